@@ -12,11 +12,14 @@ from app.models import (
     address,  # noqa: F401
     car,  # noqa: F401
     favorites,  # noqa: F401
-    fogot_password_confirmation,  # noqa: F401
+    geocode,  # noqa: F401
+    picture,  # noqa: F401
+    refresh_token,  # noqa: F401
     rental,  # noqa: F401
     review,  # noqa: F401
-    signup_confirmations,  # noqa: F401
+    revoked_token,  # noqa: F401
     user,  # noqa: F401
+    user_rating_stats,  # noqa: F401
 )
 
 # this is the Alembic Config object, which provides
@@ -25,12 +28,20 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
-if config.config_file_name is not None:
+# The app passes its connection when it applies the revisions at startup (core/database.upgrade_database),
+# its logging is kept then.
+if config.config_file_name is not None and "connection" not in config.attributes:
     fileConfig(config.config_file_name)
 
 target_metadata = Base.metadata
 config.set_main_option("sqlalchemy.url", SQLALCHEMY_DATABASE_URL)
 
+
+def include_name(name, type_, parent_names) -> bool:
+    # The R*Tree index of the addresses (and its shadow tables) is not part of the metadata
+    return not (type_ == "table" and name.startswith(address.address_rtree.name))
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -53,6 +64,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -61,6 +73,19 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 
+def do_run_migrations(connection) -> None:
+    # SQLite can not alter most of a table, batch mode recreates the table instead
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_name=include_name,
+        render_as_batch=connection.dialect.name == "sqlite",
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
 def run_migrations_online() -> None:
     """Run migrations in 'online' mode.
 
@@ -68,6 +93,11 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
@@ -75,10 +105,7 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
-
-        with context.begin_transaction():
-            context.run_migrations()
+        do_run_migrations(connection)
 
 
 if context.is_offline_mode():
@@ -0,0 +1,73 @@
+"""Indexes of the hot query columns
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+Databases created by Base.metadata.create_all already have these indexes (they are declared on the
+models), so the indexes are only created if they do not exist yet. On PostgreSQL they are created
+concurrently, without locking the tables against writes.
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns)
+INDEXES = [
+    # Availability of a car (rentals overlapping a period) and the rentals of a car
+    (
+        "ix_rentals_car_id_start_date_end_date",
+        "rentals",
+        ["car_id", "start_date", "end_date"],
+    ),
+    # Rentals of a renter, sorted by date
+    ("ix_rentals_renter_id_start_date", "rentals", ["renter_id", "start_date"]),
+    # Reviews of a user and the reviews of a rental
+    ("ix_reviews_reviewer_id", "reviews", ["reviewer_id"]),
+    ("ix_reviews_reviewee_id", "reviews", ["reviewee_id"]),
+    ("ix_reviews_rental_id", "reviews", ["rental_id"]),
+    # Cars of a user
+    ("ix_cars_owner_id", "cars", ["owner_id"]),
+    # Filters of the car search
+    (
+        "ix_cars_search",
+        "cars",
+        ["is_listed", "make", "motor_type", "transmission_type", "price_per_day"],
+    ),
+    ("ix_addresses_city", "addresses", ["city"]),
+    # Users who favorited a car (the primary key starts with user_id)
+    ("ix_favorites_car_id", "favorites", ["car_id"]),
+]
+
+
+def upgrade() -> None:
+    concurrently = op.get_bind().dialect.name == "postgresql"
+    # CREATE INDEX CONCURRENTLY can not run in a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                if_not_exists=True,
+                postgresql_concurrently=concurrently,
+            )
+
+
+def downgrade() -> None:
+    concurrently = op.get_bind().dialect.name == "postgresql"
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                if_exists=True,
+                postgresql_concurrently=concurrently,
+            )
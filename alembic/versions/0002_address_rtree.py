@@ -0,0 +1,59 @@
+"""R*Tree index of the address coordinates
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:00:00.000000
+
+SQLite only: the addresses_rtree virtual table, the triggers keeping it in sync with the addresses table
+and the rows of the addresses that already have coordinates. Databases created by Base.metadata.create_all
+already have the table and the triggers (see models/address.py).
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+UPGRADE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS addresses_rtree "
+    "USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+    "CREATE TRIGGER IF NOT EXISTS addresses_rtree_insert AFTER INSERT ON addresses "
+    "WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN "
+    "INSERT OR REPLACE INTO addresses_rtree "
+    "VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude); END",
+    "CREATE TRIGGER IF NOT EXISTS addresses_rtree_update AFTER UPDATE OF latitude, longitude ON addresses "
+    "BEGIN DELETE FROM addresses_rtree WHERE id = old.id; "
+    "INSERT INTO addresses_rtree SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude "
+    "WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL; END",
+    "CREATE TRIGGER IF NOT EXISTS addresses_rtree_delete AFTER DELETE ON addresses "
+    "BEGIN DELETE FROM addresses_rtree WHERE id = old.id; END",
+    "INSERT INTO addresses_rtree SELECT id, latitude, latitude, longitude, longitude FROM addresses "
+    "WHERE latitude IS NOT NULL AND longitude IS NOT NULL "
+    "AND id NOT IN (SELECT id FROM addresses_rtree)",
+]
+
+DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS addresses_rtree_delete",
+    "DROP TRIGGER IF EXISTS addresses_rtree_update",
+    "DROP TRIGGER IF EXISTS addresses_rtree_insert",
+    "DROP TABLE IF EXISTS addresses_rtree",
+]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    for statement in UPGRADE:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    for statement in DOWNGRADE:
+        op.execute(statement)
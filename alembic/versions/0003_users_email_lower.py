@@ -0,0 +1,76 @@
+"""Lowercase email of the users
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:00:00.000000
+
+Adds users.email_lower (case insensitive lookups of the email), fills it for the existing users and
+makes it unique. Databases created by Base.metadata.create_all already have the column and the index.
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEX_NAME = "ix_users_email_lower"
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    if "email_lower" not in {
+        column["name"] for column in sa.inspect(bind).get_columns("users")
+    }:
+        op.add_column("users", sa.Column("email_lower", sa.String()))
+    users = bind.execute(
+        sa.text(
+            "SELECT id, email FROM users WHERE email_lower IS NULL AND email IS NOT NULL"
+        )
+    ).all()
+    if users:
+        # Lowercased in Python, like the values written by the app (SQL lower() only handles ASCII)
+        bind.execute(
+            sa.text("UPDATE users SET email_lower = :email_lower WHERE id = :id"),
+            [{"id": user_id, "email_lower": email.lower()} for user_id, email in users],
+        )
+    duplicates = (
+        bind.execute(
+            sa.text(
+                "SELECT email_lower FROM users WHERE email_lower IS NOT NULL "
+                "GROUP BY email_lower HAVING count(*) > 1"
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if duplicates:
+        raise RuntimeError(
+            "Several users have the same email in a different case, merge or rename them before "
+            f"upgrading: {', '.join(duplicates)}"
+        )
+    index = next(
+        (
+            index
+            for index in sa.inspect(bind).get_indexes("users")
+            if index["name"] == INDEX_NAME
+        ),
+        None,
+    )
+    if index is not None and index["unique"]:
+        return
+    if index is not None:
+        op.drop_index(INDEX_NAME, table_name="users")
+    op.create_index(INDEX_NAME, "users", ["email_lower"], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(INDEX_NAME, table_name="users", if_exists=True)
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("email_lower")
@@ -0,0 +1,69 @@
+"""Geocoding status of the addresses
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 12:00:00.000000
+
+Columns of the background geocoding (services/geocoding.py) and the index the worker uses to find the
+PENDING addresses. Databases created by Base.metadata.create_all already have them.
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Native enum type on PostgreSQL, VARCHAR on SQLite (like the model column)
+GEOCODE_STATUS = sa.Enum("PENDING", "DONE", "FAILED", name="geocodestatus")
+INDEX_NAME = "ix_addresses_geocode_status"
+
+
+def columns() -> list:
+    return [
+        # NULL is the same as DONE, the addresses of the old rows have their coordinates
+        sa.Column("geocode_status", GEOCODE_STATUS),
+        sa.Column("geocode_attempts", sa.Integer(), server_default="0"),
+        sa.Column("geocode_next_attempt_at", sa.DateTime()),
+    ]
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    existing = {column["name"] for column in sa.inspect(bind).get_columns("addresses")}
+    GEOCODE_STATUS.create(bind, checkfirst=True)
+    for column in columns():
+        if column.name not in existing:
+            op.add_column("addresses", column)
+    op.create_index(INDEX_NAME, "addresses", ["geocode_status"], if_not_exists=True)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    op.drop_index(INDEX_NAME, table_name="addresses", if_exists=True)
+    # On SQLite the batch mode recreates the table, which drops its triggers (e.g. the R*Tree triggers of
+    # revision 0002). They are created again on the new table.
+    triggers = []
+    if bind.dialect.name == "sqlite":
+        triggers = (
+            bind.execute(
+                sa.text(
+                    "SELECT sql FROM sqlite_master "
+                    "WHERE type = 'trigger' AND tbl_name = 'addresses'"
+                )
+            )
+            .scalars()
+            .all()
+        )
+    with op.batch_alter_table("addresses") as batch_op:
+        for column in reversed(columns()):
+            batch_op.drop_column(column.name)
+    for trigger in triggers:
+        op.execute(trigger)
+    GEOCODE_STATUS.drop(bind, checkfirst=True)
@@ -0,0 +1,43 @@
+"""Drop the refresh_token table
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 12:00:00.000000
+
+The refresh tokens are stored as keyed digests in the refresh_tokens table (one row per session). The
+old table kept one plain token per user, its sessions are not moved: the users log in again.
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.drop_table("refresh_token", if_exists=True)
+
+
+def downgrade() -> None:
+    op.create_table(
+        "refresh_token",
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("token", sa.String(), unique=True),
+        sa.Column("created_at", sa.DateTime()),
+        sa.PrimaryKeyConstraint("email"),
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_refresh_token_email",
+        "refresh_token",
+        ["email"],
+        unique=True,
+        if_not_exists=True,
+    )
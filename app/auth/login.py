@@ -1,13 +1,13 @@
 from typing_extensions import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status, Form, Request, Query
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import HTMLResponse
 
 import app.core.config
 from app.auth.oauth2 import create_temp_confirmation_token, get_temp_user
-from app.models.refresh_token import DBRefreshToken
 from app.services import user_auth_service
 from app.auth import oauth2
 from app.core import database
@@ -41,10 +41,12 @@ class OAuth2PasswordRequestFormCustom(OAuth2PasswordRequestForm):
                 "If the user is a social media user and if has no account yet "
                 "a new account is also created and access token provided at this endpoint.",
 )
-def login(
+async def login(
         auth_form: OAuth2PasswordRequestFormCustom = Depends(),
         db: Session = Depends(database.get_db),
 ):
+    # The queries run on the threadpool, the password is verified on the hashing executor without holding
+    # a thread of the threadpool while waiting
     # TODO following line is for demo purposes on Swagger. login_method will be sent by backend
     # login_method = auth_form.login_method
     # login_method = LoginMethod.EMAIL if auth_form.password != "LOGIN_WITH_SOCIAL_MEDIA" \
@@ -62,30 +64,65 @@ def login(
             )
 
         try:
-            app_user = user_service.get_user_by_email(auth_form.username, db)
-            if not app_user or not Hash.verify(auth_form.password, app_user.password):
+            app_user = await run_in_threadpool(
+                user_service.get_user_by_email, auth_form.username, db
+            )
+            if not app_user:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Invalid credentials",
+                )
+            is_valid, new_password_hash = await Hash.verify_and_update_async(
+                auth_form.password, app_user.password
+            )
+            if not is_valid:
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid credentials",
                 )
-        except Exception:
+        except Exception as exc:
+            # Password hashing queue is full, the client can try again
+            if (
+                isinstance(exc, HTTPException)
+                and exc.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+            ):
+                raise
             logger.error(
                 f"Login attempt with invalid credentials ({auth_form.username})"
             )
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="Invalid credentials"
             )
+        # Hash was created with older settings (e.g. lower cost)
+        if new_password_hash:
+            await run_in_threadpool(
+                user_service.update_password_hash, app_user, new_password_hash, db
+            )
     else:
-        user = user_service.get_user_by_email(auth_form.username, db)
+        user = await run_in_threadpool(
+            user_service.get_user_by_email, auth_form.username, db
+        )
         if not user:
-            user_auth_service.create_social_media_signup_user(
-                auth_form.username, login_method, db
+            await run_in_threadpool(
+                user_auth_service.create_social_media_signup_user,
+                auth_form.username,
+                login_method,
+                db,
             )
 
-    access_token, refresh_token = oauth2.create_tokens({"username": auth_form.username})
-    user_auth_service.revoke_refresh_token(auth_form.username, db)
-    user_auth_service.save_refresh_token(auth_form.username, refresh_token, db)
-    user_auth_service.update_user_login(auth_form.username, db)
+    # Every login is a new session, sessions on other devices are kept
+    session_id = oauth2.new_session_id()
+    access_token, refresh_token = oauth2.create_tokens(
+        {"username": auth_form.username}, session_id
+    )
+    await run_in_threadpool(
+        user_auth_service.save_refresh_token,
+        auth_form.username,
+        refresh_token,
+        session_id,
+        db,
+    )
+    await run_in_threadpool(user_auth_service.update_user_login, auth_form.username, db)
     return {
         "access_token": access_token,
         "refresh_token": refresh_token,
@@ -208,20 +245,21 @@ def refresh_key(
         current_user=Depends(oauth2.get_current_user_refresh_key),
         db=Depends(database.get_db),
 ):
-    user, token = current_user
-    db_token = (
-        db.query(DBRefreshToken).filter(DBRefreshToken.email == user.email).first()
+    user, token, session_id = current_user
+    # The session keeps its id, tokens issued before sessions had ids get a new one
+    session_id = session_id or oauth2.new_session_id()
+    access_token, refresh_token = oauth2.create_tokens(
+        {"username": user.email}, session_id
     )
-    # At this point access_token provided by the user is valid (i.e. it was issued by this application) and
-    # it has not expired yet. However, we should make sure that the user did not revoke it (i.e. logged out)
-    # in the past. Thus, it must be in our db.
-    if not db_token:
+    # At this point the refresh token provided by the user is valid (i.e. it was issued by this application)
+    # and it has not expired yet. However, we should make sure that the user did not revoke it (i.e. logged
+    # out) in the past. Thus, its session must be in our db, where it is replaced by the new token.
+    if not user_auth_service.rotate_refresh_token(
+        user.email, token, refresh_token, session_id, db
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authorised."
         )
-    access_token, refresh_token = oauth2.create_tokens({"username": user.email})
-    user_auth_service.revoke_refresh_token(user.email, db)
-    user_auth_service.save_refresh_token(user.email, refresh_token, db)
     user_auth_service.update_user_login(user.email, db)
     return {
         "access_token": access_token,
@@ -1,20 +1,34 @@
+from typing import Dict
+
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
 
 from app.auth import oauth2
 from app.core import database
 from app.models.user import DBUser
-from app.services import user_auth_service
+from app.services import revocation, user_auth_service
 
 router = APIRouter(prefix="/logout", tags=["auth-login"])
 
 
 @router.post(
-    "", summary="Logout", description="Refresh tokens is revoked (deleted from db)."
+    "",
+    summary="Logout",
+    description="Access token and the refresh token of its session are revoked (deleted from db). "
+    "Sessions on other devices stay logged in.",
 )
 def logout(
     db: Session = Depends(database.get_db),
     current_user: DBUser = Depends(oauth2.get_current_user),
+    token: Dict = Depends(oauth2.get_access_token_claims),
 ):
-    user_auth_service.revoke_refresh_token(current_user.email, db)
+    # Access tokens issued before revocation support have no jti, they are valid until they expire
+    if token.get("jti"):
+        revocation.revoke_token(token["jti"], token["exp"], db)
+    # Only the session of the access token ends. Tokens issued before sessions had ids have no session to
+    # revoke, their refresh tokens expire.
+    if token.get("sid"):
+        user_auth_service.revoke_refresh_token(
+            current_user.email, db, session_id=token["sid"]
+        )
     return "logged out"
@@ -1,18 +1,25 @@
+import hashlib
+import hmac
+import os
+import secrets
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Optional
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from sqlalchemy.orm import Session
 
 from app.core import database
 from app.schemas.enums import UserType
-from app.services import user
+from app.services import revocation, user
+from app.services.principal import Principal, principal_cache
 from app.utils.constants import ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
 from app.utils.logger import logger
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+# Same scheme for public endpoints, the token is optional
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 
 # TODO SECRET_KEY will be added to environment
 # SECRET_KEY = os.getenv("SECRET_KEY")
@@ -25,18 +32,36 @@ SECRET_KEY_ACCESS_TOKEN = (
 SECRET_KEY_REFRESH_TOKEN = (
     "4b3b7fe44b24928b5e686a04733dcda7b8980d202b0e9ada2056982bb8a62496"
 )
+# Key of the digests the refresh tokens are stored under, it is not used to sign tokens
+REFRESH_TOKEN_DIGEST_KEY = os.getenv(
+    "REFRESH_TOKEN_DIGEST_KEY",
+    "22a78c56c7163e97f51e10d3fc1dddd61ecf5e9acdf3e5bbcae7a758ec7f9cf9",
+)
 ALGORITHM = "HS256"
 
 
-def create_tokens(data: dict):
+def new_session_id() -> str:
+    return secrets.token_hex(16)
+
+
+def create_tokens(data: dict, session_id: str):
+    """
+    Creates the access and the refresh token of a session. Both carry the session id (sid claim), so that
+    logging out with the access token ends the session of its refresh token only.
+    """
     to_encode_access_token = data.copy()
     to_encode_refresh_token = data.copy()
     access_token_expire = datetime.utcnow() + timedelta(
         minutes=ACCESS_TOKEN_EXPIRE_MINUTES
     )
     refresh_token_expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode_access_token.update({"exp": access_token_expire})
-    to_encode_refresh_token.update({"exp": refresh_token_expire})
+    # jti identifies a token (for revocation) and makes every token unique
+    to_encode_access_token.update(
+        {"exp": access_token_expire, "jti": secrets.token_hex(16), "sid": session_id}
+    )
+    to_encode_refresh_token.update(
+        {"exp": refresh_token_expire, "jti": secrets.token_hex(16), "sid": session_id}
+    )
     encoded_access_token_jwt = jwt.encode(
         to_encode_access_token, SECRET_KEY_ACCESS_TOKEN, algorithm=ALGORITHM
     )
@@ -46,6 +71,16 @@ def create_tokens(data: dict):
     return encoded_access_token_jwt, encoded_refresh_token_jwt
 
 
+def refresh_token_digest(token: str) -> str:
+    """
+    Digest under which a refresh token is stored. Tokens are long random values, so a keyed SHA-256 is
+    enough (no slow password hash) and it can be looked up by an index.
+    """
+    return hmac.new(
+        REFRESH_TOKEN_DIGEST_KEY.encode(), token.encode(), hashlib.sha256
+    ).hexdigest()
+
+
 def create_temp_confirmation_token(data: Dict, expire_minutes: int):
     to_encode = data.copy()
     to_encode.update({"exp": datetime.now() + timedelta(minutes=expire_minutes)})
@@ -55,14 +90,37 @@ def create_temp_confirmation_token(data: Dict, expire_minutes: int):
     return encoded_confirmation_jwt
 
 
-def get_current_user(
-    token_enc: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)
-):
+def get_access_token_claims(token_enc: str = Depends(oauth2_scheme)) -> Dict:
     """
-    This function is used for confirming the user with provided access key
+    Decodes the access token of the request.
     :param token_enc: Access token given to the user during login process.
+    :return: Claims of the token, raises exception if the token is invalid or expired.
+    """
+    try:
+        return jwt.decode(token_enc, SECRET_KEY_ACCESS_TOKEN, algorithms=ALGORITHM)
+    except Exception:
+        logger.error("Could not authenticate")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not verify credentials (credentials might have expired)",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+def get_current_principal(
+    request: Request,
+    token: Dict = Depends(get_access_token_claims),
+    db: Session = Depends(database.get_db),
+) -> Principal:
+    """
+    This function is used for confirming the user with provided access key. Users are served from the
+    principal cache and revoked tokens from the in-memory revocation list, so a confirmed request usually
+    costs no database query.
+    :param request: Request, the id of the user is saved in its state (used by database.RoutingSession)
+    :param token: Claims of the access token given to the user during login process.
     :param db: app session
-    :return: Current user (DBUser object) if the user is confirmed, raises exception otherwise.
+    :return: Principal (detached copy of the user and its profile status) if the user is confirmed,
+    raises exception otherwise.
     """
     credential_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -71,15 +129,54 @@ def get_current_user(
     )
 
     try:
-        token = jwt.decode(token_enc, SECRET_KEY_ACCESS_TOKEN, algorithms=ALGORITHM)
+        jti = token.get("jti")
+        if jti and revocation.is_token_revoked(jti, db):
+            raise Exception()
         user_email = token.get("username")
-        current_user = user.get_user_by_email(user_email, db)
-        if not current_user:
+        principal = user.get_principal(user_email, db)
+        if not principal:
             raise Exception()
     except Exception:
         logger.error("Could not authenticate")
         raise credential_exception
-    return current_user
+    request.state.user_id = principal.user.id
+    return principal
+
+
+async def identify_user(
+    request: Request, token_enc: Optional[str] = Depends(optional_oauth2_scheme)
+) -> None:
+    """
+    Saves the id of the user of a valid access token in the request state, without requiring a token. Public
+    read-only endpoints use it for read-your-writes (database.RoutingSession). Only the principal cache is
+    read: a user who wrote recently was authenticated (and cached) by this worker.
+    :param request: Request
+    :param token_enc: Access token of the request if there is one
+    """
+    if not token_enc:
+        return
+    try:
+        claims = jwt.decode(token_enc, SECRET_KEY_ACCESS_TOKEN, algorithms=ALGORITHM)
+    except Exception:
+        return
+    principal = principal_cache.get((claims.get("username") or "").lower())
+    if principal is not None:
+        request.state.user_id = principal.user.id
+
+
+def get_current_user(
+    principal: Principal = Depends(get_current_principal),
+    db: Session = Depends(database.get_db),
+):
+    """
+    This function is used for confirming the user with provided access key
+    :param principal: Confirmed user of the request
+    :param db: app session
+    :return: Current user (DBUser object of the request session) if the user is confirmed, raises exception
+    otherwise.
+    """
+    # Attach the cached copy to the session without loading it again
+    return db.merge(principal.user, load=False)
 
 
 def get_temp_user(key: str = Depends(oauth2_scheme)):
@@ -104,7 +201,8 @@ def get_current_user_refresh_key(
     This function is used for confirming the user with provided refresh key during refresh key process.
     :param refresh_token: Refresh token given to the user during login process.
     :param db: app session
-    :return: Current user (DBUser object) if the user is confirmed, raises exception otherwise.
+    :return: Current user (DBUser object), the refresh token and its session id (None for tokens issued
+    before sessions had ids) if the user is confirmed, raises exception otherwise.
     """
     credential_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -113,17 +211,17 @@ def get_current_user_refresh_key(
     )
 
     try:
-        refresh_token = jwt.decode(
+        token = jwt.decode(
             refresh_token, SECRET_KEY_REFRESH_TOKEN, algorithms=ALGORITHM
         )
-        user_email = refresh_token.get("username")
+        user_email = token.get("username")
         current_user = user.get_user_by_email(user_email, db)
         if not current_user:
             raise Exception()
     except Exception:
         logger.error("Could not authenticate")
         raise credential_exception
-    return current_user, refresh_token
+    return current_user, refresh_token, token.get("sid")
 
 
 def admin_only(current_user=Depends(get_current_user)):
@@ -152,7 +250,7 @@ def admin_only(current_user=Depends(get_current_user)):
 
 def complete_user_profile_only(
     current_user=Depends(get_current_user),
-    db: Session = Depends(database.get_db),
+    principal: Principal = Depends(get_current_principal),
 ):
     """
     Dependency that restricts access to users with complete profiles only.
@@ -162,15 +260,13 @@ def complete_user_profile_only(
 
     Args:
         current_user: A dependency that retrieves the currently authenticated user.
-        db: A dependency that provides the database session.
+        principal: A dependency that provides the cached profile status of the user.
 
     Raises:
         HTTPException: If the user's profile is not complete, an exception with status code 403 is raised.
     """
-    # Check if the user's profile is complete
-    is_complete = user.is_user_profile_complete(current_user.id, db)
-
-    if not is_complete:
+    # Check if the user's profile is complete (computed when the user was cached)
+    if not principal.profile_complete:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Access denied. Please complete your profile before accessing this resource.",
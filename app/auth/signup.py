@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Body, Depends, status, Request, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
 from pydantic import EmailStr
 
@@ -13,6 +14,7 @@ from app.services import user as user_service
 
 from app.utils import email_sender
 from app.utils.constants import CONFIRMATION_EXPIRE_PERIOD_IN_DAYS
+from app.utils.hash import Hash
 from app.utils.service_response import ServiceResponseStatus
 
 router = APIRouter(prefix="/signup", tags=["auth-signup"])
@@ -51,15 +53,18 @@ def signup(
                 "link in the email. It returns an html code to inform the user about the "
                 "success/failure of the signup process.",
 )
-def signup_confirmation(
+async def signup_confirmation(
         request: Request,
         key: str = Query(...),
         db: Session = Depends(database.get_db),
 ):
     signup_user = get_temp_user(key=key)
-    response = user_service.create_new_user(
+    # Hashed on the hashing executor without holding a thread of the threadpool while waiting
+    password_hash = await Hash.bcrypt_async(signup_user.get("password"))
+    response = await run_in_threadpool(
+        user_service.create_new_user,
         signup_user.get("email"),
-        signup_user.get("password"),
+        password_hash,
         LoginMethod.EMAIL,
         UserType.USER,
         True,
@@ -1,34 +1,320 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import math
+import itertools
+import sqlite3
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./car_rental.db"
+from alembic import command
+from alembic.config import Config
+from fastapi import Request
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import URL, Engine, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.utils import constants
+from app.utils.cache import TTLCache
+from app.utils.geo import haversine_km
+
+SQLALCHEMY_DATABASE_URL = constants.DATABASE_URL
+ALEMBIC_CONFIG_FILE = Path(__file__).resolve().parents[2] / "alembic.ini"
+
+# Connection settings of SQLite by profile name (constants.SQLITE_PROFILE).
+# "default" keeps the SQLite and SQLAlchemy defaults (rollback journal, no busy timeout, default pool).
+SQLITE_PROFILES = {
+    "default": {"pragmas": {}, "pool": {}},
+    "production": {
+        "pragmas": {
+            # Readers do not block the writer and the writer does not block readers
+            "journal_mode": "WAL",
+            # Safe with WAL (a power loss may only lose the last commits), no fsync on every commit
+            "synchronous": "NORMAL",
+            # Wait for a lock instead of failing with "database is locked"
+            "busy_timeout": constants.SQLITE_BUSY_TIMEOUT_MS,
+            # Negative value: size in KiB (per connection)
+            "cache_size": -constants.SQLITE_CACHE_SIZE_KIB,
+            "mmap_size": constants.SQLITE_MMAP_SIZE,
+            "temp_store": "MEMORY",
+        },
+        "pool": {
+            "pool_size": constants.DB_POOL_SIZE,
+            "max_overflow": constants.DB_MAX_OVERFLOW,
+            "pool_timeout": constants.DB_POOL_TIMEOUT_SECONDS,
+        },
+    },
+}
+
+# Drivers of the async engine by backend (DATABASE_URL names the sync driver)
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    db = SessionLocal(info={"request": request})
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request):
+    """
+    Session of the read-only endpoints, its queries go to the read replicas (see RoutingSession).
+    """
+    db = SessionLocal(info={"request": request, "read_only": True})
     try:
         yield db
     finally:
         db.close()
 
 
-# Register Python's math.sin in the SQLite connection
+async def get_async_db(request: Request):
+    """
+    Session of the async engine for async endpoints. Queries do not hold a thread of the threadpool.
+    Relationships are not loaded lazily on an AsyncSession, the services load what the response needs.
+    """
+    async with AsyncSessionLocal(info={"request": request}) as db:
+        yield db
+
+
+async def get_async_read_db(request: Request):
+    """
+    Async session of the read-only endpoints, its queries go to the read replicas (see RoutingSession).
+    """
+    async with AsyncSessionLocal(info={"request": request, "read_only": True}) as db:
+        yield db
+
+
+# Ids of the users who committed a write recently. Their reads go to the primary until the replicas have
+# the write. Other app workers do not see these entries, the user's next request may be served by one.
+recent_writers = TTLCache(
+    maxsize=constants.RECENT_WRITERS_CACHE_SIZE,
+    ttl=constants.READ_YOUR_WRITES_SECONDS,
+)
+
+
+def request_user_id(db: Session) -> Optional[int]:
+    """
+    Id of the authenticated user of the request a session belongs to (set by oauth2.get_current_principal
+    and oauth2.identify_user).
+    """
+    request = db.info.get("request")
+    return getattr(request.state, "user_id", None) if request is not None else None
+
+
+class RoutingSession(Session):
+    """
+    Session that sends the queries of read-only sessions (info["read_only"], see get_read_db) to a read
+    replica (each session to the next one) and everything else to the primary (the bind of the session). A read-only session also
+    reads from the primary after it wrote something, and when the user of its request committed a write in
+    the last READ_YOUR_WRITES_SECONDS (read-your-writes).
+    """
+
+    # Engines of the replicas (sync engines of the async engines for AsyncSession)
+    replicas: List[Engine] = []
+    _turn = itertools.count()
+
+    def get_bind(self, mapper=None, *, clause=None, **kw):
+        if (
+            self.replicas
+            and self.info.get("read_only")
+            and not self._flushing
+            and not self.info.get("wrote")
+            and not recent_writers.get(request_user_id(self))
+        ):
+            # One replica per session, so that its queries (e.g. a count and a page) see the same data
+            if "replica" not in self.info:
+                self.info["replica"] = self.replicas[
+                    next(self._turn) % len(self.replicas)
+                ]
+            return self.info["replica"]
+        return super().get_bind(mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def remember_write(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def remember_writer(session):
+    user_id = request_user_id(session)
+    if session.info.get("wrote") and user_id is not None:
+        recent_writers.set(user_id, True)
+
+
+def sqlite_has_math_functions() -> bool:
+    """
+    Checks if the SQLite library is compiled with the built-in math functions (SQLITE_ENABLE_MATH_FUNCTIONS).
+    """
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute("SELECT sin(0), cos(0), acos(1), radians(0)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+# Built-in math functions run in C. If they are missing, distance is calculated by the fused haversine_km function.
+SQLITE_MATH_FUNCTIONS = sqlite_has_math_functions()
+
+
 def register_math_functions(db_connection, _):
-    db_connection.create_function("sin", 1, math.sin)
-    db_connection.create_function("cos", 1, math.cos)
-    db_connection.create_function("acos", 1, math.acos)
-    db_connection.create_function("radians", 1, math.radians)
+    db_connection.create_function("haversine_km", 4, haversine_km, deterministic=True)
+
+
+def server_pool_settings() -> Dict:
+    """
+    Pool of a database server (e.g. PostgreSQL) for one worker process. The connections of the app
+    (DB_MAX_CONNECTIONS) are split between the WEB_CONCURRENCY workers, so that all pools together
+    stay under the connection limit of the server.
+    """
+    per_worker = max(
+        1, constants.DB_MAX_CONNECTIONS // max(1, constants.WEB_CONCURRENCY)
+    )
+    pool_size = min(constants.DB_POOL_SIZE, per_worker)
+    return {
+        "pool_size": pool_size,
+        "max_overflow": min(constants.DB_MAX_OVERFLOW, per_worker - pool_size),
+        "pool_timeout": constants.DB_POOL_TIMEOUT_SECONDS,
+        # Connections closed by the server (restart, failover, idle timeout) are replaced before use
+        "pool_pre_ping": True,
+        "pool_recycle": constants.DB_POOL_RECYCLE_SECONDS,
+    }
+
+
+def add_sqlite_listeners(db_engine: Engine, pragmas: Dict) -> None:
+    """
+    Applies the pragmas and registers the distance function on every new DBAPI connection of the pool.
+    :param db_engine: SQLite engine (sync_engine of an async engine)
+    :param pragmas: Pragmas of the SQLite profile
+    """
+
+    def apply_pragmas(db_connection, _):
+        cursor = db_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    event.listen(db_engine, "connect", apply_pragmas)
+    event.listen(db_engine, "connect", register_math_functions)
+
+
+def create_db_engine(
+    url: str = SQLALCHEMY_DATABASE_URL, profile: str = constants.SQLITE_PROFILE
+) -> Engine:
+    """
+    Creates the engine of the app. On SQLite the pragmas of the profile and the distance function are
+    applied on every new DBAPI connection of the pool. Other databases get a pool sized per worker process.
+    :param url: Database URL
+    :param profile: Name of the SQLite profile (see SQLITE_PROFILES), not used by other databases
+    """
+    if make_url(url).get_backend_name() != "sqlite":
+        return create_engine(url, **server_pool_settings())
+
+    settings = SQLITE_PROFILES[profile]
+    db_engine = create_engine(
+        url, connect_args={"check_same_thread": False}, **settings["pool"]
+    )
+    add_sqlite_listeners(db_engine, settings["pragmas"])
+    return db_engine
+
 
+def async_url(url: str) -> URL:
+    """
+    URL of the same database with the async driver (e.g. sqlite+aiosqlite, postgresql+asyncpg).
+    """
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
 
-# Bind the function to the connection
-with engine.connect() as connection:
-    register_math_functions(connection.connection, None)
+
+def create_async_db_engine(
+    url: str = SQLALCHEMY_DATABASE_URL, profile: str = constants.SQLITE_PROFILE
+) -> AsyncEngine:
+    """
+    Creates the async engine of the app, configured like the engine of create_db_engine.
+    :param url: Database URL (with the sync driver, it is replaced by the async driver)
+    :param profile: Name of the SQLite profile (see SQLITE_PROFILES), not used by other databases
+    """
+    url = async_url(url)
+    if url.get_backend_name() != "sqlite":
+        return create_async_engine(url, **server_pool_settings())
+
+    settings = SQLITE_PROFILES[profile]
+    db_engine = create_async_engine(url, **settings["pool"])
+    add_sqlite_listeners(db_engine.sync_engine, settings["pragmas"])
+    return db_engine
+
+
+# Extensions installed in the database of each PostgreSQL engine (read once)
+_postgres_extensions: Dict[Engine, FrozenSet[str]] = {}
+
+
+def postgres_extensions(bind: Engine) -> FrozenSet[str]:
+    """
+    Names of the extensions installed in a PostgreSQL database (e.g. "postgis", "earthdistance").
+    :param bind: Engine of the database
+    """
+    if bind not in _postgres_extensions:
+        with bind.connect() as connection:
+            _postgres_extensions[bind] = frozenset(
+                connection.execute(text("SELECT extname FROM pg_extension")).scalars()
+            )
+    return _postgres_extensions[bind]
+
+
+class AsyncRoutingSession(RoutingSession):
+    """
+    RoutingSession of AsyncSessionLocal (routes to the replicas of the async engine).
+    """
+
+
+def upgrade_database(db_engine: Engine) -> None:
+    """
+    Brings the database to the schema of the models: the missing tables are created, the changes of the
+    existing tables are the Alembic revisions (alembic/versions). A new database already has the final
+    schema after create_all, so it is only stamped with the head revision. The models must be imported.
+    """
+    new_database = not inspect(db_engine).has_table("users")
+    Base.metadata.create_all(db_engine)
+    config = Config(str(ALEMBIC_CONFIG_FILE))
+    with db_engine.connect() as connection:
+        # env.py runs the revisions on this connection
+        config.attributes["connection"] = connection
+        if new_database:
+            command.stamp(config, "head")
+        else:
+            command.upgrade(config, "head")
+
+
+engine = create_db_engine()
+replica_engines = [create_db_engine(url) for url in constants.DATABASE_REPLICA_URLS]
+RoutingSession.replicas = replica_engines
+SessionLocal = sessionmaker(
+    class_=RoutingSession, autocommit=False, autoflush=False, bind=engine
+)
+
+async_engine = create_async_db_engine()
+async_replica_engines = [
+    create_async_db_engine(url) for url in constants.DATABASE_REPLICA_URLS
+]
+AsyncRoutingSession.replicas = [
+    replica.sync_engine for replica in async_replica_engines
+]
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    sync_session_class=AsyncRoutingSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
@@ -5,11 +7,31 @@ from fastapi_pagination import add_pagination
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from app.auth import login, logout, signup
-from app.core.database import Base, engine
+from app.core.database import engine, upgrade_database
 from app.routers import admin_user_tools, car, favorites, rental, review, user
+from app.services.geocoding import geocoding_worker
+from app.services.image_processing import (
+    import_legacy_pictures,
+    picture_recovery,
+)
 from app.tests.test_sets import create_test_db
+from app.utils.address_translation import seed_gazetteer
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    upgrade_database(engine)
+    seed_gazetteer()
+    # Geocodes the addresses left PENDING (e.g. by a restart) and the new ones
+    geocoding_worker.start()
+    import_legacy_pictures()
+    # Pictures left PROCESSING by a stopped app worker, also checked periodically
+    picture_recovery.start()
+    yield
+    picture_recovery.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 Instrumentator().instrument(app).expose(app)
 
@@ -32,8 +54,6 @@ app.include_router(create_test_db.router)
 app.include_router(favorites.router)
 app.include_router(admin_user_tools.router)
 
-Base.metadata.create_all(engine)
-
 
 # This code is here to run the app from pycharm
 if __name__ == "__main__":
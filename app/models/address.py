@@ -1,7 +1,21 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, DateTime, Boolean
+from sqlalchemy import (
+    DDL,
+    Column,
+    ForeignKey,
+    Integer,
+    String,
+    Float,
+    DateTime,
+    Boolean,
+    Enum,
+    column,
+    event,
+    table,
+)
 from sqlalchemy.orm import relationship
 
 from app.core.database import Base
+from app.schemas.enums import GeocodeStatus
 
 
 class DBAddress(Base):
@@ -11,12 +25,54 @@ class DBAddress(Base):
     street = Column(String, default="")
     number = Column(String, default="")
     postal_code = Column(String, default="")
-    city = Column(String, default="")
+    city = Column(String, default="", index=True)
     state = Column(String, default="")
     country = Column(String, default="")
     latitude = Column(Float, default=None)
     longitude = Column(Float, default=None)
     is_address_confirmed = Column(Boolean, default=False)
+    # Coordinates are calculated in the background (services/geocoding.py), NULL is the same as DONE.
+    # alembic/versions/0004_address_geocode_columns.py adds the geocode columns to older databases.
+    geocode_status = Column(Enum(GeocodeStatus), default=GeocodeStatus.DONE, index=True)
+    geocode_attempts = Column(Integer, default=0)
+    # Next try of a PENDING address (also the lease of the worker processing it)
+    geocode_next_attempt_at = Column(DateTime, default=None)
 
     created_at = Column(DateTime)
     user = relationship("DBUser", back_populates="address")
+
+
+# SQLite R*Tree index over the coordinates of the addresses. It is a virtual table, so it is not part of
+# the metadata. Triggers keep it in sync with the addresses table. It is only used for querying.
+# It is created with the addresses table, alembic/versions/0002_address_rtree.py adds it to older databases.
+address_rtree = table(
+    "addresses_rtree",
+    column("id"),
+    column("min_lat"),
+    column("max_lat"),
+    column("min_lon"),
+    column("max_lon"),
+)
+
+ADDRESS_RTREE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS addresses_rtree "
+    "USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+    "CREATE TRIGGER IF NOT EXISTS addresses_rtree_insert AFTER INSERT ON addresses "
+    "WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN "
+    "INSERT OR REPLACE INTO addresses_rtree "
+    "VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude); END",
+    "CREATE TRIGGER IF NOT EXISTS addresses_rtree_update AFTER UPDATE OF latitude, longitude ON addresses "
+    "BEGIN DELETE FROM addresses_rtree WHERE id = old.id; "
+    "INSERT INTO addresses_rtree SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude "
+    "WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL; END",
+    "CREATE TRIGGER IF NOT EXISTS addresses_rtree_delete AFTER DELETE ON addresses "
+    "BEGIN DELETE FROM addresses_rtree WHERE id = old.id; END",
+]
+
+
+for statement in ADDRESS_RTREE_DDL:
+    event.listen(
+        DBAddress.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="sqlite"),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import relationship
 
 from app.core.database import Base
@@ -6,9 +6,20 @@ from app.core.database import Base
 
 class DBCar(Base):
     __tablename__ = "cars"
+    __table_args__ = (
+        # Equality filters of the car search (listed cars first), the price range last
+        Index(
+            "ix_cars_search",
+            "is_listed",
+            "make",
+            "motor_type",
+            "transmission_type",
+            "price_per_day",
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
     make = Column(String, nullable=False)
     model = Column(String, nullable=False)
     year = Column(Integer, nullable=False)
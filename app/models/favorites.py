@@ -5,4 +5,5 @@ from sqlalchemy import Column, Integer, ForeignKey
 class DBFavorite(Base):
     __tablename__ = "favorites"
     user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
-    car_id = Column(Integer, ForeignKey("cars.id"), primary_key=True)
+    # The primary key starts with user_id, the index serves the lookups by car
+    car_id = Column(Integer, ForeignKey("cars.id"), primary_key=True, index=True)
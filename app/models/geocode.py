@@ -0,0 +1,63 @@
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, String
+
+from app.core.database import Base
+from app.utils.geo import normalize_place, normalize_postal_code
+
+
+class DBGeocodeCache(Base):
+    __tablename__ = "geocode_cache"
+
+    # Normalized address (see address_translation.address_key)
+    address_key = Column(String, primary_key=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DBGazetteerPlace(Base):
+    """
+    Centroids of cities and postal code areas used for geocoding without a network connection.
+    Names and postal codes are stored normalized (see utils/geo.normalize_place and normalize_postal_code).
+    """
+
+    __tablename__ = "gazetteer_places"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    city = Column(String, nullable=False, default="")
+    country = Column(String, nullable=False, default="")
+    postal_code = Column(String, nullable=False, default="")
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_gazetteer_places_country_city", "country", "city"),
+        Index("ix_gazetteer_places_country_postal_code", "country", "postal_code"),
+    )
+
+
+def read_gazetteer_file(path: Path) -> list:
+    """
+    Reads a gazetteer file. Each line is "city;country;postal code;latitude;longitude" (postal code
+    can be empty for city centroids).
+    """
+    places = []
+    with open(path, "r", encoding="utf-8") as gazetteer_file:
+        for line in gazetteer_file:
+            if not line.strip():
+                continue
+            city, country, postal_code, latitude, longitude = line.rstrip("\n").split(
+                ";"
+            )
+            places.append(
+                {
+                    "city": normalize_place(city),
+                    "country": normalize_place(country),
+                    "postal_code": normalize_postal_code(postal_code),
+                    "latitude": float(latitude),
+                    "longitude": float(longitude),
+                }
+            )
+    return places
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Enum,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+)
+from sqlalchemy.orm import relationship
+
+from app.core.database import Base
+from app.schemas.enums import PictureOwner, PictureStatus
+
+
+class DBBlob(Base):
+    """
+    Uploaded picture file in the content addressed store (services/blob_store.py). Identical uploads are
+    stored once, ref_count is the number of pictures (rows of the pictures table) using the file.
+    """
+
+    __tablename__ = "blobs"
+
+    # SHA-256 of the uploaded content (the stored file is optimized, so it is only the address)
+    digest = Column(String(64), primary_key=True)
+    # File extension with the dot (e.g. ".jpg")
+    extension = Column(String, nullable=False, default="")
+    content_type = Column(String)
+    size = Column(Integer)
+    ref_count = Column(Integer, nullable=False, default=0)
+    status = Column(
+        Enum(PictureStatus), nullable=False, default=PictureStatus.PROCESSING
+    )
+    # Comma separated widths of the renditions created (at most the width of the optimized original)
+    renditions = Column(String, default="")
+    # Comma separated formats of the renditions (e.g. WEBP,AVIF), each width is available in each format
+    rendition_formats = Column(String, default="")
+    error = Column(String, default=None)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Set when the file is handed to the image processing pool
+    started_at = Column(DateTime, default=None)
+    processed_at = Column(DateTime, default=None)
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.digest}{self.extension}"
+
+
+class DBPicture(Base):
+    """
+    Picture of a car or a user, pointing to its file in the blob store.
+    """
+
+    __tablename__ = "pictures"
+    __table_args__ = (
+        UniqueConstraint("owner_type", "owner_id", "file_name"),
+        Index("ix_pictures_owner", "owner_type", "owner_id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    # Car or user the picture belongs to
+    owner_type = Column(Enum(PictureOwner), nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    # Name of the blob file, also used in the URLs of the picture
+    file_name = Column(String, nullable=False)
+    blob_digest = Column(
+        String(64), ForeignKey("blobs.digest"), nullable=False, index=True
+    )
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    blob = relationship(DBBlob, lazy="joined")
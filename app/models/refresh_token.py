@@ -1,11 +1,17 @@
 from app.core.database import Base
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import Column, DateTime, Integer, String
 
 from _datetime import datetime
 
 
 class DBRefreshToken(Base):
-    __tablename__ = "refresh_token"
-    email = Column(String, primary_key=True, unique=True, index=True)
-    token = Column(String, unique=True)
-    created_at = Column(DateTime, default=datetime.utcnow())
+    # One row per session, a user can be logged in on many devices
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Keyed SHA-256 digest (hex) of the refresh token, the token itself is not stored
+    token_digest = Column(String(64), unique=True, index=True, nullable=False)
+    # sid claim of the access and refresh tokens of the session (logout ends this session only)
+    session_id = Column(String(32), index=True)
+    email = Column(String, index=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime)
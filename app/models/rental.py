@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, ForeignKey, Float, Date, Enum
+from sqlalchemy import Column, Integer, ForeignKey, Float, Date, Enum, Index
 from sqlalchemy.orm import relationship
 from app.core.database import Base
 from app.schemas.enums import RentalStatus
@@ -6,6 +6,14 @@ from app.schemas.enums import RentalStatus
 
 class DBRental(Base):
     __tablename__ = "rentals"
+    __table_args__ = (
+        # Used by the availability (overlap) checks of a car
+        Index(
+            "ix_rentals_car_id_start_date_end_date", "car_id", "start_date", "end_date"
+        ),
+        # Rentals of a renter (also sorted by date, the default order of the rental lists)
+        Index("ix_rentals_renter_id_start_date", "renter_id", "start_date"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     car_id = Column(Integer, ForeignKey("cars.id"))
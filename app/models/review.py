@@ -9,9 +9,9 @@ class DBReview(Base):
     __tablename__ = "reviews"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    rental_id = Column(Integer, ForeignKey("rentals.id"))
-    reviewer_id = Column(Integer, ForeignKey("users.id"))
-    reviewee_id = Column(Integer, ForeignKey("users.id"))
+    rental_id = Column(Integer, ForeignKey("rentals.id"), index=True)
+    reviewer_id = Column(Integer, ForeignKey("users.id"), index=True)
+    reviewee_id = Column(Integer, ForeignKey("users.id"), index=True)
     rating = Column(Integer, nullable=False)
     comment = Column(String)
     review_date = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,15 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, String
+
+from app.core.database import Base
+
+
+class DBRevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    # jti claim of the revoked access token
+    jti = Column(String, primary_key=True)
+    # Expiry of the token, the row is not needed after that
+    expires_at = Column(DateTime, nullable=False, index=True)
+    revoked_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
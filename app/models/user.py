@@ -10,12 +10,21 @@ from app.core.database import Base
 from app.schemas.enums import LoginMethod, UserType
 
 
+def lowercase_email(context):
+    # Lowercased in Python (SQL lower() only handles ASCII). The email of a user is not changed after the
+    # insert, so the default is the only place email_lower is set.
+    email = context.get_current_parameters().get("email")
+    return email.lower() if email else None
+
+
 class DBUser(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, default="")
     last_name = Column(String, default="")
     email = Column(String, unique=True, index=True)
+    # Lowercase copy of the email, case insensitive lookups use its index (one user per email in any case)
+    email_lower = Column(String, unique=True, index=True, default=lowercase_email)
     password = Column(String, default="")
     login_method = Column(Enum(LoginMethod), default=Enum(LoginMethod.EMAIL))
     phone_number = Column(String, default="")
@@ -41,6 +50,12 @@ class DBUser(Base):
     reviews_received = relationship(
         "DBReview", foreign_keys="[DBReview.reviewee_id]", back_populates="reviewee"
     )
+    rating_stats = relationship(
+        "DBUserRatingStats",
+        back_populates="user",
+        cascade="all, delete-orphan",
+        uselist=False,
+    )
 
     def is_admin(self):
         return self.user_type == UserType.ADMIN
@@ -0,0 +1,15 @@
+from sqlalchemy import Column, Float, ForeignKey, Integer
+from sqlalchemy.orm import relationship
+
+from app.core.database import Base
+
+
+class DBUserRatingStats(Base):
+    __tablename__ = "user_rating_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_average = Column(Float, nullable=False, default=0)
+
+    user = relationship("DBUser", back_populates="rating_stats")
@@ -6,6 +6,7 @@ from app.core import database
 from app.models.user import DBUser
 from app.schemas.user import UserProfileForm
 
+from app.services import review as review_service
 from app.services import user as user_service
 
 router = APIRouter(prefix="/admin", tags=["admin user tools"])
@@ -51,3 +52,15 @@ def modify_user(
     db: Session = Depends(database.get_db),
 ):
     return user_service.modify_user(user_id, user_profile, db)
+
+
+@router.post(
+    "/rating-stats/rebuild",
+    summary="Rebuild user rating stats",
+    description="Endpoint for admin to recalculate the precomputed user ratings from all reviews",
+)
+def rebuild_rating_stats(
+    admin: DBUser = Depends(oauth2.admin_only),
+    db: Session = Depends(database.get_db),
+):
+    return {"users_with_ratings": review_service.rebuild_rating_stats(db)}
@@ -6,12 +6,14 @@ It allows users to create, read, update, and delete car records.
 Some actions require user authentication.
 """
 
+from datetime import date
 from typing import List
 
 from fastapi import (
     APIRouter,
     Depends,
     File,
+    Header,
     HTTPException,
     Path,
     Query,
@@ -19,21 +21,31 @@ from fastapi import (
     status,
 )
 from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app.auth import oauth2
-from app.core.database import get_db
+from app.core.database import get_async_read_db, get_db
 from app.schemas.car import CarCreate, CarDisplay, CarUpdate
 from app.schemas.enums import (
     CarEngineType,
     CarMake,
     CarSearchSortType,
     CarTransmissionType,
+    RenditionFormat,
     SortDirection,
+    TotalCountType,
     UserType,
 )
-from app.schemas.rental import RentalPeriod
-from app.services import car
+from app.schemas.picture import PictureDisplay
+from app.schemas.rental import (
+    CarAvailabilityMatrix,
+    CarAvailabilityRequest,
+    CarCalendarDisplay,
+    RentalPeriod,
+)
+from app.services import car, rental
+from app.services.image_processing import accepted_formats
 from app.utils import constants
 
 router = APIRouter(prefix="/cars", tags=["cars"])
@@ -95,11 +107,12 @@ def create_car(
 
 @router.get(
     path="/",
+    dependencies=[Depends(oauth2.identify_user)],
     summary="Search and list cars",
     description="Search and retrieve a paginated list of cars based on various filters. Filter car search based on distance, city, booking periods, engine type"
     " transmission type, price and make. Sort result accordingly.",
 )
-def search_car(
+async def search_car(
     distance_km: float = Query(
         default=None,
         ge=1,
@@ -126,15 +139,25 @@ def search_car(
     skip: int = Query(
         default=0, ge=0, description="Used for pagination for the requests."
     ),
+    cursor: str = Query(
+        default=None,
+        description="Cursor for keyset pagination (next_cursor of the previous page). "
+        "Overrides skip.",
+    ),
+    include_total: TotalCountType = Query(
+        TotalCountType.EXACT,
+        description="EXACT: total count of the matches, ESTIMATE: cheaper approximate count "
+        "(total_counts_is_capped is true if it stopped counting at a cap), NONE: no total count",
+    ),
     limit: int = Query(
         constants.QUERY_LIMIT_DEFAULT,
         ge=1,
         le=constants.QUERY_LIMIT_MAX,
         description="Length of the response list",
     ),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_read_db),
 ):
-    return car.search_cars(
+    return await car.search_cars_async(
         distance_km=distance_km,
         renter_lat=renter_lat,
         renter_lon=renter_lon,
@@ -150,9 +173,39 @@ def search_car(
         skip=skip,
         limit=min(limit, constants.QUERY_LIMIT_MAX),
         db=db,
+        cursor=cursor,
+        include_total=include_total,
     )
 
 
+@router.post(
+    "/availability",
+    response_model=CarAvailabilityMatrix,
+    summary="Check availability of many cars",
+    description="Check the availability of a list of cars for one or more periods with a single request. "
+    "Returns a boolean per car and period and the busy periods of each car.",
+)
+def get_cars_availability(
+    request: CarAvailabilityRequest,
+    db: Session = Depends(get_db),
+):
+    """
+    Check the availability of many cars for many periods.
+
+    Args:
+        request (CarAvailabilityRequest): The ids of the cars and the periods to check.
+        db (Session): Database session dependency.
+
+    Returns:
+        CarAvailabilityMatrix: Availability per car (in the order of car_ids) and period
+        (in the order of periods).
+
+    Raises:
+        HTTPException: If any of the cars does not exist.
+    """
+    return rental.get_availability_matrix(db, request.car_ids, request.periods)
+
+
 # @router.get("/test")
 # def test(db=Depends(get_db)):
 #     return test_rating(db)
@@ -161,25 +214,26 @@ def search_car(
 @router.get(
     "/{car_id}",
     response_model=CarDisplay,
+    dependencies=[Depends(oauth2.identify_user)],
     summary="Get car by ID",
     description="Retrieve details of a car by its ID.",
 )
-def get_car(
+async def get_car(
     car_id: int = Path(..., ge=1, description="The ID of the car to retrieve"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_read_db),
 ) -> CarDisplay:
     """
     Retrieve a car entry from the database by its ID.
 
     Args:
         car_id (int): The ID of the car to retrieve.
-        db (Session): Database session dependency.
+        db (AsyncSession): Async database session dependency.
 
     Returns:
         CarDisplay: The details of the car with the specified ID.
     """
     try:
-        db_car = car.get_car(db, car_id)
+        db_car = await car.get_car_async(db, car_id)
         # Check if the database car record has different model than response model
         CarDisplay.model_validate(db_car)
         return db_car
@@ -266,6 +320,42 @@ def delete_car(
     return car.delete_car(db, car_id)
 
 
+@router.get(
+    "/{car_id}/calendar",
+    response_model=CarCalendarDisplay,
+    summary="Get availability calendar of a car",
+    description="Retrieve the busy and free periods of a car between two dates.",
+)
+def get_car_calendar(
+    car_id: int = Path(..., ge=1, description="The ID of the car"),
+    from_date: date = Query(
+        None, alias="from", description="First day of the calendar (default: today)"
+    ),
+    to_date: date = Query(
+        None,
+        alias="to",
+        description=f"Last day of the calendar (default: {constants.CALENDAR_DEFAULT_DAYS} days later)",
+    ),
+    db: Session = Depends(get_db),
+):
+    """
+    Retrieve the merged busy periods and the free gaps of a car.
+
+    Args:
+        car_id (int): The ID of the car.
+        from_date (date): First day of the calendar.
+        to_date (date): Last day of the calendar.
+        db (Session): Database session dependency.
+
+    Returns:
+        CarCalendarDisplay: Busy and free periods covering the requested window.
+
+    Raises:
+        HTTPException: If the car does not exist or the window is invalid.
+    """
+    return rental.get_car_calendar(db, car_id, from_date, to_date)
+
+
 @router.post(
     "/{car_id}/car-pictures",
     status_code=status.HTTP_201_CREATED,
@@ -315,33 +405,67 @@ def upload_car_picture(
             detail="You are not authorized to update this car",
         )
 
-    return car.upload_car_picture(picture, db_car.id)
+    return car.upload_car_picture(picture, db_car.id, db)
 
 
 @router.get("/{car_id}/car-pictures", response_model=List[str])
 def get_car_pictures(
     car_id: int = Path(...),
+    width: int = Query(
+        default=None,
+        ge=1,
+        description="Width the pictures are displayed at. The URL of the best fitting resized copy is "
+        "returned instead of the original picture.",
+    ),
+    image_format: RenditionFormat = Query(
+        default=None,
+        alias="format",
+        description="Format of the resized copies (default: the best one in the Accept header)",
+    ),
+    accept: str = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """
-    Get a list of all picture filenames for a specific car.
+    Get a list of all picture URLs for a specific car.
 
     Args:
         car_id (int): The ID of the car.
+        width (int, optional): Display width, selects the smallest rendition at least this wide.
+        image_format (RenditionFormat, optional): Format of the renditions (WEBP or AVIF).
+        accept (str, optional): Accept header, used when no format is given.
         db (Session): Database session dependency.
     Returns:
-        List[str]: A list of filenames of pictures associated with the car.
+        List[str]: A list of URLs of the pictures associated with the car.
     """
 
     # Raise error if car doesnt exist
     car.get_car(db, car_id)
 
-    pictures_list = car.get_car_pictures(car_id)
-    pictures_list = [
-        f"/static/images/car-images/car_{car_id:06}/" + picture
-        for picture in pictures_list
-    ]
-    return pictures_list
+    image_formats = [image_format] if image_format else accepted_formats(accept)
+    return car.get_car_pictures(db, car_id, width, image_formats)
+
+
+@router.get("/{car_id}/car-pictures/{filename}/status", response_model=PictureDisplay)
+def get_car_picture_status(
+    car_id: int = Path(...),
+    filename: str = Path(...),
+    db: Session = Depends(get_db),
+):
+    """
+    Get the processing status of a car picture.
+
+    Uploaded pictures are optimized and resized in the background. When the status is READY,
+    the renditions (resized copies by width) can be used.
+
+    Args:
+        car_id (int): The ID of the car.
+        filename (str): The name of the picture file.
+        db (Session): Database session dependency.
+
+    Returns:
+        PictureDisplay: Status, URL and rendition URLs of the picture.
+    """
+    return car.get_car_picture_status(db, car_id, filename)
 
 
 @router.delete(
@@ -374,7 +498,7 @@ def delete_car_picture(
             detail="You are not authorized to delete this car's pictures",
         )
 
-    success = car.delete_car_picture(car_id, filename)
+    success = car.delete_car_picture(car_id, filename, db)
     if success:
         return {"message": f"Picture {filename} deleted successfully"}
     else:
@@ -412,7 +536,7 @@ def delete_all_car_pictures(
             detail="You are not authorized to delete this car's pictures",
         )
 
-    car.delete_all_car_pictures(car_id)
+    car.delete_all_car_pictures(car_id, db)
     return {"message": f"All pictures for car_id {car_id} deleted successfully"}
 
 
@@ -16,7 +16,7 @@ router = APIRouter(prefix="/favorites", tags=["favorites"])
     description="Gets id list of the cars favorited by the current user",
 )
 def get_favorites_for_user(
-    db: Session = Depends(database.get_db),
+    db: Session = Depends(database.get_read_db),
     current_user: UserBase = Depends(oauth2.get_current_user),
 ):
     return favorites_service.get_favorites_for_user(current_user, db)
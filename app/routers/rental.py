@@ -1,12 +1,13 @@
 from typing import List, Union, Dict, Optional
 
 from app.auth.oauth2 import get_current_user
-from app.schemas.enums import RentalSort, SortDirection
+from app.schemas.enums import RentalSort, SortDirection, TotalCountType
 from fastapi import Query, status
 from fastapi.responses import JSONResponse
 from app.auth import oauth2
 from app.services import rental as rental_service
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.schemas.rental import RentalDisplay, RentalPeriod
 from app.utils import constants
@@ -14,7 +15,7 @@ from app.services.rental import (
     update_rental,
     delete_rental,
 )
-from app.core.database import get_db
+from app.core.database import get_async_read_db, get_db
 
 # router = APIRouter()
 router = APIRouter(prefix="/rentals", tags=["rentals"])
@@ -37,20 +38,40 @@ def create_new_rental(
 
 
 @router.get(
-    "", response_model=Dict[str, Union[Optional[int], Optional[List[RentalDisplay]]]]
+    "",
+    response_model=Dict[
+        str,
+        Union[
+            Optional[bool],
+            Optional[int],
+            Optional[str],
+            Optional[List[RentalDisplay]],
+        ],
+    ],
 )
-def get_rentals(  # noqa: F811
+async def get_rentals(  # noqa: F811
     car_id: int = Query(None),
     rental_id: int = Query(None),
     sort_by: RentalSort = Query(RentalSort.DATE),
     sort_dir: SortDirection = Query(SortDirection.ASC),
     skip: int = Query(0),
     limit: int = Query(constants.QUERY_LIMIT_DEFAULT),
-    db: Session = Depends(get_db),
+    cursor: str = Query(None, description="next_cursor of the previous page"),
+    include_total: TotalCountType = Query(TotalCountType.EXACT),
+    db: AsyncSession = Depends(get_async_read_db),
     current_user=Depends(get_current_user),
 ):
-    return rental_service.get_rentals(
-        db, current_user, rental_id, car_id, sort_by, sort_dir, skip, limit
+    return await rental_service.get_rentals_async(
+        db,
+        current_user,
+        rental_id,
+        car_id,
+        sort_by,
+        sort_dir,
+        skip,
+        limit,
+        cursor,
+        include_total,
     )
 
 
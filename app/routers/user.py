@@ -11,13 +11,15 @@ from fastapi import (
     status,
     Body,
 )
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app.auth import oauth2
 from app.core import database
 from app.models.user import DBUser
 from app.schemas.car import CarDisplay
-from app.schemas.enums import RentalSort, SortDirection, ReviewSort
+from app.schemas.enums import RentalSort, SortDirection, ReviewSort, TotalCountType
+from app.schemas.picture import PictureDisplay
 from app.schemas.rental import RentalDisplay
 from app.schemas.review import ReviewDisplay
 from app.schemas.user import (
@@ -49,7 +51,9 @@ def check_user_id_and_path_parameter(user_id: int, path_param: int):
     response_model=Dict[
         str,
         Union[
+            Optional[bool],
             Optional[int],
+            Optional[str],
             Optional[List[UserDisplay]],
             Optional[UserDisplay],
             Optional[UserPublicDisplay],
@@ -68,7 +72,9 @@ def get_users(
             default=constants.QUERY_LIMIT_DEFAULT,
             description=f"Length of the response list (max: {constants.QUERY_LIMIT_MAX})",
         ),
-        db: Session = Depends(database.get_db),
+        cursor: str = Query(None, description="next_cursor of the previous page (overrides skip)."),
+        include_total: TotalCountType = Query(TotalCountType.EXACT),
+        db: Session = Depends(database.get_read_db),
         current_user=Depends(oauth2.get_current_user),
 ):
     if not current_user.is_admin() and not user_id:
@@ -90,7 +96,9 @@ def get_users(
             }
 
     else:
-        service_response = user_service.get_users(db, skip, min(limit, constants.QUERY_LIMIT_MAX))
+        service_response = user_service.get_users(
+            db, skip, min(limit, constants.QUERY_LIMIT_MAX), cursor, include_total
+        )
         if service_response.status == ServiceResponseStatus.SUCCESS:
             return service_response.data
         else:
@@ -148,6 +156,7 @@ def upload_profile_picture(
             description="Upload an image (JPEG, PNG, BMP, WEBP)",
             openapi_extra={"examples": {"image": {"content": {"image/*": {}}}}},
         ),
+        db: Session = Depends(database.get_db),
         current_user=Depends(oauth2.get_current_user),
 ):
     check_user_id_and_path_parameter(current_user.id, user_id)
@@ -155,7 +164,7 @@ def upload_profile_picture(
         return HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Provide a picture"
         )
-    return user_service.upload_user_profile_picture(picture, current_user.id)
+    return user_service.upload_user_profile_picture(picture, current_user.id, db)
 
 
 @router.get("/{user_id}/profile-picture")
@@ -165,6 +174,14 @@ def get_profile_picture_link(
     return user_service.get_profile_picture_link(user_id, db)
 
 
+# Processing status and renditions of the uploaded profile picture
+@router.get("/{user_id}/profile-picture/status", response_model=PictureDisplay)
+def get_profile_picture_status(
+        user_id: int = Path(...), db: Session = Depends(database.get_db)
+):
+    return user_service.get_profile_picture_status(user_id, db)
+
+
 @router.delete("/{user_id}/profile-picture", status_code=status.HTTP_204_NO_CONTENT)
 def delete_profile_picture(
         user_id: int = Path(...),
@@ -218,17 +235,19 @@ def change_password(
 
 @router.get(
     "/{user_id}/rentals",
-    response_model=Dict[str, Union[Optional[int], Optional[List[RentalDisplay]]]],
+    response_model=Dict[str, Union[Optional[bool], Optional[int], Optional[str], Optional[List[RentalDisplay]]]],
     summary="Get user's rentals",
     description="This endpoint returns the rental of a given user.",
 )
-def get_user_rentals(
+async def get_user_rentals(
         user_id: int = Path(...),
         sort_by: RentalSort = Query(RentalSort.DATE),
         sort_dir: SortDirection = Query(SortDirection.ASC),
         skip: int = Query(0),
         limit: int = Query(constants.QUERY_LIMIT_DEFAULT),
-        db: Session = Depends(database.get_db),
+        cursor: str = Query(None, description="next_cursor of the previous page"),
+        include_total: TotalCountType = Query(TotalCountType.EXACT),
+        db: AsyncSession = Depends(database.get_async_read_db),
         current_user=Depends(oauth2.get_current_user),
 ):
     if not current_user.is_admin() and current_user.id != user_id:
@@ -237,19 +256,21 @@ def get_user_rentals(
             detail="User cannot query other user's rentals.",
         )
 
-    return rental_service.get_rentals(
+    return await rental_service.get_rentals_async(
         db=db,
         current_user=current_user,
         sort_by=sort_by,
         sort_dir=sort_dir,
         skip=skip,
         limit=limit,
+        cursor=cursor,
+        include_total=include_total,
     )
 
 
 @router.get(
     "/{user_id}/reviews",
-    response_model=Dict[str, Union[Optional[int], Optional[List[ReviewDisplay]]]],
+    response_model=Dict[str, Union[Optional[bool], Optional[int], Optional[str], Optional[List[ReviewDisplay]]]],
     summary="Get the reviews about a user",
     description="This endpoint returns the reviews about a user as a renter "
                 "or as a owner of rentals",
@@ -260,9 +281,11 @@ def get_user_reviews(
         sort_dir: SortDirection = Query(SortDirection.ASC),
         skip: int = Query(0),
         limit: int = Query(constants.QUERY_LIMIT_DEFAULT),
-        db: Session = Depends(database.get_db),
+        cursor: str = Query(None, description="next_cursor of the previous page"),
+        include_total: TotalCountType = Query(TotalCountType.EXACT),
+        db: Session = Depends(database.get_read_db),
         current_user=Depends(oauth2.get_current_user),
 ):
     return review_service.get_views_by_user(
-        db, user_id, current_user, sort_by, sort_dir, skip, limit
+        db, user_id, current_user, sort_by, sort_dir, skip, limit, cursor, include_total
     )
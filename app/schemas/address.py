@@ -1,10 +1,9 @@
-from typing import Dict, Optional
+from typing import Optional
 
-from pydantic import BaseModel, model_validator
+from pydantic import BaseModel
 
 from app.models.user import DBUser
-from app.utils.address_translation import AddressValidationError, address_to_lat_lon
-from app.utils.logger import logger
+from app.schemas.enums import GeocodeStatus
 
 
 class AddressBase(BaseModel):
@@ -29,46 +28,13 @@ class AddressDisplay(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
     is_address_confirmed: Optional[bool] = False
+    # Latitude and longitude are set in the background, PENDING until then
+    geocode_status: Optional[GeocodeStatus] = None
 
     class Config:
         from_attributes = True
 
 
-# Function that validates an address and adds latitude/longitude
-def validate_address(values: Dict) -> Dict:
-    street = values.get("street")
-    number = values.get("number")
-    postal_code = values.get("postal_code")
-    city = values.get("city")
-    state = values.get("state")
-    country = values.get("country")
-
-    # Build the address dictionary for geocoding
-    address_dict = {
-        "street": f"{street} {number}" if street and number else None,
-        "postalcode": postal_code,
-        "city": city,
-        "state": state,
-        "country": country,
-    }
-
-    # Remove None values from the dictionary
-    address_dict = {k: v for k, v in address_dict.items() if v}
-
-    if address_dict:
-        try:
-            # Validate address through geocoding
-            lat_lon = address_to_lat_lon(address_dict)
-            logger.info(f"Address geocoded successfully: {lat_lon}")
-            # Add latitude and longitude to the validated data
-            values["latitude"] = lat_lon["latitude"]
-            values["longitude"] = lat_lon["longitude"]
-        except AddressValidationError as e:
-            raise ValueError(f"Address validation failed: {e}")
-
-    return values
-
-
 class AddressForm(BaseModel):
     street: Optional[str] = None
     number: Optional[str] = None
@@ -83,11 +49,6 @@ class AddressForm(BaseModel):
     class Config:
         from_attributes = True
 
-    # Validator to check and validate the address by geocoding
-    @model_validator(mode="before")
-    def validate_address(cls, values):
-        return validate_address(values)
-
 
 class AddressUpdate(BaseModel):
     street: Optional[str] = None
@@ -100,11 +61,6 @@ class AddressUpdate(BaseModel):
     class Config:
         from_attributes = True
 
-    # Validator to check and validate the address by geocoding
-    @model_validator(mode="before")
-    def validate_address(cls, values):
-        return validate_address(values)
-
 
 class AddressDisplayPublic(BaseModel):
     city: Optional[str] = None
@@ -128,6 +84,7 @@ def create_address_private_display(user: DBUser):
         latitude=user.address.latitude,
         longitude=user.address.longitude,
         is_address_confirmed=user.address.is_address_confirmed,
+        geocode_status=user.address.geocode_status or GeocodeStatus.DONE,
     )
 
 
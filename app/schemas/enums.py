@@ -126,3 +126,44 @@ class ReviewSort(str, Enum):
     REVIEW_DATE = "REVIEW_DATE"
 
 
+class TotalCountType(str, Enum):
+    # Total count of the matches (cached for a short time)
+    EXACT = "EXACT"
+
+    # Cheap estimate of the total count (capped, may be approximate)
+    ESTIMATE = "ESTIMATE"
+
+    # Total count is not calculated
+    NONE = "NONE"
+
+
+class GeocodeStatus(str, Enum):
+    # Coordinates of the address are being calculated in the background
+    PENDING = "PENDING"
+
+    # Coordinates are set
+    DONE = "DONE"
+
+    # Address could not be geocoded
+    FAILED = "FAILED"
+
+
+class PictureOwner(str, Enum):
+    CAR = "CAR"
+    USER = "USER"
+
+
+class PictureStatus(str, Enum):
+    # Uploaded, queued or being optimized by the image processing pool
+    PROCESSING = "PROCESSING"
+
+    # Original is optimized and the renditions are created
+    READY = "READY"
+
+    # Picture could not be processed (e.g. not a valid image)
+    FAILED = "FAILED"
+
+
+class RenditionFormat(str, Enum):
+    WEBP = "WEBP"
+    AVIF = "AVIF"
@@ -0,0 +1,14 @@
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+from app.schemas.enums import PictureStatus
+
+
+class PictureDisplay(BaseModel):
+    file_name: str
+    status: PictureStatus
+    url: str
+    # URLs of the resized copies by format and width, available when the status is READY
+    renditions: Dict[str, Dict[int, str]] = {}
+    error: Optional[str] = None
@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from typing import List, Optional
 
 from fastapi import HTTPException, Query
@@ -75,3 +75,45 @@ class RentalPeriod(BaseModel):
             )
 
         return values
+
+
+class AvailabilityPeriod(BaseModel):
+    start_date: date
+    end_date: date
+
+    @model_validator(mode="after")
+    def validate_dates(self):
+        if self.start_date > self.end_date:
+            raise ValueError("Start date must not be later than the end date.")
+        return self
+
+
+class CarAvailabilityRequest(BaseModel):
+    car_ids: List[int] = Field(
+        ..., min_length=1, max_length=constants.AVAILABILITY_MAX_CARS
+    )
+    periods: List[AvailabilityPeriod] = Field(
+        ..., min_length=1, max_length=constants.AVAILABILITY_MAX_PERIODS
+    )
+
+
+class CarAvailabilityDisplay(BaseModel):
+    car_id: int
+    # One value per requested period (same order)
+    available: List[bool]
+    # Merged rental periods of the car that overlap with any of the requested periods
+    busy: List[AvailabilityPeriod]
+
+
+class CarAvailabilityMatrix(BaseModel):
+    periods: List[AvailabilityPeriod]
+    cars: List[CarAvailabilityDisplay]
+
+
+class CarCalendarDisplay(BaseModel):
+    car_id: int
+    from_date: date
+    to_date: date
+    # Busy and free spans cover the whole window, both are sorted and clipped to the window
+    busy: List[AvailabilityPeriod]
+    free: List[AvailabilityPeriod]
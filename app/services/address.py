@@ -8,6 +8,9 @@ from app.schemas.address import (
     AddressUpdate,
     create_address_private_display,
 )
+from app.schemas.enums import GeocodeStatus
+from app.services.geocoding import geocoding_worker
+from app.services.principal import invalidate_principal
 from app.utils.logger import logger
 
 
@@ -22,13 +25,20 @@ def get_address_by_user_id(user_id: int, db: Session):
 
 def update_user_address(user: DBUser, address_update: AddressUpdate, db: Session):
     db_address = db.query(DBAddress).filter(DBAddress.user_id == user.id).first()
+    # The address is saved without coordinates, the geocoding worker sets them in the background
+    pending = {
+        "latitude": None,
+        "longitude": None,
+        "geocode_status": GeocodeStatus.PENDING,
+        "geocode_attempts": 0,
+        "geocode_next_attempt_at": None,
+    }
     if db_address:
-        # Convert AddressUpdate to AddressForm which has latitude and longitude
         update_data = AddressForm(
             **address_update.model_dump(exclude_unset=True)
         ).model_dump(exclude_unset=True)
 
-        for key, value in update_data.items():
+        for key, value in {**update_data, **pending}.items():
             setattr(db_address, key, value)
 
         try:
@@ -44,11 +54,12 @@ def update_user_address(user: DBUser, address_update: AddressUpdate, db: Session
             )
     # If address doesnt exist before create new
     else:
-        # Raises error if it cant generate coordinates
         new_address = AddressForm(**address_update.model_dump(exclude_unset=True))
 
         try:
-            db_new_address = DBAddress(**new_address.model_dump(), user_id=user.id)
+            db_new_address = DBAddress(
+                **{**new_address.model_dump(), **pending}, user_id=user.id
+            )
             db.add(db_new_address)
             db.commit()
             db.flush(db_new_address)
@@ -59,6 +70,8 @@ def update_user_address(user: DBUser, address_update: AddressUpdate, db: Session
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"An error occurred while updating the address: {str(exc)}",
             )
+    invalidate_principal(user.email)
+    geocoding_worker.notify()
     return create_address_private_display(user)
 
 
@@ -68,8 +81,10 @@ def delete_user_address(user_id: int, db: Session):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No address for the user"
         )
+    email = address.user.email
     db.delete(address)
     db.commit()
+    invalidate_principal(email)
     return "deleted"
 
 
@@ -0,0 +1,136 @@
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from itertools import islice
+from typing import List, Optional, Tuple, Union
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from app.models.rental import DBRental
+from app.utils import constants
+from app.utils.cache import TTLCache
+
+
+def to_date(value: Union[date, datetime]) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+def overlap_filter(start_date: Union[date, datetime], end_date: Union[date, datetime]):
+    """
+    Filter for the rentals that overlap with the given period (both ends are inclusive).
+    With the (car_id, start_date, end_date) index it is a range search per car.
+    """
+    return and_(
+        DBRental.start_date <= to_date(end_date),
+        DBRental.end_date >= to_date(start_date),
+    )
+
+
+def merge_periods(periods: List[Tuple[date, date]]) -> List[Tuple[date, date]]:
+    """
+    Merges overlapping and adjacent (next day) periods into continuous busy spans.
+    :param periods: (start_date, end_date) tuples in any order, both ends inclusive
+    :return: Sorted, disjoint (start_date, end_date) tuples
+    """
+    merged = []
+    for start, end in sorted(periods):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class CarIntervals:
+    """
+    Rental periods of a car sorted by start date. Each position also keeps the latest end date of the periods
+    up to that position and the position of the period ending then, so an overlap check is a binary search
+    (O(log n)). The merged busy spans are precomputed for the calendar.
+    """
+
+    def __init__(self, periods: List[Tuple[date, date, int]]):
+        periods = sorted(periods)
+        self.starts = [p[0] for p in periods]
+        self.ends = [p[1] for p in periods]
+        self.rental_ids = [p[2] for p in periods]
+        self.max_ends = []
+        # Position of the period with the latest end date up to each position
+        self.max_end_positions = []
+        for position, end in enumerate(self.ends):
+            if not self.max_ends or end > self.max_ends[-1]:
+                self.max_ends.append(end)
+                self.max_end_positions.append(position)
+            else:
+                self.max_ends.append(self.max_ends[-1])
+                self.max_end_positions.append(self.max_end_positions[-1])
+        self.busy_spans = merge_periods(list(zip(self.starts, self.ends)))
+
+    def overlapping(self, start_date: date, end_date: date) -> Optional[int]:
+        """
+        :return: id of a rental overlapping with the given period, None if the car is available
+        """
+        # Periods starting on or before end_date are the first i periods, the one of them ending last
+        # overlaps if any of them does
+        i = bisect_right(self.starts, end_date)
+        if i == 0 or self.max_ends[i - 1] < start_date:
+            return None
+        return self.rental_ids[self.max_end_positions[i - 1]]
+
+    def periods(self) -> List[Tuple[date, date, int]]:
+        return list(zip(self.starts, self.ends, self.rental_ids))
+
+
+def split_calendar(
+    busy_spans: List[Tuple[date, date]], window_start: date, window_end: date
+) -> Tuple[List[Tuple[date, date]], List[Tuple[date, date]]]:
+    """
+    Splits a calendar window into busy and free spans.
+    :param busy_spans: Sorted, disjoint busy spans (see merge_periods)
+    :param window_start: First day of the window
+    :param window_end: Last day of the window
+    :return: (busy spans, free spans) clipped to the window, together they cover the whole window
+    """
+    busy, free = [], []
+    next_free_day = window_start
+    # Only the span just before the first one starting after window_start can cover it
+    i = max(bisect_right(busy_spans, (window_start, date.max)) - 1, 0)
+    for start, end in islice(busy_spans, i, None):
+        if start > window_end:
+            break
+        if end < window_start:
+            continue
+        start, end = max(start, window_start), min(end, window_end)
+        if start > next_free_day:
+            free.append((next_free_day, start - timedelta(days=1)))
+        busy.append((start, end))
+        next_free_day = end + timedelta(days=1)
+    if next_free_day <= window_end:
+        free.append((next_free_day, window_end))
+    return busy, free
+
+
+# Rental periods per car_id. Entries are dropped by the rental service when a rental of the car changes.
+# Other app workers do not see those changes, so entries also expire after a short time.
+availability_index = TTLCache(
+    maxsize=constants.AVAILABILITY_INDEX_SIZE,
+    ttl=constants.AVAILABILITY_INDEX_TTL_SECONDS,
+)
+
+
+def get_car_intervals(car_id: int, db: Session) -> CarIntervals:
+    intervals = availability_index.get(car_id)
+    if intervals is None:
+        # Rentals ending in the past can not overlap with a new rental (rentals must be in the future)
+        periods = (
+            db.query(DBRental.start_date, DBRental.end_date, DBRental.id)
+            .filter(DBRental.car_id == car_id, DBRental.end_date >= date.today())
+            .all()
+        )
+        intervals = CarIntervals([tuple(p) for p in periods])
+        availability_index.set(car_id, intervals)
+    return intervals
+
+
+def invalidate_car(car_id: int) -> None:
+    availability_index.delete(car_id)
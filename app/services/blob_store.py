@@ -0,0 +1,134 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, List, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.models.picture import DBBlob
+from app.utils import constants
+
+STATIC_PATH = Path(__file__).resolve().parents[1] / "static"
+BLOBS_PATH = STATIC_PATH / constants.BLOBS_PATH
+
+
+def blob_path(digest: str, extension: str) -> Path:
+    """
+    Path of a blob file, sharded by the first two byte pairs of the digest (e.g. ab/cd/abcd...e.jpg),
+    so that no directory gets too many files.
+    """
+    return BLOBS_PATH / digest[:2] / digest[2:4] / f"{digest}{extension}"
+
+
+def rendition_path(file_path: Path, width: int, image_format: str) -> Path:
+    return (
+        file_path.parent
+        / constants.RENDITIONS_DIR
+        / f"{file_path.stem}_{width}.{image_format.lower()}"
+    )
+
+
+def static_url(path: Path) -> str:
+    return "/static/" + path.relative_to(STATIC_PATH).as_posix()
+
+
+def file_extension(file_name: str, content_type: str) -> str:
+    extension = Path(file_name or "").suffix.lower()
+    if not extension:
+        extension = mimetypes.guess_extension(content_type or "") or ""
+    return extension
+
+
+def write_temp_file(source: BinaryIO) -> Tuple[Path, str, int]:
+    """
+    Copies an upload into a temporary file of the blob store while hashing it.
+    :return: (path of the temporary file, SHA-256 hex digest, size in bytes)
+    """
+    temp_dir = BLOBS_PATH / "tmp"
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=temp_dir, delete=False) as temp_file:
+        while chunk := source.read(constants.UPLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+            temp_file.write(chunk)
+            size += len(chunk)
+    return Path(temp_file.name), sha256.hexdigest(), size
+
+
+def acquire_blob(
+    db: Session, temp_path: Path, digest: str, extension: str, content_type: str
+) -> Tuple[DBBlob, bool]:
+    """
+    Adds a reference to the blob with the given digest. A new blob is created from the temporary file,
+    otherwise the temporary file is dropped. It has to be the first change of the transaction (it is
+    rolled back if another request creates the same blob at the same time), the caller commits.
+    :return: (blob, True if the blob is new and has to be processed)
+    """
+    blob = db.get(DBBlob, digest)
+    if blob is None:
+        path = blob_path(digest, extension)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        blob = DBBlob(
+            digest=digest,
+            extension=extension,
+            content_type=content_type,
+            size=temp_path.stat().st_size,
+            ref_count=1,
+            started_at=datetime.utcnow(),
+        )
+        db.add(blob)
+        try:
+            db.flush()
+            os.replace(temp_path, path)
+            return blob, True
+        except IntegrityError:
+            # Same content uploaded at the same time by another request
+            db.rollback()
+            blob = db.get(DBBlob, digest)
+    temp_path.unlink(missing_ok=True)
+    db.execute(
+        update(DBBlob)
+        .where(DBBlob.digest == digest)
+        .values(ref_count=DBBlob.ref_count + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.refresh(blob)
+    return blob, False
+
+
+def release_blob(db: Session, digest: str) -> List[Path]:
+    """
+    Removes a reference to a blob. The row of an unreferenced blob is deleted. The caller commits and then
+    deletes the returned files.
+    :return: Files of the blob to delete (empty if the blob is still referenced)
+    """
+    db.execute(
+        update(DBBlob)
+        .where(DBBlob.digest == digest)
+        .values(ref_count=DBBlob.ref_count - 1)
+        .execution_options(synchronize_session=False)
+    )
+    blob = db.get(DBBlob, digest, populate_existing=True)
+    if blob is None or blob.ref_count > 0:
+        return []
+    path = blob_path(blob.digest, blob.extension)
+    files = [path] + [
+        rendition_path(path, int(width), rendition_format)
+        for width in (blob.renditions or "").split(",")
+        if width
+        for rendition_format in (blob.rendition_formats or "").split(",")
+        if rendition_format
+    ]
+    db.delete(blob)
+    return files
+
+
+def delete_files(files: List[Path]) -> None:
+    for file in files:
+        file.unlink(missing_ok=True)
@@ -1,30 +1,82 @@
-import shutil
-import uuid
-from pathlib import Path
+import math
 from sqlite3 import IntegrityError
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, NamedTuple, Optional, Union
 
 from fastapi import HTTPException, UploadFile, status
-from PIL import Image
-from sqlalchemy import and_, case, func, literal_column, or_, select
+from sqlalchemy import Select, and_, case, exists, func, literal_column, select
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
 
-from app.models.address import DBAddress
+from app.core.database import SQLITE_MATH_FUNCTIONS, postgres_extensions
+from app.models.address import DBAddress, address_rtree
 from app.models.car import DBCar
 from app.models.rental import DBRental
 from app.models.review import DBReview
 from app.models.user import DBUser
+from app.models.user_rating_stats import DBUserRatingStats
 from app.schemas.car import CarCreate, CarUpdate
+from app.services.availability import overlap_filter
+from app.services.image_processing import (
+    add_picture,
+    best_rendition_url,
+    delete_pictures,
+    get_picture,
+    get_pictures,
+    image_processor,
+    picture_display,
+    picture_url,
+)
 from app.schemas.enums import (
     CarEngineType,
     CarSearchSortType,
     CarTransmissionType,
+    PictureOwner,
     SortDirection,
+    TotalCountType,
 )
 from app.schemas.rental import RentalPeriod
-from app.utils.constants import CAR_IMAGES_PATH
+from app.utils.geo import EARTH_RADIUS_KM, bounding_box
 from app.utils.logger import logger
+from app.utils.pagination import (
+    TotalCounts,
+    decode_cursor,
+    encode_cursor,
+    get_total_counts,
+    get_total_counts_async,
+    keyset_filter,
+)
+
+
+class CarSearch(NamedTuple):
+    """
+    Statements of a car search, executed by search_cars or search_cars_async.
+    """
+
+    # Page of the matching cars (offset or keyset filter and limit applied)
+    query: Select
+    # Arguments of get_total_counts after the session
+    count_args: tuple
+    # Name of the sort column in the result rows (None if sorted by car id only)
+    sort_key: Optional[str]
+
+
+def car_display_loaders() -> list:
+    """
+    Loader options of the relationships shown by CarDisplay. An AsyncSession cannot load them lazily
+    during serialization. Many-to-one relationships are joined, collections are loaded by one more query
+    each. Created on use, since creating the options configures the mappers.
+    """
+    return [
+        joinedload(DBCar.owner).joinedload(DBUser.address),
+        selectinload(DBCar.rentals)
+        .selectinload(DBRental.reviews)
+        .options(
+            joinedload(DBReview.reviewer).joinedload(DBUser.address),
+            joinedload(DBReview.reviewee).joinedload(DBUser.address),
+        ),
+    ]
+
 
 # Database Operations
 
@@ -87,6 +139,18 @@ def get_car(db: Session, car_id: int) -> Optional[DBCar]:
     return car
 
 
+async def get_car_async(db: AsyncSession, car_id: int) -> DBCar:
+    """
+    Async version of get_car, the relationships of CarDisplay are loaded with the car.
+    """
+    car = await db.scalar(
+        select(DBCar).where(DBCar.id == car_id).options(*car_display_loaders())
+    )
+    if not car:
+        raise HTTPException(status_code=404, detail="Car not found")
+    return car
+
+
 def get_cars(db: Session) -> List[DBCar]:
     # return db.query(DBCar).offset(skip).limit(limit).all()
     return db.query(DBCar).all()
@@ -141,6 +205,8 @@ def delete_car(db: Session, car_id: int) -> Optional[DBCar]:
     if db_car:
         db.delete(db_car)
         db.commit()
+        # Releases the picture files (deleted if no other car or user uses them)
+        delete_pictures(db, PictureOwner.CAR, car_id)
     return db_car
 
 
@@ -167,7 +233,9 @@ def search_cars(
     skip: int,
     limit: int,
     db: Session,
-) -> Dict[str, Union[Optional[int], List[DBCar]]]:
+    cursor: Optional[str] = None,
+    include_total: TotalCountType = TotalCountType.EXACT,
+) -> Dict[str, Union[Optional[int], Optional[str], List[DBCar]]]:
     """
     :param distance_km: Distance from the renter or the city (if city is specified renter location is ignored)
     :param renter_lat: Latitude of the renter in degrees
@@ -184,15 +252,116 @@ def search_cars(
     :param skip: Offset for pagination
     :param limit: Maximum length of the resulting list
     :param db: App session
+    :param cursor: Cursor for keyset pagination (next_cursor of the previous page). If given, skip is ignored
+    :param include_total: EXACT (cached for a short time), ESTIMATE (capped, cheap) or NONE (no counting)
     :return: A dictionary of:
         {
-            "current_offset": Value of parameter skip (int),
+            "current_offset": Value of parameter skip (int, None if cursor is given),
             "counts": Length of the resulting DBCar list (int)
-            "total_counts": Total number of matches ignoring the limit value,
+            "total_counts": Total number of matches ignoring the limit value (None if include_total is NONE),
+            "total_counts_is_estimate": True if total_counts is an estimate (include_total is ESTIMATE),
+            "total_counts_is_capped": True if the estimate stopped counting, there are more matches,
             "next_offset": Starting index of the following request in pagination (None if no more records exist),
+            "next_cursor": Cursor of the following request in pagination (None if no more records exist),
             "cars": List of matching DBCar objects
         }
     """
+    search = car_search_statements(
+        distance_km=distance_km,
+        renter_lat=renter_lat,
+        renter_lon=renter_lon,
+        availability_period=availability_period,
+        search_in_city=search_in_city,
+        engine_type=engine_type,
+        transmission_type=transmission_type,
+        price_min=price_min,
+        price_max=price_max,
+        make=make,
+        sort=sort,
+        sort_direction=sort_direction,
+        skip=skip,
+        limit=limit,
+        db=db,
+        cursor=cursor,
+        include_total=include_total,
+    )
+    total_counts = get_total_counts(db, *search.count_args)
+    cars = db.execute(search.query).mappings().all()
+    return car_search_page(search, cars, total_counts, skip, limit, cursor)
+
+
+async def search_cars_async(
+    distance_km: float,
+    renter_lat: float,
+    renter_lon: float,
+    availability_period: RentalPeriod,
+    search_in_city: str,
+    engine_type: CarEngineType,
+    transmission_type: CarTransmissionType,
+    price_min: int,
+    price_max: int,
+    make: str,
+    sort: CarSearchSortType,
+    sort_direction: SortDirection,
+    skip: int,
+    limit: int,
+    db: AsyncSession,
+    cursor: Optional[str] = None,
+    include_total: TotalCountType = TotalCountType.EXACT,
+) -> Dict[str, Union[Optional[int], Optional[str], List[DBCar]]]:
+    """
+    Async version of search_cars (same parameters and result) for an AsyncSession.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        # The installed extensions (used by distance_field) are read once through the session's connection
+        await db.run_sync(lambda session: postgres_extensions(session.get_bind()))
+    search = car_search_statements(
+        distance_km=distance_km,
+        renter_lat=renter_lat,
+        renter_lon=renter_lon,
+        availability_period=availability_period,
+        search_in_city=search_in_city,
+        engine_type=engine_type,
+        transmission_type=transmission_type,
+        price_min=price_min,
+        price_max=price_max,
+        make=make,
+        sort=sort,
+        sort_direction=sort_direction,
+        skip=skip,
+        limit=limit,
+        db=db,
+        cursor=cursor,
+        include_total=include_total,
+    )
+    total_counts = await get_total_counts_async(db, *search.count_args)
+    cars = (await db.execute(search.query)).mappings().all()
+    return car_search_page(search, cars, total_counts, skip, limit, cursor)
+
+
+def car_search_statements(
+    distance_km: float,
+    renter_lat: float,
+    renter_lon: float,
+    availability_period: RentalPeriod,
+    search_in_city: str,
+    engine_type: CarEngineType,
+    transmission_type: CarTransmissionType,
+    price_min: int,
+    price_max: int,
+    make: str,
+    sort: CarSearchSortType,
+    sort_direction: SortDirection,
+    skip: int,
+    limit: int,
+    db: Union[Session, AsyncSession],
+    cursor: Optional[str] = None,
+    include_total: TotalCountType = TotalCountType.EXACT,
+) -> CarSearch:
+    """
+    Builds the statements of a car search (see search_cars for the parameters), shared by the sync and
+    the async version. Only the dialect of the session is used, no query is executed.
+    """
     # Following lines are commented so that if a user does not provide any search criteria this function returns
     # all cars without any filtering
     # if (
@@ -218,66 +387,52 @@ def search_cars(
     if distance_km and search_in_city:
         distance_km = None
 
-    sort_by = None
+    # Sort column, its name in the result rows and its type (used for the pagination cursor)
+    sort_column, sort_key, sort_type = None, None, None
     if sort:
-        if not sort_direction:
-            sort_direction = SortDirection.ASC
         # Ignore the sort request if it is "DISTANCE" and a distance value is not provided
         if distance_km and sort == CarSearchSortType.DISTANCE:
-            sort_by = (
-                literal_column("distance").asc()
-                if sort_direction == SortDirection.ASC
-                else literal_column("distance").desc()
+            sort_column, sort_key, sort_type = (
+                literal_column("distance"),
+                "distance",
+                float,
             )
         elif sort == CarSearchSortType.ENGINE_TYPE:
-            sort_by = (
-                DBCar.motor_type.asc()
-                if sort_direction == SortDirection.ASC
-                else DBCar.motor_type.desc()
-            )
+            sort_column, sort_key, sort_type = DBCar.motor_type, "motor_type", str
         elif sort == CarSearchSortType.TRANSMISSION_TYPE:
-            sort_by = (
-                DBCar.transmission_type.asc()
-                if sort_direction == SortDirection.ASC
-                else DBCar.transmission_type.desc()
+            sort_column, sort_key, sort_type = (
+                DBCar.transmission_type,
+                "transmission_type",
+                str,
             )
         elif sort == CarSearchSortType.MAKE:
-            sort_by = (
-                DBCar.make.asc()
-                if sort_direction == SortDirection.ASC
-                else DBCar.make.desc()
-            )
+            sort_column, sort_key, sort_type = DBCar.make, "make", str
         elif sort == CarSearchSortType.PRICE:
-            sort_by = (
-                DBCar.price_per_day.asc()
-                if sort_direction == SortDirection.ASC
-                else DBCar.price_per_day.desc()
+            sort_column, sort_key, sort_type = (
+                DBCar.price_per_day,
+                "price_per_day",
+                float,
             )
+    if not sort_direction:
+        sort_direction = SortDirection.ASC
+
+    # Car id is the tiebreaker, so that the order (and the cursor) is deterministic
+    if sort_direction == SortDirection.ASC:
+        sort_by = [DBCar.id.asc()]
+        if sort_column is not None:
+            sort_by.insert(0, sort_column.asc())
+    else:
+        sort_by = [DBCar.id.desc()]
+        if sort_column is not None:
+            sort_by.insert(0, sort_column.desc())
 
-    # This subquery is used to add (join) user ratings to the response
-    rating_sub_query = (
-        select(
-            DBReview.reviewee_id,
-            func.sum(DBReview.rating).label("total_rating"),
-            func.count(DBReview.reviewee_id).label("total_count"),
-        )
-        .group_by(DBReview.reviewee_id)
-        .alias("sub_query")
-    )
-
+    # Ratings of the owners are joined from the precomputed stats (maintained by the review service)
     selected_attrs = [
         DBUser.id.label("owner_id"),
         DBUser.name.label("owner_name"),
         DBUser.last_name.label("owner_last_name"),
-        rating_sub_query.c.total_count.label("review count"),
-        case(
-            (rating_sub_query.c.total_count == 0, 0),
-            else_=(
-                func.round(
-                    rating_sub_query.c.total_rating / rating_sub_query.c.total_count, 2
-                )
-            ),
-        ).label("rating"),
+        DBUserRatingStats.rating_count.label("review count"),
+        DBUserRatingStats.rating_average.label("rating"),
         DBAddress.city,
         DBAddress.postal_code,
         DBAddress.latitude,
@@ -300,20 +455,15 @@ def search_cars(
     # Query for distance calculation. The resulting value will appear as "distance" in query result.
     position_field = None
     if renter_lat and renter_lon:
-        position_field = (
-            6371.0
-            * func.acos(
-                func.cos(func.radians(renter_lat))
-                * func.cos(func.radians(DBAddress.latitude))
-                * func.cos(func.radians(DBAddress.longitude) - func.radians(renter_lon))
-                + func.sin(func.radians(renter_lat))
-                * func.sin(func.radians(DBAddress.latitude))
-            )
-        ).label("distance")
+        position_field = distance_field(renter_lat, renter_lon, db).label("distance")
         selected_attrs.append(position_field)
         where_clause.append(DBUser.id == DBAddress.user_id)
     if distance_km:
-        where_clause.append(literal_column("distance") < distance_km)
+        # Bounding box prefilter (uses the spatial index) before the exact distance check
+        where_clause.extend(distance_prefilter(renter_lat, renter_lon, distance_km, db))
+        # The expression, not the "distance" label: only SQLite resolves labels of the select in WHERE
+        distance_check = position_field.element < distance_km
+        where_clause.append(distance_check)
     if search_in_city:
         where_clause.append(DBUser.id == DBAddress.user_id)
         where_clause.append(DBAddress.city == search_in_city)
@@ -329,73 +479,182 @@ def search_cars(
         where_clause.append(DBCar.make == make)
 
     if availability_period.start_date:
+        # Cars without an overlapping rental (range search on the (car_id, start_date, end_date) index)
         where_clause.append(
-            and_(
-                DBUser.id == DBCar.owner_id,
-                DBUser.id == DBAddress.user_id,
-                DBCar.id.notin_(
-                    select(DBRental.car_id).where(
-                        and_(
-                            DBRental.car_id == DBCar.id,
-                            or_(
-                                and_(
-                                    availability_period.start_date
-                                    >= DBRental.start_date,
-                                    availability_period.start_date <= DBRental.end_date,
-                                ),
-                                and_(
-                                    availability_period.end_date >= DBRental.start_date,
-                                    availability_period.end_date <= DBRental.end_date,
-                                ),
-                            ),
-                        )
-                    )
+            ~exists().where(
+                DBRental.car_id == DBCar.id,
+                overlap_filter(
+                    availability_period.start_date, availability_period.end_date
                 ),
             )
         )
 
-    # Query for counting the matches without applying the limit value. If search is based on distance,
-    # the query for distance calculation must also be included in this query (since "distance" is literal value).
+    # Counting the matches without applying the limit value. If search is based on distance, the distance
+    # calculation must also be included in the statement (since "distance" is literal value).
     if distance_km:
-        total_counts = (
-            db.execute(
-                select(
-                    position_field, func.count(DBCar.id).label("total_counts")
-                ).where(and_(*where_clause))
-            )
-            .mappings()
-            .first()
+        count_statement = select(DBCar.id, position_field).where(and_(*where_clause))
+        # The estimate skips the exact distance check: matches in the bounding box are scaled by
+        # the area ratio of the circle to the box
+        estimate_statement = select(DBCar.id).where(
+            and_(*[c for c in where_clause if c is not distance_check])
         )
+        estimate_scale = math.pi / 4
     else:
-        total_counts = (
-            db.execute(
-                select(func.count().label("total_counts")).where(and_(*where_clause))
+        count_statement = select(DBCar.id).where(and_(*where_clause))
+        estimate_statement, estimate_scale = None, 1.0
+    query = (
+        select(*selected_attrs)
+        .where(and_(*where_clause))
+        .outerjoin(DBUserRatingStats, DBUserRatingStats.user_id == DBUser.id)
+        .order_by(*sort_by)
+    )
+    if cursor:
+        # Keyset pagination: continue after the last car of the previous page
+        last_value, last_id = decode_cursor(cursor, sort_type)
+        query = query.where(
+            keyset_filter(
+                position_field.element if sort_key == "distance" else sort_column,
+                DBCar.id,
+                last_value,
+                last_id,
+                sort_direction != SortDirection.ASC,
             )
-            .mappings()
-            .first()
-        )
-    cars = (
-        db.execute(
-            select(*selected_attrs)
-            .where(and_(*where_clause))
-            .outerjoin(rating_sub_query, rating_sub_query.c.reviewee_id == DBUser.id)
-            .order_by(sort_by)
-            .offset(skip)
-            .limit(limit)
         )
-        .mappings()
-        .all()
+    else:
+        query = query.offset(skip)
+    return CarSearch(
+        query=query.limit(limit),
+        count_args=(
+            include_total,
+            (
+                "cars",
+                distance_km,
+                renter_lat if distance_km else None,
+                renter_lon if distance_km else None,
+                availability_period.start_date,
+                availability_period.end_date,
+                search_in_city,
+                engine_type,
+                transmission_type,
+                price_min,
+                price_max,
+                make,
+            ),
+            count_statement,
+            estimate_statement,
+            estimate_scale,
+        ),
+        sort_key=sort_key,
     )
+
+
+def car_search_page(
+    search: CarSearch,
+    cars: list,
+    total_counts: TotalCounts,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+) -> Dict[str, Union[Optional[int], Optional[str], List[DBCar]]]:
+    """
+    Creates the result of search_cars from the rows of the page (see search_cars for the keys).
+    """
+    sort_key = search.sort_key
+    has_next = len(cars) == limit
     result = {
-        "current_offset": skip,
+        "current_offset": None if cursor else skip,
         "counts": len(cars),
-        "total_counts": total_counts["total_counts"],
-        "next_offset": (skip + limit) if len(cars) == limit else None,
+        **total_counts.fields(),
+        "next_offset": (skip + limit) if has_next and not cursor else None,
+        "next_cursor": (
+            encode_cursor(cars[-1][sort_key] if sort_key else None, cars[-1]["car_id"])
+            if has_next
+            else None
+        ),
         "cars": cars,
     }
     return result
 
 
+def distance_field(lat: float, lon: float, db: Session):
+    """
+    Creates the expression of the great-circle distance (in km) between the given point and the addresses.
+    On SQLite the built-in math functions are used if they are available, otherwise a single haversine_km
+    function (registered on every connection in core.database) is called per row. On PostgreSQL the
+    distance functions of PostGIS or earthdistance are used when one of the extensions is installed,
+    otherwise the same formula runs on the native math functions.
+    :param lat: Latitude of the point in degrees
+    :param lon: Longitude of the point in degrees
+    :param db: App session
+    :return: Distance expression
+    """
+    bind = db.get_bind()
+    least, greatest = func.min, func.max
+    if bind.dialect.name == "sqlite":
+        if not SQLITE_MATH_FUNCTIONS:
+            return func.haversine_km(lat, lon, DBAddress.latitude, DBAddress.longitude)
+    elif bind.dialect.name == "postgresql":
+        extensions = postgres_extensions(bind)
+        if "postgis" in extensions:
+            return (
+                func.ST_DistanceSphere(
+                    func.ST_MakePoint(lon, lat),
+                    func.ST_MakePoint(DBAddress.longitude, DBAddress.latitude),
+                )
+                / 1000.0
+            )
+        if "earthdistance" in extensions:
+            return (
+                func.earth_distance(
+                    func.ll_to_earth(lat, lon),
+                    func.ll_to_earth(DBAddress.latitude, DBAddress.longitude),
+                )
+                / 1000.0
+            )
+        # min and max are aggregates on PostgreSQL
+        least, greatest = func.least, func.greatest
+    # The cosine is clamped to [-1, 1] since rounding errors make acos return NULL for identical points
+    return EARTH_RADIUS_KM * func.acos(
+        least(
+            1.0,
+            greatest(
+                -1.0,
+                func.cos(func.radians(lat))
+                * func.cos(func.radians(DBAddress.latitude))
+                * func.cos(func.radians(DBAddress.longitude) - func.radians(lon))
+                + func.sin(func.radians(lat))
+                * func.sin(func.radians(DBAddress.latitude)),
+            ),
+        )
+    )
+
+
+def distance_prefilter(lat: float, lon: float, distance_km: float, db: Session):
+    """
+    Creates the filters that limit the addresses to the bounding box of the search circle. On SQLite the
+    R*Tree index (addresses_rtree) is joined so that the search starts from the addresses in the box. On other
+    databases the filters fall back to the coordinate columns.
+    :param lat: Latitude of the center in degrees
+    :param lon: Longitude of the center in degrees
+    :param distance_km: Radius of the search in kilometers
+    :param db: App session
+    :return: A list of filter expressions
+    """
+    box = bounding_box(lat, lon, distance_km)
+    if db.get_bind().dialect.name == "sqlite":
+        return [
+            address_rtree.c.id == DBAddress.id,
+            address_rtree.c.max_lat >= box["min_lat"],
+            address_rtree.c.min_lat <= box["max_lat"],
+            address_rtree.c.max_lon >= box["min_lon"],
+            address_rtree.c.min_lon <= box["max_lon"],
+        ]
+    return [
+        DBAddress.latitude.between(box["min_lat"], box["max_lat"]),
+        DBAddress.longitude.between(box["min_lon"], box["max_lon"]),
+    ]
+
+
 def test_rating(db: Session):
     sub_query = (
         select(
@@ -433,22 +692,23 @@ def test_rating(db: Session):
 ALLOWED_TYPES = {"image/jpeg", "image/png", "image/bmp", "image/webp"}
 
 
-def upload_car_picture(picture: UploadFile, car_id: int) -> dict:
+def upload_car_picture(picture: UploadFile, car_id: int, db: Session) -> dict:
     """
-    Upload and save a picture for a specific car.
+    Upload and save a picture for a specific car. The picture is stored once per content (identical
+    uploads share the file) and optimized in the background, its status can be followed with
+    get_car_picture_status.
 
     Args:
         picture (UploadFile): The uploaded picture file.
         car_id (int): The ID of the car to associate the picture with.
+        db (Session): The database session.
 
     Returns:
-        dict: A dictionary containing the saved file's name and content type.
+        dict: A dictionary containing the saved file's name, content type and processing status.
 
     Raises:
-        HTTPException: If the uploaded file type is not allowed.
+        HTTPException: If the uploaded file type is not allowed or the image processing queue is full.
     """
-    pictures_path = get_car_pictures_path(car_id)
-
     # Validate file type
     if picture.content_type not in ALLOWED_TYPES:
         allowed_str = ", ".join(t.split("/")[-1].upper() for t in ALLOWED_TYPES)
@@ -457,95 +717,99 @@ def upload_car_picture(picture: UploadFile, car_id: int) -> dict:
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Invalid file type. Only {allowed_str} types are allowed.",
         )
-
-    # Generate a unique filename and save the image
-    unique_filename = f"{uuid.uuid4()}{Path(picture.filename).suffix}"
-    new_file_path = pictures_path / unique_filename
+    image_processor.admit()
 
     try:
-        with new_file_path.open("wb") as buffer:
-            shutil.copyfileobj(picture.file, buffer)
-        logger.info(f"Picture uploaded for car_id {car_id}: {unique_filename}")
+        db_picture = add_picture(
+            db,
+            PictureOwner.CAR,
+            car_id,
+            picture.file,
+            picture.filename,
+            picture.content_type,
+        )
+        logger.info(f"Picture uploaded for car_id {car_id}: {db_picture.file_name}")
     except Exception as e:
         logger.error(f"Error saving picture for car_id {car_id}: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
 
-    # Optimizing the image
-    optimize_image(new_file_path)
-
     return {
-        "file-name": new_file_path.name,
+        "file-name": db_picture.file_name,
         "file-type": picture.content_type,
+        "status": db_picture.blob.status,
     }
 
 
-def get_car_pictures_path(car_id: int) -> Path:
+def get_car_picture_status(db: Session, car_id: int, filename: str) -> dict:
     """
-    Get the path to the directory where pictures for a specific car are stored.
+    Get the processing status and the rendition URLs of a car picture.
 
     Args:
+        db (Session): The database session.
         car_id (int): The ID of the car.
+        filename (str): The name of the picture file.
 
     Returns:
-        Path: The path to the car's picture directory.
-    """
-    current_dir = Path(__file__).resolve().parent
-    pictures_path = current_dir.parent / "static" / CAR_IMAGES_PATH / f"car_{car_id:06}"
+        dict: File name, status, URL of the picture and URLs of the renditions by format and width.
 
-    # Ensuring the directory exists
-    try:
-        pictures_path.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Created directory for car_id {car_id}: {pictures_path}")
-    except OSError as e:
-        logger.error(f"Error creating directory for car_id {car_id}: {str(e)}")
+    Raises:
+        HTTPException: If the picture is not found.
+    """
+    db_picture = get_picture(db, PictureOwner.CAR, car_id, filename)
+    if db_picture is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error creating directory: {e}",
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Picture {filename} not found for car_id {car_id}",
         )
-
-    return pictures_path
+    return picture_display(db_picture)
 
 
-def get_car_pictures(car_id: int) -> List[str]:
+def get_car_pictures(
+    db: Session,
+    car_id: int,
+    width: Optional[int] = None,
+    image_formats: Optional[List[str]] = None,
+) -> List[str]:
     """
-    Get a list of all picture filenames for a specific car.
+    Get the URLs of the pictures of a car.
 
     Args:
+        db (Session): The database session.
         car_id (int): The ID of the car.
+        width (int, optional): Width the pictures are displayed at. If given, the URL of the best
+            fitting rendition is returned for each picture.
+        image_formats (List[str], optional): Rendition formats the client accepts, best first.
 
     Returns:
-        List[str]: A list of filenames of pictures associated with the car.
+        List[str]: URLs of the pictures in upload order. With a width, the URL of the smallest rendition
+            at least `width` wide, or of the original picture if it has no rendition in an accepted format.
     """
-    pictures_path = get_car_pictures_path(car_id)
+    pictures = get_pictures(db, PictureOwner.CAR, car_id)
+    if width:
+        return [
+            best_rendition_url(picture, width, image_formats or [])
+            for picture in pictures
+        ]
+    return [picture_url(picture) for picture in pictures]
 
-    if not pictures_path.exists():
-        logger.info(f"No pictures found for car_id {car_id}")
-        return []
 
-    # Return file names that are regular files
-    logger.info(f"Listing pictures for car_id {car_id}")
-    return [f.name for f in pictures_path.iterdir() if f.is_file()]
-
-
-def delete_car_picture(car_id: int, filename: str) -> bool:
+def delete_car_picture(car_id: int, filename: str, db: Session) -> bool:
     """
-    Delete a specific picture for a car.
+    Delete a specific picture for a car. The file and its renditions are deleted with the last
+    picture using them.
 
     Args:
         car_id (int): The ID of the car.
         filename (str): The name of the file to delete.
+        db (Session): The database session.
 
     Returns:
-        bool: True if the file was successfully deleted, False otherwise.
+        bool: True if the picture was successfully deleted, False if it was not found.
     """
-    pictures_path = get_car_pictures_path(car_id)
-    file_path = pictures_path / filename
-
     try:
-        if file_path.exists():
-            file_path.unlink()
+        if delete_pictures(db, PictureOwner.CAR, car_id, filename):
             logger.info(f"Deleted picture for car_id {car_id}: {filename}")
             return True
         logger.warning(f"File not found for car_id {car_id}: {filename}")
@@ -561,39 +825,16 @@ def delete_car_picture(car_id: int, filename: str) -> bool:
     return False
 
 
-def optimize_image(file_path: Path, max_size: int = 1024, quality: int = 85) -> None:
-    """
-    Optimize an image by resizing and compressing it.
-
-    Args:
-        file_path (Path): The path to the image file.
-        max_size (int, optional): The maximum width or height of the image. Defaults to 1024.
-        quality (int, optional): The quality of the compressed image (0-100). Defaults to 85.
-    """
-    try:
-        with Image.open(file_path) as img:
-            img.thumbnail((max_size, max_size))
-            img.save(file_path, optimize=True, quality=quality)
-        logger.info(f"Optimized image at {file_path}")
-    except Exception as e:
-        logger.error(f"Error optimizing image at {file_path}: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error optimizing image: {e}",
-        )
-
-
-def delete_all_car_pictures(car_id: int) -> None:
+def delete_all_car_pictures(car_id: int, db: Session) -> None:
     """
     Delete all pictures associated with a specific car.
 
     Args:
         car_id (int): The ID of the car.
+        db (Session): The database session.
     """
-    pictures_path = get_car_pictures_path(car_id)
-
     try:
-        shutil.rmtree(pictures_path, ignore_errors=True)
+        delete_pictures(db, PictureOwner.CAR, car_id)
         logger.info(f"Deleted all pictures for car_id {car_id}")
     except Exception as e:
         logger.error(f"Error deleting all pictures for car_id {car_id}: {str(e)}")
@@ -0,0 +1,210 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import or_, select, update
+
+from app.core.database import SessionLocal
+from app.models.address import DBAddress
+from app.models.user import DBUser
+from app.schemas.enums import GeocodeStatus
+from app.services.principal import invalidate_principal
+from app.utils import constants
+from app.utils.address_translation import (
+    AddressValidationError,
+    GeocodingUnavailableError,
+    address_to_lat_lon,
+)
+from app.utils.logger import logger
+from app.utils.pagination import total_counts_cache
+
+
+def geocoding_query(address: DBAddress) -> Dict:
+    """
+    Address dictionary for the geocoders, empty values are left out.
+    """
+    query = {
+        "street": f"{address.street} {address.number}"
+        if address.street and address.number
+        else None,
+        "postalcode": address.postal_code,
+        "city": address.city,
+        "state": address.state,
+        "country": address.country,
+    }
+    return {key: value for key, value in query.items() if value}
+
+
+def geocode(query: Dict) -> Tuple[GeocodeStatus, Optional[Dict]]:
+    """
+    :return: (DONE, coordinates), (FAILED, None) if the address does not exist or
+        (PENDING, None) if it can be retried
+    """
+    if not query:
+        return GeocodeStatus.FAILED, None
+    try:
+        return GeocodeStatus.DONE, address_to_lat_lon(query)
+    except GeocodingUnavailableError:
+        return GeocodeStatus.PENDING, None
+    except AddressValidationError as exc:
+        logger.warning(f"Address could not be geocoded: {exc}")
+        return GeocodeStatus.FAILED, None
+    except Exception as exc:
+        logger.error(f"Geocoding failed: {exc}")
+        return GeocodeStatus.PENDING, None
+
+
+class GeocodingWorker:
+    """
+    Background thread that geocodes the PENDING addresses in batches on a small thread pool.
+    Addresses are claimed with a lease (geocode_next_attempt_at), so several app workers can run it on the
+    same database. Failed attempts are retried with exponential backoff up to GEOCODE_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, workers: int, batch_size: int, poll_seconds: float):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._executor = None
+
+    def start(self) -> None:
+        # The thread does not survive a fork (e.g. app workers), it is started again in the new process
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="geocoding"
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="geocoding-dispatcher", daemon=True
+            )
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def notify(self) -> None:
+        """
+        Wakes the worker up after an address was saved as PENDING.
+        """
+        self.start()
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                processed = self.run_once()
+            except Exception as exc:
+                logger.error(f"Geocoding batch failed: {exc}")
+                processed = 0
+            # A full batch means there may be more pending addresses
+            if processed < self.batch_size:
+                self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
+
+    def claim(self) -> Tuple[List[Tuple[int, Dict]], datetime]:
+        """
+        Leases a batch of PENDING addresses that are due.
+        :return: ([(address id, geocoding query)], end of the lease)
+        """
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=constants.GEOCODE_LEASE_SECONDS)
+        due = (
+            DBAddress.geocode_status == GeocodeStatus.PENDING,
+            or_(
+                DBAddress.geocode_next_attempt_at.is_(None),
+                DBAddress.geocode_next_attempt_at <= now,
+            ),
+        )
+        with SessionLocal() as db:
+            addresses = (
+                db.execute(select(DBAddress).where(*due).limit(self.batch_size))
+                .scalars()
+                .all()
+            )
+            claimed = []
+            for address in addresses:
+                # Conditional update: only one app worker gets the address
+                result = db.execute(
+                    update(DBAddress)
+                    .where(DBAddress.id == address.id, *due)
+                    .values(geocode_next_attempt_at=lease_until)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount == 1:
+                    claimed.append((address.id, geocoding_query(address)))
+            db.commit()
+        return claimed, lease_until
+
+    def run_once(self) -> int:
+        """
+        Geocodes one batch of pending addresses.
+        :return: Number of addresses processed
+        """
+        claimed, lease_until = self.claim()
+        if not claimed:
+            return 0
+        results = list(
+            self._executor.map(geocode, [query for _, query in claimed])
+            if self._executor
+            else map(geocode, [query for _, query in claimed])
+        )
+
+        now = datetime.utcnow()
+        updated_ids = []
+        with SessionLocal() as db:
+            for (address_id, _), (geocode_status, coordinates) in zip(claimed, results):
+                address = db.get(DBAddress, address_id)
+                # Skip addresses changed by the user in the meantime (their lease is reset)
+                if (
+                    address is None
+                    or address.geocode_status != GeocodeStatus.PENDING
+                    or address.geocode_next_attempt_at != lease_until
+                ):
+                    continue
+                address.geocode_attempts = (address.geocode_attempts or 0) + 1
+                if geocode_status == GeocodeStatus.PENDING:
+                    if address.geocode_attempts >= constants.GEOCODE_MAX_ATTEMPTS:
+                        geocode_status = GeocodeStatus.FAILED
+                    else:
+                        address.geocode_next_attempt_at = now + timedelta(
+                            seconds=constants.GEOCODE_BACKOFF_SECONDS
+                            * 2 ** (address.geocode_attempts - 1)
+                        )
+                        continue
+                address.geocode_status = geocode_status
+                address.geocode_next_attempt_at = None
+                if coordinates:
+                    address.latitude = coordinates["latitude"]
+                    address.longitude = coordinates["longitude"]
+                updated_ids.append(address_id)
+            db.commit()
+            emails = (
+                db.execute(
+                    select(DBUser.email)
+                    .join(DBAddress, DBAddress.user_id == DBUser.id)
+                    .where(DBAddress.id.in_(updated_ids))
+                )
+                .scalars()
+                .all()
+                if updated_ids
+                else []
+            )
+
+        if updated_ids:
+            # New coordinates change the results of the distance searches and the profile completeness
+            total_counts_cache.delete_where(lambda key: key[0] == "cars")
+            for email in emails:
+                invalidate_principal(email)
+        return len(claimed)
+
+
+geocoding_worker = GeocodingWorker(
+    workers=constants.GEOCODE_WORKERS,
+    batch_size=constants.GEOCODE_BATCH_SIZE,
+    poll_seconds=constants.GEOCODE_POLL_SECONDS,
+)
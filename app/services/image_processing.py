@@ -0,0 +1,528 @@
+import mimetypes
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from PIL import Image, ImageOps, features
+from sqlalchemy import and_, select, update
+from sqlalchemy.orm import Session
+
+from app.core.database import SessionLocal
+from app.models.picture import DBBlob, DBPicture
+from app.schemas.enums import PictureOwner, PictureStatus, RenditionFormat
+from app.services.blob_store import (
+    STATIC_PATH,
+    acquire_blob,
+    blob_path,
+    delete_files,
+    file_extension,
+    release_blob,
+    rendition_path,
+    static_url,
+    write_temp_file,
+)
+from app.utils import constants
+from app.utils.logger import logger
+
+
+def rendition_formats() -> List[str]:
+    """
+    Formats of IMAGE_RENDITION_FORMATS that the installed Pillow can encode (e.g. AVIF needs libavif).
+    """
+    return [
+        image_format
+        for image_format in constants.IMAGE_RENDITION_FORMATS
+        if features.check(image_format.lower())
+    ]
+
+
+def save_image(
+    image: Image.Image, path: Path, temp_dir: Path, image_format: str, quality: int
+):
+    # Written to a temporary file first, so the file is never served half written
+    temp_path = temp_dir / f".{path.name}.tmp"
+    image.save(temp_path, format=image_format, optimize=True, quality=quality)
+    os.replace(temp_path, path)
+
+
+# Module level function, so that it can be sent to a process pool
+def process_picture(
+    file_path: str,
+    widths: List[int],
+    image_formats: List[str],
+    max_size: int,
+    quality: int,
+) -> List[int]:
+    """
+    Optimizes an uploaded picture in place and creates its renditions in each of the given formats.
+    :param file_path: Path of the uploaded picture
+    :param widths: Widths of the renditions (widths over the width of the picture are capped to it)
+    :param image_formats: Formats of the renditions (e.g. WEBP, AVIF)
+    :param max_size: The picture is scaled down to fit into a square of this size
+    :param quality: Quality of the re-encoded pictures (0-100)
+    :return: Widths of the renditions created
+    """
+    path = Path(file_path)
+    renditions_dir = path.parent / constants.RENDITIONS_DIR
+    renditions_dir.mkdir(parents=True, exist_ok=True)
+    with Image.open(path) as original:
+        image_format = original.format
+        # Rotates the picture as the camera saved it (the orientation tag is dropped on save)
+        image = ImageOps.exif_transpose(original)
+    image.thumbnail((max_size, max_size))
+    save_image(image, path, renditions_dir, image_format, quality)
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    created = sorted({min(width, image.width) for width in widths})
+    for width in created:
+        rendition = image.copy()
+        rendition.thumbnail((width, image.height))
+        for rendition_format in image_formats:
+            save_image(
+                rendition,
+                rendition_path(path, width, rendition_format),
+                renditions_dir,
+                rendition_format,
+                quality,
+            )
+    return created
+
+
+class ImageProcessor:
+    """
+    Optimizes the uploaded pictures on a fixed number of workers (processes by default), so the encoding
+    does not run in the request threads. Identical uploads share a blob, which is processed once;
+    the status is kept in the blobs table.
+    An upload reserves a slot with admit() before it is saved, the slot is used by submit() or given back
+    with release(). If max_pending slots are taken, new uploads are rejected with 503.
+    """
+
+    def __init__(self, workers: int, max_pending: int, use_processes: bool):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def admit(self, enforce_limit: bool = True) -> None:
+        """
+        Reserves a slot of the processing queue (before the upload is saved), raises 503 if the queue is full.
+        :param enforce_limit: False for the pictures of the start-up tasks, which are already stored
+        """
+        with self._lock:
+            # Pools are created on first use in each (forked) app worker
+            if self._executor_pid != os.getpid():
+                self._executor = (
+                    ProcessPoolExecutor(max_workers=self.workers)
+                    if self.use_processes
+                    else ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="image"
+                    )
+                )
+                self._executor_pid = os.getpid()
+                self._pending = 0
+            if enforce_limit and self._pending >= self.max_pending:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Server is busy, please try again.",
+                    headers={"Retry-After": "5"},
+                )
+            self._pending += 1
+
+    def release(self) -> None:
+        """
+        Gives back a slot that is not used (the upload failed or its blob is already known).
+        """
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, digest: str, file_path: Path) -> None:
+        """
+        Processes a new blob in the slot reserved by admit(), the slot is released when it is done.
+        """
+        image_formats = rendition_formats()
+        try:
+            future = self._executor.submit(
+                process_picture,
+                str(file_path),
+                constants.IMAGE_RENDITION_WIDTHS,
+                image_formats,
+                constants.IMAGE_MAX_SIZE,
+                constants.IMAGE_QUALITY,
+            )
+        except Exception:
+            self.release()
+            raise
+        future.add_done_callback(
+            partial(self._finish, digest, file_path, image_formats)
+        )
+
+    def _finish(
+        self, digest: str, file_path: Path, image_formats: List[str], future
+    ) -> None:
+        self.release()
+        try:
+            widths = future.result()
+            values = {
+                "status": PictureStatus.READY,
+                "renditions": ",".join(str(width) for width in widths),
+                "rendition_formats": ",".join(image_formats),
+                "error": None,
+            }
+            logger.info(f"Processed picture {file_path}")
+        except Exception as exc:
+            values = {"status": PictureStatus.FAILED, "error": str(exc)}
+            logger.error(f"Error processing picture {file_path}: {exc}")
+        try:
+            with SessionLocal() as db:
+                # Blobs deleted in the meantime are not updated
+                db.execute(
+                    update(DBBlob)
+                    .where(
+                        DBBlob.digest == digest,
+                        DBBlob.status == PictureStatus.PROCESSING,
+                    )
+                    .values(processed_at=datetime.utcnow(), **values)
+                )
+                db.commit()
+        except Exception as exc:
+            logger.error(f"Status of blob {digest} could not be saved: {exc}")
+
+
+image_processor = ImageProcessor(
+    workers=constants.IMAGE_WORKERS,
+    max_pending=constants.IMAGE_MAX_PENDING,
+    use_processes=constants.IMAGE_USE_PROCESSES,
+)
+
+
+def add_picture(
+    db: Session,
+    owner_type: PictureOwner,
+    owner_id: int,
+    upload: BinaryIO,
+    file_name: str,
+    content_type: str,
+    replace: bool = False,
+) -> DBPicture:
+    """
+    Stores an uploaded picture in the blob store and adds it to the pictures of a car or a user.
+    A new blob is handed to the image processor, a known one (same content) is only referenced again.
+    The caller reserves a slot of the image processor (image_processor.admit()) first, it is released here
+    if the blob is known or the picture cannot be added.
+    :param upload: File object of the upload
+    :param file_name: Name of the uploaded file (only its extension is used)
+    :param content_type: Content type of the upload
+    :param replace: Remove the other pictures of the owner (e.g. the previous profile picture)
+    """
+    try:
+        temp_path, digest, _ = write_temp_file(upload)
+        picture = db.execute(
+            select(DBPicture).where(
+                DBPicture.owner_type == owner_type,
+                DBPicture.owner_id == owner_id,
+                DBPicture.blob_digest == digest,
+            )
+        ).scalar_one_or_none()
+        if picture is not None:
+            # The owner already has this picture
+            temp_path.unlink(missing_ok=True)
+            blob, new_blob = picture.blob, False
+        else:
+            blob, new_blob = acquire_blob(
+                db,
+                temp_path,
+                digest,
+                file_extension(file_name, content_type),
+                content_type,
+            )
+            picture = DBPicture(
+                owner_type=owner_type,
+                owner_id=owner_id,
+                file_name=blob.file_name,
+                blob_digest=blob.digest,
+            )
+            db.add(picture)
+        files = []
+        if replace:
+            _, files = remove_pictures(
+                db, owner_type, owner_id, keep_file_name=picture.file_name
+            )
+        db.commit()
+        db.refresh(picture)
+        delete_files(files)
+    except BaseException:
+        image_processor.release()
+        raise
+    if new_blob:
+        image_processor.submit(blob.digest, blob_path(blob.digest, blob.extension))
+    else:
+        image_processor.release()
+    return picture
+
+
+def get_picture(
+    db: Session, owner_type: PictureOwner, owner_id: int, file_name: str
+) -> Optional[DBPicture]:
+    return db.execute(
+        select(DBPicture).where(
+            DBPicture.owner_type == owner_type,
+            DBPicture.owner_id == owner_id,
+            DBPicture.file_name == file_name,
+        )
+    ).scalar_one_or_none()
+
+
+def get_pictures(
+    db: Session, owner_type: PictureOwner, owner_id: int
+) -> List[DBPicture]:
+    """
+    :return: Pictures of a car or a user in upload order (indexed by owner)
+    """
+    return (
+        db.execute(
+            select(DBPicture)
+            .where(DBPicture.owner_type == owner_type, DBPicture.owner_id == owner_id)
+            .order_by(DBPicture.id)
+        )
+        .scalars()
+        .all()
+    )
+
+
+def remove_pictures(
+    db: Session,
+    owner_type: PictureOwner,
+    owner_id: int,
+    file_name: Optional[str] = None,
+    keep_file_name: Optional[str] = None,
+) -> Tuple[int, List[Path]]:
+    """
+    Removes pictures of an owner and releases their blobs, without committing.
+    :return: (number of pictures removed, files of the unreferenced blobs to delete after the commit)
+    """
+    filters = [DBPicture.owner_type == owner_type, DBPicture.owner_id == owner_id]
+    if file_name is not None:
+        filters.append(DBPicture.file_name == file_name)
+    if keep_file_name is not None:
+        filters.append(DBPicture.file_name != keep_file_name)
+    pictures = db.execute(select(DBPicture).where(*filters)).scalars().all()
+    files = []
+    for picture in pictures:
+        digest = picture.blob_digest
+        db.delete(picture)
+        db.flush()
+        files.extend(release_blob(db, digest))
+    return len(pictures), files
+
+
+def delete_pictures(
+    db: Session,
+    owner_type: PictureOwner,
+    owner_id: int,
+    file_name: Optional[str] = None,
+) -> bool:
+    """
+    Deletes a picture of a car or a user (all pictures of the owner if file_name is None). Blob files are
+    deleted with their last picture.
+    :return: True if a picture was deleted
+    """
+    removed, files = remove_pictures(db, owner_type, owner_id, file_name)
+    db.commit()
+    delete_files(files)
+    return removed > 0
+
+
+def rendition_widths(blob: DBBlob) -> List[int]:
+    return [int(width) for width in (blob.renditions or "").split(",") if width]
+
+
+def rendition_formats_of(blob: DBBlob) -> List[str]:
+    return [f for f in (blob.rendition_formats or "").split(",") if f]
+
+
+def picture_url(picture: DBPicture) -> str:
+    return static_url(blob_path(picture.blob.digest, picture.blob.extension))
+
+
+def picture_display(picture: DBPicture) -> dict:
+    blob = picture.blob
+    file_path = blob_path(blob.digest, blob.extension)
+    return {
+        "file_name": picture.file_name,
+        "status": blob.status,
+        "url": static_url(file_path),
+        "renditions": {
+            rendition_format: {
+                width: static_url(rendition_path(file_path, width, rendition_format))
+                for width in rendition_widths(blob)
+            }
+            for rendition_format in rendition_formats_of(blob)
+        },
+        "error": blob.error,
+    }
+
+
+def accepted_formats(accept: Optional[str]) -> List[str]:
+    """
+    Rendition formats a client can decode, from the Accept header of the request (best first).
+    """
+    accept = (accept or "").lower()
+    return [
+        image_format
+        for image_format in (RenditionFormat.AVIF, RenditionFormat.WEBP)
+        if f"image/{image_format.lower()}" in accept
+    ]
+
+
+def best_rendition_url(picture: DBPicture, width: int, image_formats: List[str]) -> str:
+    """
+    URL of the smallest rendition that is at least the requested width (the largest one if none is)
+    in the first format of image_formats that the picture has. Falls back to the original picture.
+    :param picture: Picture row
+    :param width: Width the client displays the picture at
+    :param image_formats: Formats the client accepts, best first
+    """
+    blob = picture.blob
+    file_path = blob_path(blob.digest, blob.extension)
+    available_formats = rendition_formats_of(blob)
+    widths = rendition_widths(blob)
+    rendition_format = next((f for f in image_formats if f in available_formats), None)
+    if blob.status != PictureStatus.READY or not widths or not rendition_format:
+        return static_url(file_path)
+    best_width = next((w for w in widths if w >= width), widths[-1])
+    return static_url(rendition_path(file_path, best_width, rendition_format))
+
+
+def resume_unfinished_pictures() -> None:
+    """
+    Hands the blobs left unprocessed by a stopped app worker to the image processor again
+    (after IMAGE_PROCESSING_TIMEOUT_SECONDS, so the blobs of running app workers are not taken).
+    """
+    now = datetime.utcnow()
+    unfinished = and_(
+        DBBlob.status == PictureStatus.PROCESSING,
+        DBBlob.started_at
+        < now - timedelta(seconds=constants.IMAGE_PROCESSING_TIMEOUT_SECONDS),
+    )
+    with SessionLocal() as db:
+        blobs = db.execute(select(DBBlob).where(unfinished)).scalars().all()
+        for blob in blobs:
+            # Conditional update: only one app worker gets the blob
+            result = db.execute(
+                update(DBBlob)
+                .where(DBBlob.digest == blob.digest, unfinished)
+                .values(started_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            if result.rowcount == 1:
+                image_processor.admit(enforce_limit=False)
+                image_processor.submit(
+                    blob.digest, blob_path(blob.digest, blob.extension)
+                )
+
+
+def import_legacy_pictures() -> None:
+    """
+    Moves the pictures saved before the blob store (car_XXXXXX directories and user_XXXXXX files of the
+    profile pictures) into the blob store. After the first run the old directories are empty.
+    """
+    cars_path = STATIC_PATH / constants.CAR_IMAGES_PATH
+    profile_pictures_path = STATIC_PATH / constants.PROFILE_PICTURES_PATH
+    legacy_files = [
+        (PictureOwner.CAR, int(directory.name[len("car_") :]), file)
+        for directory in cars_path.glob("car_*")
+        if directory.is_dir()
+        for file in directory.iterdir()
+        if file.is_file()
+    ] + [
+        (PictureOwner.USER, int(file.name[len("user_") :][:6]), file)
+        for file in profile_pictures_path.glob("user_*")
+        if file.is_file()
+    ]
+    if not legacy_files:
+        return
+    with SessionLocal() as db:
+        for owner_type, owner_id, file in legacy_files:
+            content_type = mimetypes.guess_type(file.name)[0]
+            try:
+                with file.open("rb") as upload:
+                    image_processor.admit(enforce_limit=False)
+                    add_picture(
+                        db,
+                        owner_type,
+                        owner_id,
+                        upload,
+                        file.name,
+                        content_type,
+                        replace=owner_type == PictureOwner.USER,
+                    )
+                file.unlink()
+            except Exception as exc:
+                db.rollback()
+                logger.error(
+                    f"Picture {file} could not be moved to the blob store: {exc}"
+                )
+    # Renditions of the old layout are created again in the blob store, files that could not be moved stay
+    for directory in [*cars_path.glob("car_*"), profile_pictures_path]:
+        shutil.rmtree(directory / constants.RENDITIONS_DIR, ignore_errors=True)
+        if directory != profile_pictures_path and not any(directory.iterdir()):
+            directory.rmdir()
+
+
+class PictureRecovery:
+    """
+    Background thread that runs resume_unfinished_pictures every interval_seconds, so the pictures of an
+    app worker stopped during processing are finished without waiting for a restart of the app.
+    """
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+
+    def start(self) -> None:
+        # The thread does not survive a fork (e.g. app workers), it is started again in the new process
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="picture-recovery", daemon=True
+            )
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._thread_pid != os.getpid():
+                return
+            self._stopped.set()
+            self._thread.join()
+            self._thread, self._thread_pid = None, None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                resume_unfinished_pictures()
+            except Exception as exc:
+                logger.error(f"Unfinished pictures could not be resumed: {exc}")
+            if self._stopped.wait(self.interval_seconds):
+                return
+
+
+picture_recovery = PictureRecovery(
+    interval_seconds=constants.IMAGE_RECOVERY_INTERVAL_SECONDS
+)
@@ -0,0 +1,41 @@
+from typing import NamedTuple
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.models.user import DBUser
+from app.utils import constants
+from app.utils.cache import TTLCache
+
+
+class Principal(NamedTuple):
+    # Detached copy of the user row, it is merged into the session of each request (without a query)
+    user: DBUser
+    profile_complete: bool
+
+
+# Authenticated users keyed by the lowercase email (subject of the access token). Entries are dropped by the
+# user and address services when the user changes. Other app workers do not see those changes, so entries
+# also expire after a short time.
+principal_cache = TTLCache(
+    maxsize=constants.PRINCIPAL_CACHE_SIZE,
+    ttl=constants.PRINCIPAL_CACHE_TTL_SECONDS,
+)
+
+
+def snapshot_user(user: DBUser) -> DBUser:
+    """
+    Copies the column values of a user into a new detached instance that is not bound to any session.
+    """
+    snapshot = DBUser(
+        **{
+            attribute.key: getattr(user, attribute.key)
+            for attribute in DBUser.__mapper__.column_attrs
+        }
+    )
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+def invalidate_principal(email: str) -> None:
+    if email:
+        principal_cache.delete(email.lower())
@@ -1,44 +1,151 @@
-from datetime import datetime, timedelta
-from typing import Dict, List, Union
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
 
 from fastapi import HTTPException, status
-from sqlalchemy import and_, func, or_
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import (
+    Column,
+    Date,
+    Float,
+    Integer,
+    and_,
+    exists,
+    func,
+    insert,
+    literal,
+    or_,
+    Select,
+    select,
+)
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
 
 import app.utils.constants as constants
 from app.models.car import DBCar
 from app.models.rental import DBRental
+from app.models.review import DBReview
 from app.models.user import DBUser
-from app.schemas.enums import RentalSort, RentalStatus, SortDirection
-from app.schemas.rental import RentalPeriod
+from app.schemas.enums import RentalSort, RentalStatus, SortDirection, TotalCountType
+from app.schemas.rental import AvailabilityPeriod, RentalPeriod
+from app.services.availability import (
+    CarIntervals,
+    get_car_intervals,
+    invalidate_car,
+    merge_periods,
+    overlap_filter,
+    split_calendar,
+    to_date,
+)
 from app.services.car import get_car
 from app.utils.logger import logger
+from app.utils.pagination import (
+    TotalCounts,
+    decode_cursor,
+    encode_cursor,
+    get_total_counts,
+    get_total_counts_async,
+    keyset_filter,
+)
+
+
+def rental_display_loaders() -> list:
+    """
+    Loader options of the relationships shown by RentalDisplay. An AsyncSession cannot load them lazily
+    during serialization. The reviews are loaded by one more query, joined with their users.
+    Created on use, since creating the options configures the mappers.
+    """
+    return [
+        selectinload(DBRental.reviews).options(
+            joinedload(DBReview.reviewer).joinedload(DBUser.address),
+            joinedload(DBReview.reviewee).joinedload(DBUser.address),
+        )
+    ]
 
 
-# Create a new rental
+# Bookings of the same car are serialized within the process by these (striped) locks, so that
+# concurrent requests wait here instead of competing for the database write lock.
+_booking_locks = [threading.Lock() for _ in range(constants.BOOKING_LOCK_STRIPES)]
+
+
+def reserve_car(
+    db: Session,
+    car_id: int,
+    renter_id: int,
+    start_date: date,
+    end_date: date,
+    total_price: float,
+) -> Optional[int]:
+    """
+    Inserts the rental only if the car has no overlapping rental. The check and the insert are a single
+    statement, so a concurrent booking can not slip in between them (SQLite runs write statements one
+    at a time, on PostgreSQL a transaction level advisory lock on the car_id is taken first).
+    The caller commits.
+    :return: id of the new rental, None if the car is not available
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.pg_advisory_xact_lock(car_id)))
+    status_type = DBRental.__table__.c.status.type
+    statement = (
+        insert(DBRental)
+        .from_select(
+            ["car_id", "renter_id", "start_date", "end_date", "total_price", "status"],
+            select(
+                literal(car_id, Integer),
+                literal(renter_id, Integer),
+                literal(start_date, Date),
+                literal(end_date, Date),
+                literal(total_price, Float),
+                literal(RentalStatus.RESERVED, status_type),
+            ).where(
+                ~exists().where(
+                    DBRental.car_id == car_id, overlap_filter(start_date, end_date)
+                )
+            ),
+        )
+        .returning(DBRental.id)
+    )
+    return db.execute(statement).scalar_one_or_none()
 
 
+# Create a new rental
 def create_rental(db: Session, car_id, rental: RentalPeriod, renter_id: int):
     car = get_car(db, car_id)
     if car.owner_id == renter_id:
         raise HTTPException(status_code=404, detail="You are the owner of the car!")
+    # Fast rejection on the in-memory availability index, the booking itself is checked again atomically
     if not is_car_available(car_id, rental.start_date, rental.end_date, db):
         raise HTTPException(
             status_code=404, detail="Car is not available during this period!"
         )
-    db_rental = DBRental(
-        car_id=car_id,
-        renter_id=renter_id,
-        start_date=rental.start_date,
-        end_date=rental.end_date,
-        total_price=(rental.end_date - rental.start_date).days * car.price_per_day,
-        status=RentalStatus.RESERVED,
-    )
-    db.add(db_rental)
+    total_price = (rental.end_date - rental.start_date).days * car.price_per_day
+
+    # End the read transaction, so that the booking runs in its own (short) write transaction
     db.commit()
-    db.refresh(db_rental)
-    return db_rental
+    with _booking_locks[car_id % constants.BOOKING_LOCK_STRIPES]:
+        try:
+            rental_id = reserve_car(
+                db,
+                car_id,
+                renter_id,
+                to_date(rental.start_date),
+                to_date(rental.end_date),
+                total_price,
+            )
+            db.commit()
+        except OperationalError as exc:
+            db.rollback()
+            logger.error(f"Could not book car_id {car_id}: {exc}")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Booking could not be processed, please try again.",
+            )
+    invalidate_car(car_id)
+    if rental_id is None:
+        raise HTTPException(
+            status_code=404, detail="Car is not available during this period!"
+        )
+    return db.get(DBRental, rental_id)
 
 
 # Retrieve rental by ID
@@ -103,9 +210,75 @@ def get_rentals(
     sort_dir: SortDirection = SortDirection.ASC,
     skip: int = 0,
     limit: int = constants.QUERY_LIMIT_DEFAULT,
-) -> Dict[str, Union[int, List[DBRental]]]:
+    cursor: str = None,
+    include_total: TotalCountType = TotalCountType.EXACT,
+) -> Dict[str, Union[int, str, List[DBRental]]]:
     limit = min(limit, constants.QUERY_LIMIT_MAX)
+    count_args, query, sort_column = rental_list_statements(
+        current_user,
+        rental_id,
+        car_id,
+        sort_by,
+        sort_dir,
+        skip,
+        limit,
+        cursor,
+        include_total,
+    )
+    total = get_total_counts(db, *count_args)
+    rentals = db.execute(query).scalars().all()
+    return rental_page(rentals, total, sort_column, skip, limit, cursor)
+
 
+async def get_rentals_async(
+    db: AsyncSession,
+    current_user: DBUser,
+    rental_id: int = None,
+    car_id: int = None,
+    sort_by: RentalSort = RentalSort.DATE,
+    sort_dir: SortDirection = SortDirection.ASC,
+    skip: int = 0,
+    limit: int = constants.QUERY_LIMIT_DEFAULT,
+    cursor: str = None,
+    include_total: TotalCountType = TotalCountType.EXACT,
+) -> Dict[str, Union[int, str, List[DBRental]]]:
+    """
+    Async version of get_rentals, the reviews shown by RentalDisplay are loaded with the rentals.
+    """
+    limit = min(limit, constants.QUERY_LIMIT_MAX)
+    count_args, query, sort_column = rental_list_statements(
+        current_user,
+        rental_id,
+        car_id,
+        sort_by,
+        sort_dir,
+        skip,
+        limit,
+        cursor,
+        include_total,
+    )
+    total = await get_total_counts_async(db, *count_args)
+    rentals = (
+        (await db.execute(query.options(*rental_display_loaders()))).scalars().all()
+    )
+    return rental_page(rentals, total, sort_column, skip, limit, cursor)
+
+
+def rental_list_statements(
+    current_user: DBUser,
+    rental_id: Optional[int],
+    car_id: Optional[int],
+    sort_by: RentalSort,
+    sort_dir: SortDirection,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    include_total: TotalCountType,
+) -> Tuple[tuple, Select, Column]:
+    """
+    Builds the statements of get_rentals and get_rentals_async.
+    :return: (arguments of get_total_counts after the session, page query, sort column)
+    """
     q_filer = [
         DBRental.id == rental_id if rental_id else True,
         DBRental.car_id == car_id if car_id else True,
@@ -114,32 +287,67 @@ def get_rentals(
         q_filer.append(current_user.id == DBRental.renter_id)
 
     if sort_by == RentalSort.DATE:
-        q_sort = DBRental.start_date
+        sort_column, sort_type = DBRental.start_date, date
     elif sort_by == RentalSort.TOTAL_PRICE:
-        q_sort = DBRental.total_price
+        sort_column, sort_type = DBRental.total_price, float
     else:
-        q_sort = DBRental.status
+        sort_column, sort_type = DBRental.status, RentalStatus
 
+    # Rental id is the tiebreaker, so that the order (and the cursor) is deterministic
     if sort_dir == SortDirection.ASC:
-        q_sort = q_sort.asc()
+        q_sort = [sort_column.asc(), DBRental.id.asc()]
     else:
-        q_sort = q_sort.desc()
-
-    total = db.query(func.count(DBRental.id)).filter(and_(*q_filer)).scalar()
+        q_sort = [sort_column.desc(), DBRental.id.desc()]
 
-    rentals = (
-        db.query(DBRental)
-        .filter(and_(*q_filer))
-        .order_by(q_sort)
-        .offset(skip)
-        .limit(limit)
-        .all()
+    count_args = (
+        include_total,
+        (
+            "rentals",
+            rental_id,
+            car_id,
+            None if current_user.is_admin() else current_user.id,
+        ),
+        select(DBRental.id).where(and_(*q_filer)),
     )
+
+    query = select(DBRental).where(and_(*q_filer)).order_by(*q_sort)
+    if cursor:
+        # Keyset pagination: continue after the last row of the previous page
+        last_value, last_id = decode_cursor(cursor, sort_type)
+        query = query.where(
+            keyset_filter(
+                sort_column,
+                DBRental.id,
+                last_value,
+                last_id,
+                sort_dir != SortDirection.ASC,
+            )
+        )
+    else:
+        query = query.offset(skip)
+    return count_args, query.limit(limit), sort_column
+
+
+def rental_page(
+    rentals: List[DBRental],
+    total: TotalCounts,
+    sort_column: Column,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+) -> Dict[str, Union[int, str, List[DBRental]]]:
+    # limit=0 returns an empty page without a next page
+    has_next = limit > 0 and len(rentals) == limit
     return {
-        "current_offset": skip,
+        "current_offset": None if cursor else skip,
         "counts": len(rentals),
-        "total_counts": total,
-        "next_offset": (skip + limit) if len(rentals) == limit else None,
+        **total.fields(),
+        "next_offset": (skip + limit) if has_next and not cursor else None,
+        "next_cursor": (
+            encode_cursor(getattr(rentals[-1], sort_column.key), rentals[-1].id)
+            if has_next
+            else None
+        ),
         "rentals": rentals,
     }
 
@@ -179,6 +387,7 @@ def update_rental(
 
     try:
         db.commit()
+        invalidate_car(db_rental.car_id)
         db.refresh(db_rental)
         return db_rental
     except Exception:
@@ -212,6 +421,7 @@ def delete_rental(db: Session, rental_id: int, current_user: DBUser):
     try:
         db.delete(db_rental)
         db.commit()
+        invalidate_car(db_rental.car_id)
         return db_rental
     except Exception as exc:
         logger.log(
@@ -220,22 +430,13 @@ def delete_rental(db: Session, rental_id: int, current_user: DBUser):
         )
 
 
-# new code
 def get_overlapping_rental(car_id: int, start_date: datetime, end_date: datetime, db):
     rental = (
         db.query(DBRental)
         .filter(
             and_(
                 car_id == DBRental.car_id,
-                or_(
-                    and_(
-                        start_date >= DBRental.start_date,
-                        start_date <= DBRental.end_date,
-                    ),
-                    and_(
-                        end_date >= DBRental.start_date, end_date <= DBRental.end_date
-                    ),
-                ),
+                overlap_filter(start_date, end_date),
             )
         )
         .first()
@@ -243,9 +444,124 @@ def get_overlapping_rental(car_id: int, start_date: datetime, end_date: datetime
     return rental
 
 
+def get_availability_matrix(
+    db: Session, car_ids: List[int], periods: List[AvailabilityPeriod]
+) -> Dict:
+    """
+    Checks the availability of many cars for many periods with one query. Each car is outer joined to its
+    rentals that overlap with any of the periods (same overlap filter as get_overlapping_rental), then the
+    matrix is filled from the returned rental periods.
+    :param db: App session
+    :param car_ids: ids of the cars
+    :param periods: Requested periods, both ends inclusive
+    :return: Requested periods and the availability and busy periods per car (in the order of car_ids)
+    """
+    car_ids = list(dict.fromkeys(car_ids))
+    rows = db.execute(
+        select(DBCar.id, DBRental.start_date, DBRental.end_date, DBRental.id)
+        .select_from(DBCar)
+        .outerjoin(
+            DBRental,
+            and_(
+                DBRental.car_id == DBCar.id,
+                or_(*[overlap_filter(p.start_date, p.end_date) for p in periods]),
+            ),
+        )
+        .where(DBCar.id.in_(car_ids))
+    ).all()
+
+    rentals_by_car = {}
+    for found_car_id, start_date, end_date, rental_id in rows:
+        car_rentals = rentals_by_car.setdefault(found_car_id, [])
+        if rental_id is not None:
+            car_rentals.append((to_date(start_date), to_date(end_date), rental_id))
+    missing_car_ids = [car_id for car_id in car_ids if car_id not in rentals_by_car]
+    if missing_car_ids:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Cars not found: {missing_car_ids}",
+        )
+
+    cars = []
+    for car_id in car_ids:
+        intervals = CarIntervals(rentals_by_car[car_id])
+        cars.append(
+            {
+                "car_id": car_id,
+                "available": [
+                    intervals.overlapping(p.start_date, p.end_date) is None
+                    for p in periods
+                ],
+                "busy": [
+                    {"start_date": start, "end_date": end}
+                    for start, end in intervals.busy_spans
+                ],
+            }
+        )
+    return {"periods": periods, "cars": cars}
+
+
+def get_car_calendar(
+    db: Session,
+    car_id: int,
+    calendar_start: Optional[date],
+    calendar_end: Optional[date],
+) -> Dict:
+    """
+    Busy and free spans of a car in a date window. Served from the in-memory rental periods of the car,
+    which are dropped whenever a rental of the car is created, updated or deleted.
+    :param db: App session
+    :param car_id: id of the car
+    :param calendar_start: First day of the window (default: today)
+    :param calendar_end: Last day of the window (default: CALENDAR_DEFAULT_DAYS later)
+    :return: Window and its busy and free spans
+    """
+    today = date.today()
+    calendar_start = calendar_start or today
+    calendar_end = calendar_end or calendar_start + timedelta(
+        days=constants.CALENDAR_DEFAULT_DAYS
+    )
+    if calendar_start > calendar_end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Start of the calendar must not be later than its end.",
+        )
+    if (calendar_end - calendar_start).days > constants.CALENDAR_MAX_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Max length of the calendar is {constants.CALENDAR_MAX_DAYS} days",
+        )
+    get_car(db, car_id)
+
+    busy_spans = get_car_intervals(car_id, db).busy_spans
+    if calendar_start < today:
+        # Rentals that ended before today are not kept in memory
+        past_periods = db.execute(
+            select(DBRental.start_date, DBRental.end_date).where(
+                DBRental.car_id == car_id,
+                DBRental.end_date < today,
+                overlap_filter(calendar_start, calendar_end),
+            )
+        ).all()
+        busy_spans = merge_periods(
+            [(to_date(start), to_date(end)) for start, end in past_periods] + busy_spans
+        )
+    busy, free = split_calendar(busy_spans, calendar_start, calendar_end)
+    return {
+        "car_id": car_id,
+        "from_date": calendar_start,
+        "to_date": calendar_end,
+        "busy": [{"start_date": start, "end_date": end} for start, end in busy],
+        "free": [{"start_date": start, "end_date": end} for start, end in free],
+    }
+
+
 def is_car_available(car_id: int, start_date: datetime, end_date: datetime, db):
-    overlapping_rental = get_overlapping_rental(car_id, start_date, end_date, db)
-    return overlapping_rental is None
+    # Checked on the in-memory rental periods of the car (binary search)
+    overlapping_rental_id = get_car_intervals(car_id, db).overlapping(
+        to_date(start_date), to_date(end_date)
+    )
+    return overlapping_rental_id is None
 
 
 def is_car_available_for_update(
@@ -257,31 +573,20 @@ def is_car_available_for_update(
     if reserved_period.renter_id != renter_id:
         return False
 
-    converted_date_start = datetime(
-        year=reserved_period.start_date.year,
-        month=reserved_period.start_date.month,
-        day=reserved_period.start_date.day,
-    )
-    converted_date_end = datetime(
-        year=reserved_period.end_date.year,
-        month=reserved_period.end_date.month,
-        day=reserved_period.end_date.day,
-    )
-    is_available = False
+    # Only the days added to the reserved period must be free
+    is_available = True
     if start_date.date() < reserved_period.start_date:
         is_available = is_car_available(
             car_id,
-            start_date + timedelta(seconds=1),
-            converted_date_start - timedelta(seconds=1),
+            start_date,
+            reserved_period.start_date - timedelta(days=1),
             db,
         )
-        if not is_available:
-            return False
-    if end_date.date() > reserved_period.end_date:
+    if is_available and end_date.date() > reserved_period.end_date:
         is_available = is_car_available(
             car_id,
-            converted_date_end + timedelta(seconds=1),
-            end_date - timedelta(seconds=1),
+            reserved_period.end_date + timedelta(days=1),
+            end_date,
             db,
         )
     return is_available
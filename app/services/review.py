@@ -2,13 +2,21 @@ from datetime import datetime
 from typing import Dict, Union, List
 
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, func, and_
+from sqlalchemy import or_, func, and_, case, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
 
 from app.models.review import DBReview
 from app.models.user import DBUser
-from app.schemas.enums import ReviewSort, SortDirection
+from app.models.user_rating_stats import DBUserRatingStats
+from app.schemas.enums import ReviewSort, SortDirection, TotalCountType
 from app.schemas.review import ReviewBase, ReviewCreate
 from app.utils import constants
+from app.utils.pagination import (
+    decode_cursor,
+    encode_cursor,
+    get_total_counts,
+    keyset_filter,
+)
 
 
 # Create a new review
@@ -41,6 +49,7 @@ def create_review(
         review_date=datetime.utcnow(),
     )
     db.add(db_review)
+    apply_rating_change(db, reviewee_id, review.rating, 1)
     db.commit()
     db.refresh(db_review)
     return db_review
@@ -60,6 +69,9 @@ def get_all_reviews(db: Session):
 def update_review(db: Session, review_id: int, review: ReviewBase):
     db_review = db.query(DBReview).filter(DBReview.id == review_id).first()
     if db_review:
+        apply_rating_change(
+            db, db_review.reviewee_id, review.rating - db_review.rating, 0
+        )
         db_review.rating = review.rating
         db_review.comment = review.comment
         db.commit()
@@ -71,11 +83,67 @@ def update_review(db: Session, review_id: int, review: ReviewBase):
 def delete_review(db: Session, review_id: int):
     db_review = db.query(DBReview).filter(DBReview.id == review_id).first()
     if db_review:
+        apply_rating_change(db, db_review.reviewee_id, -db_review.rating, -1)
         db.delete(db_review)
         db.commit()
     return db_review
 
 
+# Apply a change to the precomputed rating of a user (the caller commits)
+def apply_rating_change(db: Session, user_id: int, rating_delta: int, count_delta: int):
+    if user_id is None or (rating_delta == 0 and count_delta == 0):
+        return
+    # Upsert, so that two concurrent first reviews of a user do not both insert the row
+    dialect_insert = (
+        postgresql.insert
+        if db.get_bind().dialect.name == "postgresql"
+        else sqlite.insert
+    )
+    statement = dialect_insert(DBUserRatingStats).values(
+        user_id=user_id,
+        rating_sum=rating_delta,
+        rating_count=count_delta,
+        rating_average=round(rating_delta / count_delta, 2) if count_delta > 0 else 0,
+    )
+    new_sum = DBUserRatingStats.rating_sum + statement.excluded.rating_sum
+    new_count = DBUserRatingStats.rating_count + statement.excluded.rating_count
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[DBUserRatingStats.user_id],
+            set_={
+                "rating_sum": new_sum,
+                "rating_count": new_count,
+                "rating_average": case(
+                    (new_count <= 0, 0),
+                    else_=func.round(new_sum * 1.0 / new_count, 2),
+                ),
+            },
+        )
+    )
+
+
+# Recalculate the rating stats of all users from the reviews table (backfill)
+def rebuild_rating_stats(db: Session) -> int:
+    db.query(DBUserRatingStats).delete()
+    db.execute(
+        insert(DBUserRatingStats).from_select(
+            ["user_id", "rating_sum", "rating_count", "rating_average"],
+            select(
+                DBReview.reviewee_id,
+                func.sum(DBReview.rating),
+                func.count(DBReview.id),
+                func.round(
+                    func.sum(DBReview.rating) * 1.0 / func.count(DBReview.id), 2
+                ),
+            )
+            .where(DBReview.reviewee_id.is_not(None))
+            .group_by(DBReview.reviewee_id),
+        )
+    )
+    db.commit()
+    return db.query(func.count(DBUserRatingStats.user_id)).scalar()
+
+
 def get_views_by_user(
     db,
     user_id: int,
@@ -84,41 +152,65 @@ def get_views_by_user(
     sort_dir: SortDirection = SortDirection.ASC,
     skip: int = 0,
     limit: int = constants.QUERY_LIMIT_DEFAULT,
-) -> Dict[str, Union[int, List[DBReview]]]:
+    cursor: str = None,
+    include_total: TotalCountType = TotalCountType.EXACT,
+) -> Dict[str, Union[int, str, List[DBReview]]]:
     limit = min(limit, constants.QUERY_LIMIT_MAX)
 
     q_filter = [or_(DBReview.reviewer_id == user_id, DBReview.reviewer_id == user_id)]
 
     if sort_by == ReviewSort.REVIEW_DATE:
-        q_sort = DBReview.review_date
+        sort_column, sort_type = DBReview.review_date, datetime
     elif sort_by == ReviewSort.REVIEWER_ID:
-        q_sort = DBReview.reviewer_id
+        sort_column, sort_type = DBReview.reviewer_id, int
     elif sort_by == ReviewSort.REVIEWEE_ID:
-        q_sort = DBReview.reviewee_id
+        sort_column, sort_type = DBReview.reviewee_id, int
     elif sort_by == ReviewSort.RENTAL_ID:
-        q_sort = DBReview.id
+        sort_column, sort_type = DBReview.id, int
     else:
-        q_sort = DBReview.rating
+        sort_column, sort_type = DBReview.rating, int
 
+    # Review id is the tiebreaker, so that the order (and the cursor) is deterministic
     if sort_dir == SortDirection.ASC:
-        q_sort = q_sort.asc()
+        q_sort = [sort_column.asc(), DBReview.id.asc()]
     else:
-        q_sort = q_sort.desc()
-
-    total = db.query(func.count(DBReview.id)).filter(and_(*q_filter)).scalar()
+        q_sort = [sort_column.desc(), DBReview.id.desc()]
 
-    reviews = (
-        db.query(DBReview)
-        .filter(and_(*q_filter))
-        .order_by(q_sort)
-        .offset(skip)
-        .limit(limit)
-        .all()
+    total = get_total_counts(
+        db,
+        include_total,
+        ("reviews", user_id),
+        select(DBReview.id).where(and_(*q_filter)),
     )
+
+    query = db.query(DBReview).filter(and_(*q_filter)).order_by(*q_sort)
+    if cursor:
+        # Keyset pagination: continue after the last row of the previous page
+        last_value, last_id = decode_cursor(cursor, sort_type)
+        query = query.filter(
+            keyset_filter(
+                sort_column,
+                DBReview.id,
+                last_value,
+                last_id,
+                sort_dir != SortDirection.ASC,
+            )
+        )
+    else:
+        query = query.offset(skip)
+    reviews = query.limit(limit).all()
+
+    # limit=0 returns an empty page without a next page
+    has_next = limit > 0 and len(reviews) == limit
     return {
-        "current_offset": skip,
+        "current_offset": None if cursor else skip,
         "counts": len(reviews),
-        "total_counts": total,
-        "next_offset": (skip + limit) if len(reviews) == limit else None,
+        **total.fields(),
+        "next_offset": (skip + limit) if has_next and not cursor else None,
+        "next_cursor": (
+            encode_cursor(getattr(reviews[-1], sort_column.key), reviews[-1].id)
+            if has_next
+            else None
+        ),
         "reviews": reviews,
     }
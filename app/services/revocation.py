@@ -0,0 +1,114 @@
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from app.models.revoked_token import DBRevokedToken
+from app.utils import constants
+
+
+class RevocationList:
+    """
+    jti values of the revoked access tokens with their expiry (epoch seconds). A token is checked with a
+    dictionary lookup. Entries are dropped when the token would have expired anyway, a heap ordered by the
+    expiry finds them at every add and sync without walking the whole list.
+    The list is persisted in the revoked_tokens table. Each app worker loads the rows revoked by the other
+    workers every REVOCATION_SYNC_SECONDS.
+    """
+
+    def __init__(self, sync_seconds: float):
+        self.sync_seconds = sync_seconds
+        self._entries: Dict[str, float] = {}
+        self._expiries: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+        self._synced_at: Optional[float] = None
+        self._synced_until: Optional[datetime] = None
+
+    def add(self, jti: str, expires_at: float) -> None:
+        with self._lock:
+            self._put(jti, expires_at)
+            self._evict_expired()
+
+    def is_revoked(self, jti: str, db: Session) -> bool:
+        if (
+            self._synced_at is None
+            or time.monotonic() - self._synced_at > self.sync_seconds
+        ):
+            self.sync(db)
+        expires_at = self._entries.get(jti)
+        if expires_at is None:
+            return False
+        if expires_at < time.time():
+            with self._lock:
+                self._entries.pop(jti, None)
+            return False
+        return True
+
+    def sync(self, db: Session) -> None:
+        """
+        Loads the tokens revoked since the last sync (all of the unexpired ones at the first call).
+        """
+        now = datetime.utcnow()
+        query = select(DBRevokedToken.jti, DBRevokedToken.expires_at).where(
+            DBRevokedToken.expires_at > now
+        )
+        if self._synced_until is not None:
+            query = query.where(DBRevokedToken.revoked_at >= self._synced_until)
+        rows = db.execute(query).all()
+        with self._lock:
+            for jti, expires_at in rows:
+                self._put(jti, to_epoch(expires_at))
+            self._evict_expired()
+            # The next sync reads back a bit, so rows committed late by other workers are not missed
+            self._synced_until = now - timedelta(seconds=self.sync_seconds)
+            self._synced_at = time.monotonic()
+
+    def _put(self, jti: str, expires_at: float) -> None:
+        if self._entries.get(jti) != expires_at:
+            self._entries[jti] = expires_at
+            heapq.heappush(self._expiries, (expires_at, jti))
+
+    def _evict_expired(self) -> None:
+        """
+        Drops the entries of the expired tokens, the caller holds the lock.
+        """
+        now = time.time()
+        while self._expiries and self._expiries[0][0] < now:
+            expires_at, jti = heapq.heappop(self._expiries)
+            # A jti revoked again with a later expiry has a newer heap item
+            if self._entries.get(jti) == expires_at:
+                del self._entries[jti]
+
+
+def to_epoch(utc_datetime: datetime) -> float:
+    return (utc_datetime - datetime(1970, 1, 1)).total_seconds()
+
+
+revocation_list = RevocationList(sync_seconds=constants.REVOCATION_SYNC_SECONDS)
+
+
+def revoke_token(jti: str, expires_at: float, db: Session) -> None:
+    """
+    Revokes an access token until it expires.
+    :param jti: jti claim of the token
+    :param expires_at: exp claim of the token (epoch seconds)
+    :param db: app session
+    """
+    revocation_list.add(jti, expires_at)
+    now = datetime.utcnow()
+    # Rows of the expired tokens are not needed any more
+    db.execute(delete(DBRevokedToken).where(DBRevokedToken.expires_at < now))
+    db.merge(
+        DBRevokedToken(
+            jti=jti, expires_at=datetime.utcfromtimestamp(expires_at), revoked_at=now
+        )
+    )
+    db.commit()
+
+
+def is_token_revoked(jti: str, db: Session) -> bool:
+    return revocation_list.is_revoked(jti, db)
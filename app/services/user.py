@@ -1,20 +1,43 @@
-import os
-import shutil
-from pathlib import Path as pathlibPath
+from typing import Optional
 
 from fastapi import UploadFile, status
 from fastapi.exceptions import HTTPException
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import select
 
 from app.models.user import DBUser
-from app.schemas.enums import LoginMethod, UserType
+from app.schemas.enums import (
+    LoginMethod,
+    PictureOwner,
+    TotalCountType,
+    UserType,
+)
 from app.schemas.user import UserProfileForm
 from app.services import address as address_service
+from app.services.image_processing import (
+    add_picture,
+    delete_pictures,
+    get_pictures,
+    image_processor,
+    picture_display,
+    picture_url,
+)
+from app.services.principal import (
+    Principal,
+    invalidate_principal,
+    principal_cache,
+    snapshot_user,
+)
 from app.utils import constants
 from app.utils.constants import PROFILE_PICTURES_PATH, DEFAULT_PROFILE_PICTURE_FILE
 from app.utils.logger import logger
+from app.utils.pagination import (
+    decode_cursor,
+    encode_cursor,
+    get_total_counts,
+    keyset_filter,
+)
 from app.utils.hash import Hash
 from app.utils.service_response import ServiceResponse, ServiceResponseStatus
 
@@ -36,12 +59,40 @@ def get_user_by_id(user_id: int, db: Session):
 
 
 def get_user_by_email(email: str, db):
-    return (
-        db.query(DBUser).filter(func.lower(DBUser.email) == func.lower(email)).first()
-    )
+    if not email:
+        return None
+    # Case insensitive lookup on the indexed lowercase copy of the email
+    return db.query(DBUser).filter(DBUser.email_lower == email.lower()).first()
+
+
+def get_principal(email: str, db: Session) -> Optional[Principal]:
+    """
+    Returns the authenticated user and its profile status from the principal cache, loads it on a miss.
+    :param email: Subject (username) of the access token
+    :param db: app session
+    :return: Principal with a detached copy of the user, None if there is no such user
+    """
+    key = email.lower()
+    principal = principal_cache.get(key)
+    if principal is None:
+        user = get_user_by_email(email, db)
+        if not user:
+            return None
+        principal = Principal(
+            user=snapshot_user(user),
+            profile_complete=is_user_profile_complete(user.id, db),
+        )
+        principal_cache.set(key, principal)
+    return principal
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 20):
+def get_users(
+        db: Session,
+        skip: int = 0,
+        limit: int = 20,
+        cursor: str = None,
+        include_total: TotalCountType = TotalCountType.EXACT,
+):
     limit = min(limit, constants.QUERY_LIMIT_MAX)
     if skip < 0 or limit < 0:
         return ServiceResponse(
@@ -49,26 +100,37 @@ def get_users(db: Session, skip: int = 0, limit: int = 20):
             message="Skip and limit must be positive integers",
             data=None
         )
-    total = db.query(func.count(DBUser.id)).scalar()
-    users = db.query(DBUser).offset(skip).limit(limit).all()
+    total = get_total_counts(db, include_total, ("users",), select(DBUser.id))
+    query = db.query(DBUser).order_by(DBUser.id)
+    if cursor:
+        # Keyset pagination: continue after the last user of the previous page
+        _, last_id = decode_cursor(cursor)
+        query = query.filter(keyset_filter(None, DBUser.id, None, last_id, False))
+    else:
+        query = query.offset(skip)
+    users = query.limit(limit).all()
+    # limit=0 returns an empty page without a next page
+    has_next = limit > 0 and len(users) == limit
     return ServiceResponse(
         status=ServiceResponseStatus.SUCCESS,
         message="",
         data={
-            "current_offset": skip,
+            "current_offset": None if cursor else skip,
             "counts": len(users),
-            "total_counts": total,
-            "next_offset": (skip + limit) if len(users) == limit else None,
+            **total.fields(),
+            "next_offset": (skip + limit) if has_next and not cursor else None,
+            "next_cursor": encode_cursor(None, users[-1].id) if has_next else None,
             "users": users,
         }
     )
 
 
-def create_new_user(email: str, password: str, signup_method: LoginMethod, user_type: UserType, is_verified: bool, db:Session):
+def create_new_user(email: str, password_hash: str, signup_method: LoginMethod, user_type: UserType, is_verified: bool, db:Session):
+    # The password is hashed by the caller (Hash.bcrypt_async), so the hashing does not hold a request thread
     try:
         user = DBUser(
             email=email,
-            password=Hash.bcrypt(password),
+            password=password_hash,
             login_method=LoginMethod.EMAIL,
             user_type=UserType.USER,
             is_verified=True,
@@ -127,6 +189,7 @@ def modify_user(user_id: int, user_profile: UserProfileForm, db: Session):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while updating the car: {str(exc)}",
         )
+    invalidate_principal(db_user.email)
 
     # Check if address needs to be updated
     if user_profile.address:
@@ -138,24 +201,12 @@ def modify_user(user_id: int, user_profile: UserProfileForm, db: Session):
     return db_user
 
 
-def get_picture_name_and_path(user_id: int):
-    current_dir = pathlibPath(os.path.dirname(__file__)).as_posix()
-    pictures_path = (
-            current_dir[: current_dir.rindex("/")] + "/static/images/profile-pictures"
-    )
-    file_name_no_ext = f"user_{(str(user_id)):0>6}"
-    files = list(
-        filter(
-            lambda x: x.find(file_name_no_ext) != -1,
-            [f for f in os.listdir(pictures_path)],
-        )
-    )
-    return files, file_name_no_ext, pictures_path
+def get_profile_picture(user_id: int, db: Session):
+    pictures = get_pictures(db, PictureOwner.USER, user_id)
+    return pictures[0] if pictures else None
 
 
-def upload_user_profile_picture(picture: UploadFile, user_id: int):
-    current_files, file_name_no_ext, pictures_path = get_picture_name_and_path(user_id)
-    _, upload_file_ext = os.path.splitext(picture.filename)
+def upload_user_profile_picture(picture: UploadFile, user_id: int, db: Session):
     allowed_types = ["image/jpeg", "image/png", "image/bmp", "image/webp"]
     if picture.content_type not in allowed_types:
         raise HTTPException(
@@ -163,34 +214,47 @@ def upload_user_profile_picture(picture: UploadFile, user_id: int):
             detail=f"Invalid file type. "
                    f"Only {', '.join(list(map(lambda t: t.replace('image/', '').upper(), allowed_types)))} types are allowed.",
         )
-    for f in current_files:
-        os.remove(f"{pictures_path}/{f}")
-    with open(f"{pictures_path}/{file_name_no_ext}.{upload_file_ext}", "w+b") as buffer:
-        shutil.copyfileobj(picture.file, buffer)
+    image_processor.admit()
+    # Replaces the previous picture, the picture is optimized in the background
+    db_picture = add_picture(
+        db,
+        PictureOwner.USER,
+        user_id,
+        picture.file,
+        picture.filename,
+        picture.content_type,
+        replace=True,
+    )
     return {
-        "file-name": f"{file_name_no_ext}.{upload_file_ext}",
+        "file-name": db_picture.file_name,
         "file-type": picture.content_type,
+        "status": db_picture.blob.status,
     }
 
 
+def get_profile_picture_status(user_id: int, db: Session):
+    db_picture = get_profile_picture(user_id, db)
+    if db_picture is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User has no profile picture"
+        )
+    return picture_display(db_picture)
+
+
 def get_profile_picture_link(user_id: int, db):
     # Check if user exist (get_user_by_id raises exception if the user does not exist)
     get_user_by_id(user_id, db)
-    current_files, _, _ = get_picture_name_and_path(user_id)
-    profile_picture_file = (
-        DEFAULT_PROFILE_PICTURE_FILE if len(current_files) == 0 else current_files[0]
-    )
-    return f"static/{PROFILE_PICTURES_PATH}/{profile_picture_file}"
+    db_picture = get_profile_picture(user_id, db)
+    if db_picture is None:
+        return f"static/{PROFILE_PICTURES_PATH}/{DEFAULT_PROFILE_PICTURE_FILE}"
+    return picture_url(db_picture).lstrip("/")
 
 
 def delete_profile_picture(user_id: int, db):
-    current_files, file_name_no_ext, pictures_path = get_picture_name_and_path(user_id)
-    if len(current_files) == 0:
+    if not delete_pictures(db, PictureOwner.USER, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User has no profile picture"
         )
-    for f in current_files:
-        os.remove(f"{pictures_path}/{f}")
     return "deleted"
 
 
@@ -201,8 +265,11 @@ def delete_user(user_id: int, db: Session):
             status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist."
         )
 
+    email = user.email
     db.delete(user)
     db.commit()
+    invalidate_principal(email)
+    delete_pictures(db, PictureOwner.USER, user_id)
     return "Deleted"
 
 
@@ -233,9 +300,17 @@ def change_password(user_id: int, new_password: str, db: Session):
     user.password = Hash.bcrypt(new_password.strip())
     db.commit()
     db.flush(user)
+    invalidate_principal(user.email)
     return {"user_id": user.id, "result": "Password is changed"}
 
 
+def update_password_hash(user: DBUser, password_hash: str, db: Session):
+    # Saves a password hash recreated on login (the password itself is not changed)
+    user.password = password_hash
+    db.commit()
+    invalidate_principal(user.email)
+
+
 def get_user_rentals(user_id: int, db: Session):
     user: DBUser = db.query(DBUser).filter(DBUser.id == user_id).all()
     return user.rentals
@@ -1,12 +1,15 @@
 import datetime
 
+from sqlalchemy import delete, select, update
 from sqlalchemy.orm import Session
 
+from app.auth.oauth2 import refresh_token_digest
 from app.models.refresh_token import DBRefreshToken
 from app.models.user import DBUser
 from app.schemas.enums import LoginMethod, UserType
 from app.services import user as user_service
-
+from app.services.principal import invalidate_principal
+from app.utils.constants import MAX_SESSIONS_PER_USER, REFRESH_TOKEN_EXPIRE_DAYS
 from app.utils.hash import Hash
 
 
@@ -46,27 +49,89 @@ def reset_change_password(email: str, password: str, db: Session):
     user.password = Hash.bcrypt(password.strip())
     db.commit()
     db.refresh(user)
+    invalidate_principal(user.email)
     return {
         "result": True,
         "message": "Your password has been successfully changed. Please proceed to login.",
     }
 
 
-def save_refresh_token(user_email: str, token: str, db: Session):
-    if db.query(DBRefreshToken).filter(DBRefreshToken.email == user_email).first():
-        return False
-    new_token = DBRefreshToken()
-    new_token.email = user_email
-    new_token.token = Hash.bcrypt(token)
+def save_refresh_token(user_email: str, token: str, session_id: str, db: Session):
+    """
+    Stores a new session of the user. Expired sessions of the user and the oldest sessions above
+    MAX_SESSIONS_PER_USER are removed in the same transaction.
+    :param user_email: Email of the user
+    :param token: New refresh token
+    :param session_id: Id of the session (sid claim of its tokens)
+    :param db: app session
+    """
+    now = datetime.datetime.utcnow()
+    db.execute(
+        delete(DBRefreshToken).where(
+            DBRefreshToken.email == user_email, DBRefreshToken.expires_at < now
+        )
+    )
+    kept_sessions = (
+        select(DBRefreshToken.id)
+        .where(DBRefreshToken.email == user_email)
+        .order_by(DBRefreshToken.created_at.desc(), DBRefreshToken.id.desc())
+        .limit(MAX_SESSIONS_PER_USER - 1)
+    )
+    db.execute(
+        delete(DBRefreshToken).where(
+            DBRefreshToken.email == user_email,
+            DBRefreshToken.id.not_in(kept_sessions),
+        )
+    )
+    new_token = DBRefreshToken(
+        token_digest=refresh_token_digest(token),
+        session_id=session_id,
+        email=user_email,
+        created_at=now,
+        expires_at=now + datetime.timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
     db.add(new_token)
     db.commit()
-    db.refresh(new_token)
-
     return new_token
 
 
-def revoke_refresh_token(user_email: str, db: Session):
-    token = db.query(DBRefreshToken).filter(DBRefreshToken.email == user_email).first()
-    if token:
-        db.delete(token)
-        db.commit()
+def rotate_refresh_token(
+    user_email: str, old_token: str, new_token: str, session_id: str, db: Session
+):
+    """
+    Replaces the refresh token of a session with a single update. If the old token was revoked or
+    already rotated, nothing is updated.
+    :param user_email: Email of the user
+    :param old_token: Refresh token sent by the client
+    :param new_token: Refresh token replacing it
+    :param session_id: Id of the session (sid claim of the new tokens)
+    :param db: app session
+    :return: True if the session was found and rotated
+    """
+    now = datetime.datetime.utcnow()
+    result = db.execute(
+        update(DBRefreshToken)
+        .where(
+            DBRefreshToken.token_digest == refresh_token_digest(old_token),
+            DBRefreshToken.email == user_email,
+        )
+        .values(
+            token_digest=refresh_token_digest(new_token),
+            session_id=session_id,
+            created_at=now,
+            expires_at=now + datetime.timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        )
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def revoke_refresh_token(user_email: str, db: Session, session_id: str = None):
+    """
+    Deletes a session of the user (if the session id is given) or all sessions of the user.
+    """
+    statement = delete(DBRefreshToken).where(DBRefreshToken.email == user_email)
+    if session_id:
+        statement = statement.where(DBRefreshToken.session_id == session_id)
+    db.execute(statement)
+    db.commit()
@@ -0,0 +1,240 @@
+"""
+Async endpoint benchmark
+
+Serves the car search and the car details twice, once from sync handlers (sync Session, one thread of
+Starlette's threadpool per request) and once from async handlers (AsyncSession of core/database.py),
+and sends the same requests to both with many concurrent clients. Prints the requests per second and the
+latency percentiles per endpoint and handler type.
+
+Usage:
+    python -m app.tests.benchmarks.async_endpoints --concurrency 64 --requests 2000
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+from random import randint, uniform
+from statistics import quantiles
+from time import perf_counter
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.core.database import Base, create_async_db_engine, create_db_engine
+from app.models import (
+    favorites,  # noqa: F401
+    picture,  # noqa: F401
+    refresh_token,  # noqa: F401
+    review,  # noqa: F401
+    user_rating_stats,  # noqa: F401
+)
+from app.models.address import DBAddress
+from app.models.car import DBCar
+from app.models.user import DBUser
+from app.schemas.car import CarDisplay
+from app.schemas.enums import LoginMethod, TotalCountType, UserType
+from app.schemas.rental import RentalPeriod
+from app.services import car
+
+NUMBER_OF_USERS = 2000
+NUMBER_OF_CARS = 5000
+
+
+def prepare_db(url: str):
+    engine = create_db_engine(url)
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.execute(
+            insert(DBUser),
+            [
+                {
+                    "id": i,
+                    "email": f"user_{i}@example.com",
+                    "login_method": LoginMethod.EMAIL,
+                    "user_type": UserType.USER,
+                    "is_verified": True,
+                }
+                for i in range(1, NUMBER_OF_USERS + 1)
+            ],
+        )
+        db.execute(
+            insert(DBAddress),
+            [
+                {
+                    "user_id": i,
+                    "city": "Eindhoven",
+                    "latitude": uniform(50.5, 53.5),
+                    "longitude": uniform(3.5, 7.0),
+                }
+                for i in range(1, NUMBER_OF_USERS + 1)
+            ],
+        )
+        db.execute(
+            insert(DBCar),
+            [
+                {
+                    "id": i,
+                    "owner_id": randint(1, NUMBER_OF_USERS),
+                    "make": "Audi",
+                    "model": "A4",
+                    "year": 2020,
+                    "transmission_type": "AUTOMATIC",
+                    "motor_type": "DIESEL",
+                    "price_per_day": randint(20, 200),
+                }
+                for i in range(1, NUMBER_OF_CARS + 1)
+            ],
+        )
+        db.commit()
+    engine.dispose()
+
+
+def search_arguments(params: dict) -> dict:
+    return {
+        "distance_km": params["distance_km"],
+        "renter_lat": params["renter_lat"],
+        "renter_lon": params["renter_lon"],
+        "availability_period": RentalPeriod(start_date=None, end_date=None),
+        "search_in_city": None,
+        "engine_type": None,
+        "transmission_type": None,
+        "price_min": None,
+        "price_max": None,
+        "make": None,
+        "sort": "DISTANCE",
+        "sort_direction": None,
+        "skip": 0,
+        "limit": 20,
+        "include_total": TotalCountType.NONE,
+    }
+
+
+def create_app(url: str) -> FastAPI:
+    engine = create_db_engine(url)
+    async_engine = create_async_db_engine(url)
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_session_local = async_sessionmaker(
+        bind=async_engine, autoflush=False, expire_on_commit=False
+    )
+
+    def get_db():
+        with session_local() as db:
+            yield db
+
+    async def get_async_db():
+        async with async_session_local() as db:
+            yield db
+
+    app = FastAPI()
+
+    @app.get("/sync/cars")
+    def sync_search(
+        distance_km: float,
+        renter_lat: float,
+        renter_lon: float,
+        db: Session = Depends(get_db),
+    ):
+        arguments = search_arguments(locals())
+        return car.search_cars(db=db, **arguments)["counts"]
+
+    @app.get("/async/cars")
+    async def async_search(
+        distance_km: float,
+        renter_lat: float,
+        renter_lon: float,
+        db: AsyncSession = Depends(get_async_db),
+    ):
+        arguments = search_arguments(locals())
+        return (await car.search_cars_async(db=db, **arguments))["counts"]
+
+    # Same response model as GET /cars/{car_id} (the sync handler loads the relationships lazily)
+    @app.get("/sync/cars/{car_id}", response_model=CarDisplay)
+    def sync_get_car(car_id: int, db: Session = Depends(get_db)):
+        return car.get_car(db, car_id)
+
+    @app.get("/async/cars/{car_id}", response_model=CarDisplay)
+    async def async_get_car(car_id: int, db: AsyncSession = Depends(get_async_db)):
+        return await car.get_car_async(db, car_id)
+
+    return app
+
+
+def request_path(endpoint: str, mode: str) -> str:
+    if endpoint == "search":
+        return (
+            f"/{mode}/cars?distance_km=50&renter_lat={uniform(51, 53):.4f}"
+            f"&renter_lon={uniform(4, 6.5):.4f}"
+        )
+    return f"/{mode}/cars/{randint(1, NUMBER_OF_CARS)}"
+
+
+async def run(app: FastAPI, endpoint: str, mode: str, concurrency: int, requests: int):
+    # Errors of the app (e.g. pool timeouts) are counted as failed requests
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://benchmark"
+    ) as client:
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                started = perf_counter()
+                response = await client.get(request_path(endpoint, mode))
+                if response.status_code == 200:
+                    latencies.append(perf_counter() - started)
+                else:
+                    errors += 1
+
+        started = perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def percentiles_ms(values):
+    if len(values) < 2:
+        return "-"
+    cuts = quantiles(values, n=100)
+    return f"p50 {cuts[49] * 1000:.1f} / p95 {cuts[94] * 1000:.1f} / p99 {cuts[98] * 1000:.1f} ms"
+
+
+async def run_all(app: FastAPI, endpoints, concurrency: int, requests: int):
+    # One event loop for all runs, the connections of the async pool belong to it
+    for endpoint in endpoints:
+        for mode in ("sync", "async"):
+            latencies, errors, elapsed = await run(
+                app, endpoint, mode, concurrency, requests
+            )
+            print(
+                f"{endpoint} ({mode}): {len(latencies) / elapsed:.0f} req/sec "
+                f"({len(latencies)} requests, {errors} errors, concurrency {concurrency})"
+            )
+            print(f"  latency: {percentiles_ms(latencies)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--endpoints", nargs="+", default=["search", "car"], choices=["search", "car"]
+    )
+    args = parser.parse_args()
+
+    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'async_benchmark.db')}"
+    prepare_db(url)
+    asyncio.run(
+        run_all(create_app(url), args.endpoints, args.concurrency, args.requests)
+    )
+
+
+if __name__ == "__main__":
+    main()
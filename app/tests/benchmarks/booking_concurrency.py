@@ -0,0 +1,158 @@
+"""
+Booking concurrency benchmark
+
+Many threads (optionally in several processes) book random periods of the same car at the same time through
+services/rental.create_rental. At the end the stored rentals are checked for overlaps (double bookings).
+
+Usage:
+    python -m app.tests.benchmarks.booking_concurrency --processes 4 --threads 8 --requests 100
+"""
+
+import argparse
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from random import randint
+from time import time
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import sessionmaker
+
+from app.core.database import Base
+from app.models import address, favorites, refresh_token, review, user_rating_stats  # noqa: F401
+from app.models.car import DBCar
+from app.models.user import DBUser
+from app.schemas.enums import LoginMethod, UserType
+from app.schemas.rental import RentalPeriod
+from app.services import rental as rental_service
+
+CAR_ID = 1
+OWNER_ID = 1
+
+OVERLAPS_QUERY = (
+    "SELECT count(*) FROM rentals a JOIN rentals b ON a.car_id = b.car_id AND a.id < b.id "
+    "AND a.start_date <= b.end_date AND a.end_date >= b.start_date"
+)
+
+
+def create_engine_for(db_path: str):
+    return create_engine(
+        f"sqlite:///{db_path}", connect_args={"check_same_thread": False, "timeout": 30}
+    )
+
+
+def prepare_db(db_path: str, number_of_renters: int):
+    engine = create_engine_for(db_path)
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.execute(
+            insert(DBUser),
+            [
+                {
+                    "id": i,
+                    "email": f"user_{i}@example.com",
+                    "login_method": LoginMethod.EMAIL,
+                    "user_type": UserType.USER,
+                    "is_verified": True,
+                }
+                for i in range(1, number_of_renters + 2)
+            ],
+        )
+        db.execute(
+            insert(DBCar),
+            [
+                {
+                    "id": CAR_ID,
+                    "owner_id": OWNER_ID,
+                    "make": "Audi",
+                    "model": "A4",
+                    "year": 2020,
+                    "transmission_type": "AUTOMATIC",
+                    "motor_type": "DIESEL",
+                    "price_per_day": 100,
+                }
+            ],
+        )
+        db.commit()
+    engine.dispose()
+
+
+def book(session_factory, horizon_days: int) -> str:
+    start = datetime.now() + timedelta(days=randint(1, horizon_days))
+    period = RentalPeriod(
+        start_date=start, end_date=start + timedelta(days=randint(1, 7))
+    )
+    renter_id = randint(OWNER_ID + 1, OWNER_ID + 50)
+    db = session_factory()
+    try:
+        rental_service.create_rental(db, CAR_ID, period, renter_id)
+        return "booked"
+    except HTTPException as exc:
+        return "rejected" if exc.status_code == 404 else "error"
+    finally:
+        db.close()
+
+
+def run_worker(args) -> dict:
+    db_path, threads, requests_per_thread, horizon_days = args
+    engine = create_engine_for(db_path)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    results = {"booked": 0, "rejected": 0, "error": 0}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for result in executor.map(
+            lambda _: book(session_factory, horizon_days),
+            range(threads * requests_per_thread),
+        ):
+            results[result] += 1
+    engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="Requests per thread")
+    parser.add_argument("--horizon-days", type=int, default=365)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "booking_benchmark.db")
+    prepare_db(db_path, 50)
+
+    start_time = time()
+    with Pool(args.processes) as pool:
+        worker_results = pool.map(
+            run_worker,
+            [(db_path, args.threads, args.requests, args.horizon_days)]
+            * args.processes,
+        )
+    elapsed = time() - start_time
+
+    totals = {"booked": 0, "rejected": 0, "error": 0}
+    for worker_result in worker_results:
+        for key, value in worker_result.items():
+            totals[key] += value
+    engine = create_engine_for(db_path)
+    with engine.connect() as connection:
+        stored = connection.execute(text("SELECT count(*) FROM rentals")).scalar()
+        overlaps = connection.execute(text(OVERLAPS_QUERY)).scalar()
+    engine.dispose()
+
+    attempts = sum(totals.values())
+    print(
+        f"{attempts} booking attempts ({args.processes} processes x {args.threads} threads) "
+        f"in {elapsed:.2f} sec. ({attempts / elapsed:.0f} req/sec)"
+    )
+    print(
+        f"booked: {totals['booked']}, rejected: {totals['rejected']}, errors: {totals['error']}"
+    )
+    print(f"stored rentals: {stored}, double bookings: {overlaps}")
+    if overlaps or stored != totals["booked"]:
+        raise SystemExit("Double booking detected")
+
+
+if __name__ == "__main__":
+    main()
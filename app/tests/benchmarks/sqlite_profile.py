@@ -0,0 +1,198 @@
+"""
+SQLite profile benchmark
+
+Runs the same mixed read/write traffic against a fresh database with each SQLite profile of
+core/database.py (e.g. "default" before and "production" after). Readers count the rentals of a random car
+overlapping a random period, writers add a rental and commit. Prints the throughput, the latency
+percentiles and the number of "database is locked" errors per profile.
+
+Usage:
+    python -m app.tests.benchmarks.sqlite_profile --threads 16 --seconds 10 --write-ratio 0.2
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+from datetime import date, timedelta
+from random import randint, random
+from statistics import quantiles
+from time import perf_counter
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.core.database import SQLITE_PROFILES, Base, create_db_engine
+from app.models import (
+    address,  # noqa: F401
+    favorites,  # noqa: F401
+    picture,  # noqa: F401
+    refresh_token,  # noqa: F401
+    review,  # noqa: F401
+    user_rating_stats,  # noqa: F401
+)
+from app.models.car import DBCar
+from app.models.rental import DBRental
+from app.models.user import DBUser
+from app.schemas.enums import LoginMethod, UserType
+from app.services.availability import overlap_filter
+
+NUMBER_OF_USERS = 1000
+NUMBER_OF_CARS = 1000
+NUMBER_OF_RENTALS = 20000
+
+
+def prepare_db(url: str):
+    engine = create_db_engine(url, "default")
+    Base.metadata.create_all(engine)
+    today = date.today()
+    with sessionmaker(bind=engine)() as db:
+        db.execute(
+            insert(DBUser),
+            [
+                {
+                    "id": i,
+                    "email": f"user_{i}@example.com",
+                    "login_method": LoginMethod.EMAIL,
+                    "user_type": UserType.USER,
+                    "is_verified": True,
+                }
+                for i in range(1, NUMBER_OF_USERS + 1)
+            ],
+        )
+        db.execute(
+            insert(DBCar),
+            [
+                {
+                    "id": i,
+                    "owner_id": randint(1, NUMBER_OF_USERS),
+                    "make": "Audi",
+                    "model": "A4",
+                    "year": 2020,
+                    "transmission_type": "AUTOMATIC",
+                    "motor_type": "DIESEL",
+                    "price_per_day": 100,
+                }
+                for i in range(1, NUMBER_OF_CARS + 1)
+            ],
+        )
+        rentals = []
+        for _ in range(NUMBER_OF_RENTALS):
+            start = today + timedelta(days=randint(-365, 365))
+            rentals.append(
+                {
+                    "car_id": randint(1, NUMBER_OF_CARS),
+                    "renter_id": randint(1, NUMBER_OF_USERS),
+                    "start_date": start,
+                    "end_date": start + timedelta(days=randint(1, 14)),
+                    "total_price": 100,
+                }
+            )
+        db.execute(insert(DBRental), rentals)
+        db.commit()
+    engine.dispose()
+
+
+def read(db):
+    start = date.today() + timedelta(days=randint(0, 365))
+    db.execute(
+        select(func.count(DBRental.id)).where(
+            DBRental.car_id == randint(1, NUMBER_OF_CARS),
+            overlap_filter(start, start + timedelta(days=7)),
+        )
+    ).scalar()
+
+
+def write(db):
+    start = date.today() + timedelta(days=randint(0, 365))
+    db.add(
+        DBRental(
+            car_id=randint(1, NUMBER_OF_CARS),
+            renter_id=randint(1, NUMBER_OF_USERS),
+            start_date=start,
+            end_date=start + timedelta(days=randint(1, 14)),
+            total_price=100,
+        )
+    )
+    db.commit()
+
+
+def run_client(session_factory, deadline, write_ratio, results, lock):
+    latencies = {"read": [], "write": []}
+    errors = 0
+    while perf_counter() < deadline:
+        operation = "write" if random() < write_ratio else "read"
+        db = session_factory()
+        started = perf_counter()
+        try:
+            (write if operation == "write" else read)(db)
+            latencies[operation].append(perf_counter() - started)
+        except OperationalError:
+            db.rollback()
+            errors += 1
+        finally:
+            db.close()
+    with lock:
+        for operation, values in latencies.items():
+            results[operation].extend(values)
+        results["errors"] += errors
+
+
+def run_profile(profile: str, threads: int, seconds: float, write_ratio: float):
+    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'sqlite_benchmark.db')}"
+    prepare_db(url)
+    engine = create_db_engine(url, profile)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    results = {"read": [], "write": [], "errors": 0}
+    lock = threading.Lock()
+    deadline = perf_counter() + seconds
+    clients = [
+        threading.Thread(
+            target=run_client,
+            args=(session_factory, deadline, write_ratio, results, lock),
+        )
+        for _ in range(threads)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    engine.dispose()
+    return results
+
+
+def percentiles_ms(values):
+    if len(values) < 2:
+        return "-"
+    cuts = quantiles(values, n=100)
+    return f"p50 {cuts[49] * 1000:.1f} / p95 {cuts[94] * 1000:.1f} / p99 {cuts[98] * 1000:.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=["default", "production"],
+        choices=SQLITE_PROFILES,
+    )
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        results = run_profile(profile, args.threads, args.seconds, args.write_ratio)
+        operations = len(results["read"]) + len(results["write"])
+        print(
+            f"{profile}: {operations / args.seconds:.0f} ops/sec "
+            f"({len(results['read'])} reads, {len(results['write'])} writes, "
+            f"{results['errors']} 'database is locked' errors)"
+        )
+        print(f"  reads:  {percentiles_ms(results['read'])}")
+        print(f"  writes: {percentiles_ms(results['write'])}")
+
+
+if __name__ == "__main__":
+    main()
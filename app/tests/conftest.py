@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.core.database import Base, create_db_engine
+from app.models import (
+    address,  # noqa: F401
+    car,  # noqa: F401
+    favorites,  # noqa: F401
+    geocode,  # noqa: F401
+    picture,  # noqa: F401
+    refresh_token,  # noqa: F401
+    rental,  # noqa: F401
+    review,  # noqa: F401
+    revoked_token,  # noqa: F401
+    user,  # noqa: F401
+    user_rating_stats,  # noqa: F401
+)
+
+
+@pytest.fixture
+def db_engine(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(db_engine):
+    with sessionmaker(bind=db_engine)() as session:
+        yield session
@@ -0,0 +1,41 @@
+from datetime import date, timedelta
+from random import Random
+
+from app.services.availability import CarIntervals
+
+
+def test_overlapping_returns_an_overlapping_rental():
+    intervals = CarIntervals(
+        [
+            (date(2030, 1, 1), date(2030, 1, 20), 1),
+            (date(2030, 1, 5), date(2030, 1, 6), 2),
+            (date(2030, 1, 8), date(2030, 1, 9), 3),
+        ]
+    )
+
+    assert intervals.overlapping(date(2030, 1, 10), date(2030, 1, 12)) == 1
+    assert intervals.overlapping(date(2030, 1, 21), date(2030, 1, 25)) is None
+    assert intervals.overlapping(date(2029, 12, 1), date(2029, 12, 31)) is None
+
+
+def test_overlapping_matches_a_linear_scan():
+    random = Random(0)
+    first_day = date(2030, 1, 1)
+    periods = []
+    for rental_id in range(200):
+        start = first_day + timedelta(days=random.randint(0, 365))
+        periods.append(
+            (start, start + timedelta(days=random.randint(0, 30)), rental_id)
+        )
+    intervals = CarIntervals(periods)
+
+    for _ in range(500):
+        start = first_day + timedelta(days=random.randint(-30, 400))
+        end = start + timedelta(days=random.randint(0, 10))
+        overlapping = {
+            rental_id
+            for period_start, period_end, rental_id in periods
+            if period_start <= end and period_end >= start
+        }
+        result = intervals.overlapping(start, end)
+        assert result in overlapping if overlapping else result is None
@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from app.services import image_processing
+from app.services.image_processing import ImageProcessor, PictureRecovery
+
+
+def test_admit_reserves_a_slot():
+    image_processor = ImageProcessor(workers=1, max_pending=2, use_processes=False)
+    image_processor.admit()
+    image_processor.admit()
+
+    with pytest.raises(HTTPException) as exc_info:
+        image_processor.admit()
+    assert exc_info.value.status_code == 503
+
+    image_processor.release()
+    image_processor.admit()
+
+
+def test_admit_without_limit():
+    image_processor = ImageProcessor(workers=1, max_pending=1, use_processes=False)
+    image_processor.admit()
+    image_processor.admit(enforce_limit=False)
+
+    with pytest.raises(HTTPException):
+        image_processor.admit()
+
+
+def test_picture_recovery_runs_periodically(monkeypatch):
+    calls = []
+    resumed_again = threading.Event()
+
+    def resume_unfinished_pictures():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        resumed_again.set()
+
+    monkeypatch.setattr(
+        image_processing, "resume_unfinished_pictures", resume_unfinished_pictures
+    )
+    picture_recovery = PictureRecovery(interval_seconds=0.01)
+    picture_recovery.start()
+
+    # A failed sweep does not stop the next ones
+    assert resumed_again.wait(5)
+    picture_recovery.stop()
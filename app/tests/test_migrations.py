@@ -0,0 +1,151 @@
+import pytest
+from alembic import command
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, text
+
+from app.core.database import (
+    ALEMBIC_CONFIG_FILE,
+    Base,
+    create_db_engine,
+    upgrade_database,
+)
+
+
+def head_revision() -> str:
+    return ScriptDirectory.from_config(
+        Config(str(ALEMBIC_CONFIG_FILE))
+    ).get_current_head()
+
+
+def current_revision(db_engine) -> str:
+    with db_engine.connect() as connection:
+        return connection.execute(
+            text("SELECT version_num FROM alembic_version")
+        ).scalar()
+
+
+def test_new_database_is_stamped(tmp_path):
+    db_engine = create_db_engine(f"sqlite:///{tmp_path / 'new.db'}")
+    upgrade_database(db_engine)
+
+    assert current_revision(db_engine) == head_revision()
+    assert set(Base.metadata.tables) <= set(inspect(db_engine).get_table_names())
+    assert "addresses_rtree" in inspect(db_engine).get_table_names()
+
+
+def test_revisions_apply_to_a_database_created_by_the_models(db_engine):
+    # The revisions skip the objects create_all already made
+    config = Config(str(ALEMBIC_CONFIG_FILE))
+    with db_engine.connect() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, "head")
+
+    assert current_revision(db_engine) == head_revision()
+    upgrade_database(db_engine)
+    assert current_revision(db_engine) == head_revision()
+
+
+# users, addresses and refresh_token tables of the first version of the app (before the revisions)
+BASELINE_SCHEMA = [
+    "CREATE TABLE users (id INTEGER NOT NULL, name VARCHAR, last_name VARCHAR, email VARCHAR, "
+    "password VARCHAR, login_method VARCHAR(8), phone_number VARCHAR, user_type VARCHAR(5), "
+    "is_verified BOOLEAN, created_at DATETIME, last_login DATETIME, is_profile_completed BOOLEAN, "
+    "PRIMARY KEY (id))",
+    "CREATE UNIQUE INDEX ix_users_email ON users (email)",
+    "CREATE TABLE addresses (id INTEGER NOT NULL, user_id INTEGER, street VARCHAR, number VARCHAR, "
+    "postal_code VARCHAR, city VARCHAR, state VARCHAR, country VARCHAR, latitude FLOAT, longitude FLOAT, "
+    "is_address_confirmed BOOLEAN, created_at DATETIME, PRIMARY KEY (id), UNIQUE (user_id), "
+    "FOREIGN KEY(user_id) REFERENCES users (id))",
+    "CREATE TABLE refresh_token (email VARCHAR NOT NULL, token VARCHAR, created_at DATETIME, "
+    "PRIMARY KEY (email), UNIQUE (token))",
+    "INSERT INTO users (id, email) VALUES (1, 'Renter@Example.com'), (2, 'owner@example.com')",
+    "INSERT INTO addresses (id, user_id, city, latitude, longitude) "
+    "VALUES (1, 1, 'Eindhoven', 51.44, 5.47), (2, 2, 'Utrecht', NULL, NULL)",
+]
+
+
+def test_upgrade_of_a_database_created_before_the_revisions(tmp_path):
+    db_engine = create_db_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with db_engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+
+    upgrade_database(db_engine)
+
+    assert current_revision(db_engine) == head_revision()
+    assert set(Base.metadata.tables) <= set(inspect(db_engine).get_table_names())
+    with db_engine.connect() as connection:
+        # Addresses with coordinates are in the R*Tree index
+        assert connection.execute(text("SELECT id FROM addresses_rtree")).all() == [
+            (1,)
+        ]
+        assert connection.execute(
+            text("SELECT email_lower FROM users ORDER BY id")
+        ).scalars().all() == ["renter@example.com", "owner@example.com"]
+    email_lower_index = next(
+        index
+        for index in inspect(db_engine).get_indexes("users")
+        if index["name"] == "ix_users_email_lower"
+    )
+    assert email_lower_index["unique"]
+    # Replaced by the refresh_tokens table
+    assert "refresh_token" not in inspect(db_engine).get_table_names()
+    address_columns = {
+        column["name"] for column in inspect(db_engine).get_columns("addresses")
+    }
+    assert {
+        "geocode_status",
+        "geocode_attempts",
+        "geocode_next_attempt_at",
+    } <= address_columns
+
+
+def test_revisions_downgrade_and_upgrade_again(tmp_path):
+    db_engine = create_db_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with db_engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+    upgrade_database(db_engine)
+    config = Config(str(ALEMBIC_CONFIG_FILE))
+
+    with db_engine.connect() as connection:
+        config.attributes["connection"] = connection
+        command.downgrade(config, "base")
+        command.upgrade(config, "head")
+
+    assert current_revision(db_engine) == head_revision()
+
+
+def test_r_tree_is_kept_in_sync_after_a_downgrade_of_the_geocode_columns(tmp_path):
+    db_engine = create_db_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with db_engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+    upgrade_database(db_engine)
+    config = Config(str(ALEMBIC_CONFIG_FILE))
+
+    with db_engine.connect() as connection:
+        config.attributes["connection"] = connection
+        command.downgrade(config, "0003")
+    with db_engine.begin() as connection:
+        connection.execute(
+            text("UPDATE addresses SET latitude = 52.09, longitude = 5.12 WHERE id = 2")
+        )
+
+        assert connection.execute(
+            text("SELECT id FROM addresses_rtree ORDER BY id")
+        ).all() == [(1,), (2,)]
+
+
+def test_upgrade_stops_at_emails_differing_in_case(tmp_path):
+    db_engine = create_db_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with db_engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(
+            text("INSERT INTO users (id, email) VALUES (3, 'renter@example.com')")
+        )
+
+    with pytest.raises(RuntimeError, match="renter@example.com"):
+        upgrade_database(db_engine)
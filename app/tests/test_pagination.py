@@ -0,0 +1,43 @@
+from app.models.user import DBUser
+from app.schemas.enums import LoginMethod, UserType
+from app.services import rental, review, user
+
+
+def add_user(db) -> DBUser:
+    db_user = DBUser(
+        email="renter@example.com",
+        login_method=LoginMethod.EMAIL,
+        user_type=UserType.USER,
+        is_verified=True,
+    )
+    db.add(db_user)
+    db.commit()
+    return db_user
+
+
+def test_users_page_with_limit_zero(db):
+    add_user(db)
+
+    page = user.get_users(db, limit=0).data
+
+    assert page["users"] == []
+    assert page["next_offset"] is None
+    assert page["next_cursor"] is None
+
+
+def test_rentals_page_with_limit_zero(db):
+    page = rental.get_rentals(db, add_user(db), limit=0)
+
+    assert page["rentals"] == []
+    assert page["next_offset"] is None
+    assert page["next_cursor"] is None
+
+
+def test_reviews_page_with_limit_zero(db):
+    db_user = add_user(db)
+
+    page = review.get_views_by_user(db, db_user.id, db_user, limit=0)
+
+    assert page["reviews"] == []
+    assert page["next_offset"] is None
+    assert page["next_cursor"] is None
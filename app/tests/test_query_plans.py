@@ -0,0 +1,393 @@
+"""
+Query plan regression test
+
+Runs the service queries of the hot endpoints (car search, car details, rental lists, availability,
+reviews and favorites of a user) against a SQLite database with realistic table sizes and asks SQLite
+for the plan of every executed statement (EXPLAIN QUERY PLAN). Each case must use the indexes of the
+revisions in alembic/versions, and no plan may read one of the large tables without an index
+("SCAN <table>" without "USING ... INDEX").
+
+Usage:
+    pytest -v app/tests/test_query_plans.py
+"""
+
+import re
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from random import choice, randint, seed, uniform
+from typing import Callable, Iterator, List, Set, Tuple
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import event, insert, inspect, text
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.core.database import ALEMBIC_CONFIG_FILE, create_db_engine, upgrade_database
+from app.models.address import DBAddress
+from app.models.car import DBCar
+from app.models.favorites import DBFavorite
+from app.models.rental import DBRental
+from app.models.review import DBReview
+from app.models.user import DBUser
+from app.schemas.car import CarDisplay
+from app.schemas.enums import (
+    CarEngineType,
+    CarSearchSortType,
+    CarTransmissionType,
+    LoginMethod,
+    RentalSort,
+    SortDirection,
+    TotalCountType,
+    UserType,
+)
+from app.schemas.rental import RentalDisplay, RentalPeriod
+from app.services import car, favorites, rental, review
+from app.services.availability import availability_index
+
+NUMBER_OF_USERS = 2000
+NUMBER_OF_CARS = 3000
+NUMBER_OF_RENTALS = 20000
+NUMBER_OF_FAVORITES = 10000
+CITIES = ["Eindhoven", "Amsterdam", "Rotterdam", "Utrecht", "Den Haag", "Tilburg"]
+MAKES = ["Audi", "BMW", "Fiat", "Ford", "Opel", "Renault", "Toyota", "Volkswagen"]
+
+# Tables that grow with the usage of the app, reading them without an index is a regression
+LARGE_TABLES = {"users", "addresses", "cars", "rentals", "reviews", "favorites"}
+# Full scan of a table (SQLite 3.36+ prints "SCAN <table>", older versions "SCAN TABLE <table>")
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+# Index read by a step of a plan (the R*Tree of the addresses is a virtual table)
+USED_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)|^SCAN (\w+) VIRTUAL TABLE")
+
+
+def prepare_db(url: str):
+    engine = create_db_engine(url)
+    upgrade_database(engine)
+    # Only the indexes of the primary keys and unique constraints are kept from create_all, the others
+    # are created by the revisions, so the test fails if a revision misses an index
+    with engine.begin() as connection:
+        for table in LARGE_TABLES:
+            for index in inspect(connection).get_indexes(table):
+                if not index["unique"]:
+                    connection.execute(text(f"DROP INDEX {index['name']}"))
+    config = Config(str(ALEMBIC_CONFIG_FILE))
+    with engine.connect() as connection:
+        config.attributes["connection"] = connection
+        command.stamp(config, "base")
+        command.upgrade(config, "head")
+    today = date.today()
+    with sessionmaker(bind=engine)() as db:
+        db.execute(
+            insert(DBUser),
+            [
+                {
+                    "id": i,
+                    "email": f"user_{i}@example.com",
+                    "login_method": LoginMethod.EMAIL,
+                    "user_type": UserType.ADMIN if i == 1 else UserType.USER,
+                    "is_verified": True,
+                }
+                for i in range(1, NUMBER_OF_USERS + 1)
+            ],
+        )
+        db.execute(
+            insert(DBAddress),
+            [
+                {
+                    "user_id": i,
+                    "city": choice(CITIES),
+                    "latitude": uniform(50.5, 53.5),
+                    "longitude": uniform(3.5, 7.0),
+                }
+                for i in range(1, NUMBER_OF_USERS + 1)
+            ],
+        )
+        db.execute(
+            insert(DBCar),
+            [
+                {
+                    "id": i,
+                    "owner_id": randint(1, NUMBER_OF_USERS),
+                    "make": choice(MAKES),
+                    "model": "Model",
+                    "year": randint(2000, 2024),
+                    "transmission_type": choice(list(CarTransmissionType)),
+                    "motor_type": choice(list(CarEngineType)),
+                    "price_per_day": randint(20, 200),
+                    "is_listed": randint(0, 9) > 0,
+                }
+                for i in range(1, NUMBER_OF_CARS + 1)
+            ],
+        )
+        rentals = []
+        for i in range(1, NUMBER_OF_RENTALS + 1):
+            start = today + timedelta(days=randint(-365, 365))
+            rentals.append(
+                {
+                    "id": i,
+                    "car_id": randint(1, NUMBER_OF_CARS),
+                    "renter_id": randint(1, NUMBER_OF_USERS),
+                    "start_date": start,
+                    "end_date": start + timedelta(days=randint(1, 14)),
+                    "total_price": 100,
+                }
+            )
+        db.execute(insert(DBRental), rentals)
+        db.execute(
+            insert(DBReview),
+            [
+                {
+                    "rental_id": r["id"],
+                    "reviewer_id": r["renter_id"],
+                    "reviewee_id": randint(1, NUMBER_OF_USERS),
+                    "rating": randint(1, 5),
+                }
+                for r in rentals[: NUMBER_OF_RENTALS // 2]
+            ],
+        )
+        db.execute(
+            insert(DBFavorite).prefix_with("OR IGNORE"),
+            [
+                {
+                    "user_id": randint(1, NUMBER_OF_USERS),
+                    "car_id": randint(1, NUMBER_OF_CARS),
+                }
+                for _ in range(NUMBER_OF_FAVORITES)
+            ],
+        )
+        db.commit()
+        # Statistics for the query planner, as after "PRAGMA optimize" on a database in use
+        db.execute(text("ANALYZE"))
+    engine.dispose()
+
+
+def search(db: Session, **criteria):
+    arguments = {
+        "distance_km": None,
+        "renter_lat": None,
+        "renter_lon": None,
+        "availability_period": RentalPeriod(start_date=None, end_date=None),
+        "search_in_city": None,
+        "engine_type": None,
+        "transmission_type": None,
+        "price_min": None,
+        "price_max": None,
+        "make": None,
+        "sort": None,
+        "sort_direction": None,
+        "skip": 0,
+        "limit": 20,
+        "include_total": TotalCountType.EXACT,
+    }
+    arguments.update(criteria)
+    return car.search_cars(db=db, **arguments)
+
+
+def show_car(db: Session, car_id: int):
+    # Serialization loads the relationships shown by GET /cars/{car_id}
+    CarDisplay.model_validate(car.get_car(db, car_id))
+
+
+def list_rentals(db: Session, user_id: int, **filters):
+    page = rental.get_rentals(db, db.get(DBUser, user_id), **filters)
+    for item in page["rentals"]:
+        RentalDisplay.model_validate(item)
+
+
+def cases() -> List[Tuple[str, Set[str], Callable[[Session], object]]]:
+    """
+    Name, indexes the plans must use (the primary key of the favorites starts with user_id) and the
+    queries of each case.
+    """
+    today = date.today()
+    start = datetime.combine(today, datetime.min.time()) + timedelta(days=10)
+    period = RentalPeriod(start_date=start, end_date=start + timedelta(days=7))
+    return [
+        (
+            "car search by distance",
+            {"addresses_rtree", "ix_cars_owner_id"},
+            lambda db: search(
+                db,
+                distance_km=20,
+                renter_lat=51.44,
+                renter_lon=5.47,
+                sort=CarSearchSortType.DISTANCE,
+            ),
+        ),
+        (
+            "car search in a city",
+            {"ix_addresses_city", "ix_cars_owner_id"},
+            lambda db: search(db, search_in_city="Eindhoven"),
+        ),
+        (
+            "car search by make, engine, transmission and price",
+            {"ix_cars_search"},
+            lambda db: search(
+                db,
+                make="Fiat",
+                engine_type=CarEngineType.ELECTRIC,
+                transmission_type=CarTransmissionType.AUTOMATIC,
+                price_min=50,
+                price_max=120,
+            ),
+        ),
+        (
+            "car search by make and availability",
+            {"ix_cars_search", "ix_rentals_car_id_start_date_end_date"},
+            lambda db: search(
+                db,
+                make="Fiat",
+                availability_period=period,
+                sort=CarSearchSortType.PRICE,
+            ),
+        ),
+        (
+            "car details",
+            {"ix_rentals_car_id_start_date_end_date", "ix_reviews_rental_id"},
+            lambda db: show_car(db, 7),
+        ),
+        (
+            "cars of a user",
+            {"ix_cars_owner_id"},
+            lambda db: car.get_cars_by_user(db, db.get(DBCar, 7).owner_id),
+        ),
+        (
+            "rentals of a user",
+            {"ix_rentals_renter_id_start_date"},
+            lambda db: list_rentals(db, 42),
+        ),
+        (
+            "rentals of a user, next page",
+            {"ix_rentals_renter_id_start_date"},
+            lambda db: list_rentals(
+                db,
+                42,
+                cursor=rental.get_rentals(db, db.get(DBUser, 42), limit=2)[
+                    "next_cursor"
+                ],
+            ),
+        ),
+        (
+            "rentals of a car (admin)",
+            {"ix_rentals_car_id_start_date_end_date"},
+            lambda db: list_rentals(db, 1, car_id=7),
+        ),
+        (
+            "rentals of a user sorted by price",
+            {"ix_rentals_renter_id_start_date"},
+            lambda db: list_rentals(db, 42, sort_by=RentalSort.TOTAL_PRICE),
+        ),
+        (
+            "availability of a car",
+            {"ix_rentals_car_id_start_date_end_date"},
+            lambda db: rental.is_car_available(
+                7, period.start_date, period.end_date, db
+            ),
+        ),
+        (
+            "overlapping rental of a car",
+            {"ix_rentals_car_id_start_date_end_date"},
+            lambda db: rental.get_overlapping_rental(
+                7, period.start_date, period.end_date, db
+            ),
+        ),
+        (
+            "calendar of a car",
+            {"ix_rentals_car_id_start_date_end_date"},
+            lambda db: rental.get_car_calendar(
+                db, 7, today - timedelta(days=60), today + timedelta(days=30)
+            ),
+        ),
+        (
+            "reviews of a user",
+            {"ix_reviews_reviewer_id"},
+            lambda db: review.get_views_by_user(
+                db, 42, db.get(DBUser, 42), sort_dir=SortDirection.DESC
+            ),
+        ),
+        (
+            "favorites of a user",
+            {"sqlite_autoindex_favorites_1"},
+            lambda db: favorites.get_favorites_for_user(db.get(DBUser, 42), db),
+        ),
+        (
+            "favorites of a car",
+            {"ix_favorites_car_id"},
+            lambda db: favorites.get_favorites_for_car(7, db),
+        ),
+    ]
+
+
+@contextmanager
+def captured_statements(engine) -> Iterator[List[Tuple[str, object]]]:
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+
+def query_plan(engine, statement: str, parameters) -> List[str]:
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[3] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    scans = []
+    for detail in plan:
+        match = FULL_SCAN.match(detail)
+        # Aliases of joined loads end with a number (e.g. users_1)
+        if match and re.sub(r"_\d+$", "", match.group(1)) in LARGE_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def used_indexes(plan: List[str]) -> Set[str]:
+    return {
+        match.group(1) or match.group(2)
+        for match in (USED_INDEX.search(detail) for detail in plan)
+        if match
+    }
+
+
+@pytest.fixture(scope="module")
+def plan_engine(tmp_path_factory):
+    seed(0)
+    url = f"sqlite:///{tmp_path_factory.mktemp('query_plans') / 'query_plans.db'}"
+    prepare_db(url)
+    engine = create_db_engine(url)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize(
+    "name, expected_indexes, case", cases(), ids=[name for name, _, _ in cases()]
+)
+def test_query_plan(plan_engine, name, expected_indexes, case):
+    # The in-memory rental periods would hide the queries of the availability checks
+    availability_index.clear()
+    with captured_statements(plan_engine) as statements:
+        with sessionmaker(autocommit=False, autoflush=False, bind=plan_engine)() as db:
+            case(db)
+    plans = [
+        (" ".join(statement.split()), query_plan(plan_engine, statement, parameters))
+        for statement, parameters in statements
+    ]
+
+    assert plans
+    failed = {
+        statement: full_scans(plan) for statement, plan in plans if full_scans(plan)
+    }
+    assert not failed, f"Full scans of large tables in {name}: {failed}"
+    assert expected_indexes <= set().union(*(used_indexes(plan) for _, plan in plans))
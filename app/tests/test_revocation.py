@@ -0,0 +1,41 @@
+import time
+from datetime import datetime, timedelta
+
+from app.models.revoked_token import DBRevokedToken
+from app.services.revocation import RevocationList, to_epoch
+
+
+def test_sync_evicts_expired_entries_without_lookup(db):
+    revocation_list = RevocationList(sync_seconds=60)
+    revocation_list.add("short-lived", time.time() + 0.2)
+    revocation_list.add("long-lived", time.time() + 3600)
+    time.sleep(0.3)
+
+    revocation_list.sync(db)
+
+    assert "short-lived" not in revocation_list._entries
+    assert "long-lived" in revocation_list._entries
+
+
+def test_add_evicts_expired_entries(db):
+    revocation_list = RevocationList(sync_seconds=60)
+    revocation_list.add("short-lived", time.time() + 0.2)
+    time.sleep(0.3)
+
+    revocation_list.add("new", time.time() + 3600)
+
+    assert set(revocation_list._entries) == {"new"}
+    assert len(revocation_list._expiries) == 1
+
+
+def test_sync_loads_tokens_revoked_by_other_workers(db):
+    expires_at = datetime.utcnow().replace(microsecond=0) + timedelta(hours=1)
+    db.add(
+        DBRevokedToken(jti="other", expires_at=expires_at, revoked_at=datetime.utcnow())
+    )
+    db.commit()
+    revocation_list = RevocationList(sync_seconds=60)
+
+    assert revocation_list.is_revoked("other", db)
+    assert revocation_list._entries["other"] == to_epoch(expires_at)
+    assert not revocation_list.is_revoked("unknown", db)
@@ -22,6 +22,7 @@ from app.schemas.enums import (
     RentalStatus,
 )
 from app.services import car as car_service
+from app.services import review as review_service
 
 email_providers = ["google.com", "hotmail.com", "yahoo.com"]
 
@@ -81,6 +82,12 @@ def create_test_all(
         f"{rent_cnt} rentals and {rev_cnt} "
         f"reviews created in {time() - start_time:.2f} sec."
     )
+
+    start_time = time()
+    rated_users = review_service.rebuild_rating_stats(db)
+    print(
+        f"Rating stats of {rated_users} users built in {time() - start_time:.2f} sec."
+    )
     print("All done")
     return {
         "users_created": number_of_users,
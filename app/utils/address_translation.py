@@ -1,23 +1,236 @@
-from typing import Dict
+import abc
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
 
 from geopy.geocoders import Nominatim
+from sqlalchemy import func, insert, select
 
+from app.core.database import SessionLocal
+from app.models.geocode import (
+    DBGazetteerPlace,
+    DBGeocodeCache,
+    read_gazetteer_file,
+)
+from app.utils import constants
+from app.utils.cache import TTLCache
+from app.utils.geo import normalize_place, normalize_postal_code
 from app.utils.logger import logger
 
-geolocator = Nominatim(user_agent="car-rental", timeout=3)
-
 
 class AddressValidationError(Exception):
     pass
 
 
-def address_to_lat_lon(address: Dict):
-    try:
-        location = geolocator.geocode(address)
+class GeocodingUnavailableError(AddressValidationError):
+    """
+    The address could not be geocoded because a geocoder failed (e.g. network error), it can be retried later.
+    """
+
+
+class RateLimiter:
+    """
+    Spaces the calls of all threads to at most rate_per_second.
+    """
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1 / rate_per_second if rate_per_second else 0
+        self._next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(now, self._next_call)
+            self._next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+def address_key(address: Dict) -> str:
+    """
+    Cache key of an address: normalized values with sorted keys (same address, same key).
+    """
+    return json.dumps(
+        {
+            key: normalize_postal_code(value)
+            if key == "postalcode"
+            else normalize_place(value)
+            for key, value in address.items()
+            if value
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+
+
+class GeocodeResolver(abc.ABC):
+    """
+    Turns an address dictionary (street, postalcode, city, state, country) into coordinates.
+    """
+
+    # Results of precise resolvers are also saved in the geocode_cache table
+    persistent = True
+
+    @abc.abstractmethod
+    def resolve(self, address: Dict) -> Optional[Dict]:
+        """
+        :return: {"latitude": ..., "longitude": ...} or None if the address is not found
+        """
+
+
+class NominatimResolver(GeocodeResolver):
+    def __init__(self, timeout: float = 3):
+        self.geolocator = Nominatim(user_agent="car-rental", timeout=timeout)
+        self.unavailable_until = 0.0
+        # Usage policy of the public Nominatim service
+        self.rate_limiter = RateLimiter(constants.GEOCODE_RATE_PER_SECOND)
+
+    def resolve(self, address: Dict) -> Optional[Dict]:
+        # Do not wait for the timeout on every request while the service is not reachable
+        if time.monotonic() < self.unavailable_until:
+            raise GeocodingUnavailableError("Geocoding service is not reachable")
+        self.rate_limiter.wait()
+        try:
+            location = self.geolocator.geocode(address)
+        except Exception:
+            self.unavailable_until = time.monotonic() + constants.GEOCODE_RETRY_SECONDS
+            raise
         if location:
             return {"latitude": location.latitude, "longitude": location.longitude}
-        else:
-            raise AddressValidationError("Invalid address: unable to geocode.")
-    except Exception as exc:
-        logger.error(exc)
-        raise AddressValidationError(f"Error occurred during geocoding: {exc}")
+        return None
+
+
+class GazetteerResolver(GeocodeResolver):
+    """
+    Offline resolver returning the centroid of the postal code area or the city of the address
+    (gazetteer_places table, loaded into memory at the first lookup).
+    """
+
+    persistent = False
+
+    def __init__(self):
+        self._by_postal_code = None
+        self._by_city = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        by_postal_code, by_city = {}, {}
+        with SessionLocal() as db:
+            for place in db.execute(select(DBGazetteerPlace)).scalars():
+                coordinates = {"latitude": place.latitude, "longitude": place.longitude}
+                if place.postal_code:
+                    by_postal_code.setdefault(
+                        (place.country, place.postal_code), coordinates
+                    )
+                    by_postal_code.setdefault(("", place.postal_code), coordinates)
+                else:
+                    by_city.setdefault((place.country, place.city), coordinates)
+                    by_city.setdefault(("", place.city), coordinates)
+        self._by_postal_code, self._by_city = by_postal_code, by_city
+
+    def resolve(self, address: Dict) -> Optional[Dict]:
+        if self._by_city is None:
+            with self._lock:
+                if self._by_city is None:
+                    self.load()
+        country = normalize_place(address.get("country"))
+        postal_code = normalize_postal_code(address.get("postalcode"))
+        if postal_code:
+            # Full postal code first, then its leading part (e.g. the digits of "1234 AB")
+            for code in (
+                postal_code,
+                normalize_postal_code(address["postalcode"].split()[0]),
+            ):
+                coordinates = self._by_postal_code.get((country, code))
+                if coordinates:
+                    return coordinates
+        return self._by_city.get((country, normalize_place(address.get("city"))))
+
+
+def seed_gazetteer() -> None:
+    """
+    Fills the gazetteer of a new (or empty) database from GAZETTEER_SEED_FILE, it runs at startup.
+    """
+    seed_file = Path(__file__).resolve().parents[1] / constants.GAZETTEER_SEED_FILE
+    with SessionLocal() as db:
+        if db.execute(select(func.count()).select_from(DBGazetteerPlace)).scalar():
+            return
+        if seed_file.exists():
+            db.execute(insert(DBGazetteerPlace), read_gazetteer_file(seed_file))
+            db.commit()
+
+
+RESOLVERS = {"nominatim": NominatimResolver, "gazetteer": GazetteerResolver}
+
+# Resolvers are tried in this order, the first result is used
+geocode_resolvers: List[GeocodeResolver] = [
+    RESOLVERS[name]() for name in constants.GEOCODE_RESOLVERS
+]
+
+
+class GeocodeCache:
+    """
+    In-memory LRU of geocoded addresses in front of the geocode_cache table.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key: str) -> Optional[Dict]:
+        coordinates = self.memory.get(key)
+        if coordinates is not None:
+            return coordinates
+        try:
+            with SessionLocal() as db:
+                row = db.get(DBGeocodeCache, key)
+        except Exception as exc:
+            logger.error(f"Geocode cache could not be read: {exc}")
+            return None
+        if row is None:
+            return None
+        coordinates = {"latitude": row.latitude, "longitude": row.longitude}
+        self.memory.set(key, coordinates)
+        return coordinates
+
+    def set(self, key: str, coordinates: Dict, persistent: bool) -> None:
+        self.memory.set(key, coordinates)
+        if not persistent:
+            return
+        try:
+            with SessionLocal() as db:
+                db.merge(DBGeocodeCache(address_key=key, **coordinates))
+                db.commit()
+        except Exception as exc:
+            logger.error(f"Geocode cache could not be saved: {exc}")
+
+
+geocode_cache = GeocodeCache(
+    maxsize=constants.GEOCODE_CACHE_SIZE, ttl=constants.GEOCODE_CACHE_TTL_SECONDS
+)
+
+
+def address_to_lat_lon(address: Dict):
+    key = address_key(address)
+    coordinates = geocode_cache.get(key)
+    if coordinates is not None:
+        return coordinates
+
+    errors = []
+    for resolver in geocode_resolvers:
+        try:
+            coordinates = resolver.resolve(address)
+        except Exception as exc:
+            logger.error(exc)
+            errors.append(str(exc))
+            continue
+        if coordinates:
+            geocode_cache.set(key, coordinates, resolver.persistent)
+            return coordinates
+    if errors:
+        raise GeocodingUnavailableError(
+            f"Error occurred during geocoding: {'; '.join(errors)}"
+        )
+    raise AddressValidationError("Invalid address: unable to geocode.")
@@ -0,0 +1,70 @@
+import math
+from typing import Dict
+
+# Mean radius of the earth in kilometers (same value used in distance calculations of car search)
+EARTH_RADIUS_KM = 6371.0
+
+
+def bounding_box(lat: float, lon: float, distance_km: float) -> Dict[str, float]:
+    """
+    Calculates the smallest lat/lon box that contains the circle with the given center and radius.
+    It is used as a cheap (indexed) prefilter before the exact great-circle distance check.
+    :param lat: Latitude of the center in degrees
+    :param lon: Longitude of the center in degrees
+    :param distance_km: Radius of the circle in kilometers
+    :return: A dictionary of "min_lat", "max_lat", "min_lon" and "max_lon" in degrees
+    """
+    angular_distance = distance_km / EARTH_RADIUS_KM
+    delta_lat = math.degrees(angular_distance)
+    min_lat = lat - delta_lat
+    max_lat = lat + delta_lat
+
+    # If the circle contains a pole or crosses the antimeridian, longitude can not be bounded
+    if min_lat <= -90 or max_lat >= 90:
+        return {
+            "min_lat": max(min_lat, -90.0),
+            "max_lat": min(max_lat, 90.0),
+            "min_lon": -180.0,
+            "max_lon": 180.0,
+        }
+    delta_lon = math.degrees(
+        math.asin(min(1.0, math.sin(angular_distance) / math.cos(math.radians(lat))))
+    )
+    min_lon = lon - delta_lon
+    max_lon = lon + delta_lon
+    if min_lon < -180 or max_lon > 180:
+        min_lon, max_lon = -180.0, 180.0
+    return {
+        "min_lat": min_lat,
+        "max_lat": max_lat,
+        "min_lon": min_lon,
+        "max_lon": max_lon,
+    }
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great-circle distance between two points in kilometers (haversine formula).
+    It is registered as a single SQLite function so that a distance costs one Python call per row.
+    :return: Distance in kilometers or None if any of the coordinates is missing
+    """
+    if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
+        return None
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def normalize_place(value) -> str:
+    """
+    Normalizes a part of an address (city, country, street, ...) for lookups: case folded with single spaces.
+    """
+    return " ".join(str(value).split()).casefold() if value is not None else ""
+
+
+def normalize_postal_code(value) -> str:
+    return "".join(str(value).split()).upper() if value is not None else ""
@@ -1,11 +1,138 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from prometheus_client import Counter, Gauge
+
+from app.utils import constants
+
+# Hashes created with another cost (rounds) are marked as "needs update" and rehashed on login
+ctx = CryptContext(
+    schemes="bcrypt", deprecated="auto", bcrypt__rounds=constants.BCRYPT_ROUNDS
+)
+
+hash_queue_depth = Gauge(
+    "password_hash_queue_depth", "Password hashing jobs waiting or running"
+)
+hash_rejected = Counter(
+    "password_hash_rejected_total",
+    "Password hashing jobs rejected because the hashing queue was full",
+)
+
+
+# Module level functions, so that they can be sent to a process pool
+def _hash(plain_password: str) -> str:
+    return ctx.hash(plain_password)
+
+
+def _verify(plain_password: str, encrypted_password: str) -> bool:
+    return ctx.verify(plain_password, encrypted_password)
+
+
+def _verify_and_update(plain_password: str, encrypted_password: str):
+    return ctx.verify_and_update(plain_password, encrypted_password)
+
 
-ctx = CryptContext(schemes="bcrypt", deprecated="auto")
+class HashExecutor:
+    """
+    Runs the (slow) bcrypt calls on a fixed number of workers, so a burst of logins can not take over the
+    request threadpool. If max_pending jobs are already waiting or running, new jobs are rejected with 503.
+    Async endpoints await their jobs (run_async), sync endpoints block a request thread while waiting (run),
+    at most max_blocking of them at a time.
+    """
+
+    def __init__(
+        self, workers: int, max_pending: int, max_blocking: int, use_processes: bool
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_blocking = max_blocking
+        self.use_processes = use_processes
+        self._pending = 0
+        self._blocking = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def _admit(self, blocking: bool):
+        with self._lock:
+            if self._pending >= self.max_pending or (
+                blocking and self._blocking >= self.max_blocking
+            ):
+                hash_rejected.inc()
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Server is busy, please try again.",
+                    headers={"Retry-After": "1"},
+                )
+            # Pools are created on first use in each (forked) app worker
+            if self._executor_pid != os.getpid():
+                self._executor = (
+                    ProcessPoolExecutor(max_workers=self.workers)
+                    if self.use_processes
+                    else ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="hash"
+                    )
+                )
+                self._executor_pid = os.getpid()
+            self._pending += 1
+            if blocking:
+                self._blocking += 1
+            hash_queue_depth.set(self._pending)
+            return self._executor
+
+    def _release(self, blocking: bool):
+        with self._lock:
+            self._pending -= 1
+            if blocking:
+                self._blocking -= 1
+            hash_queue_depth.set(self._pending)
+
+    def run(self, fn, *args):
+        executor = self._admit(blocking=True)
+        try:
+            return executor.submit(fn, *args).result()
+        finally:
+            self._release(blocking=True)
+
+    async def run_async(self, fn, *args):
+        executor = self._admit(blocking=False)
+        try:
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+        finally:
+            self._release(blocking=False)
+
+
+hash_executor = HashExecutor(
+    workers=constants.HASH_WORKERS,
+    max_pending=constants.HASH_MAX_PENDING,
+    max_blocking=constants.HASH_MAX_BLOCKING,
+    use_processes=constants.HASH_USE_PROCESSES,
+)
 
 
 class Hash:
     def bcrypt(plain_password: str):
-        return ctx.hash(plain_password)
+        return hash_executor.run(_hash, plain_password)
 
     def verify(plain_password: str, encrypted_password: str):
-        return ctx.verify(plain_password, encrypted_password)
+        return hash_executor.run(_verify, plain_password, encrypted_password)
+
+    def verify_and_update(plain_password: str, encrypted_password: str):
+        """
+        Verifies the password and rehashes it if the hash was created with other settings (e.g. cost).
+        :return: (True if the password is valid, new hash to be saved or None)
+        """
+        return hash_executor.run(_verify_and_update, plain_password, encrypted_password)
+
+    # Versions for async endpoints, the request does not hold a thread while the hash is calculated
+    async def bcrypt_async(plain_password: str):
+        return await hash_executor.run_async(_hash, plain_password)
+
+    async def verify_and_update_async(plain_password: str, encrypted_password: str):
+        return await hash_executor.run_async(
+            _verify_and_update, plain_password, encrypted_password
+        )
@@ -1,45 +1,249 @@
-import inspect
+import atexit
+import json
 import os
+import queue
+import sys
+import threading
+import time
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
+from app.utils import constants
+
+
+@lru_cache(maxsize=1024)
+def caller_file_name(filename: str) -> str:
+    caller_file = Path(filename)
+    try:
+        return caller_file.relative_to("/app").as_posix()
+    except ValueError:
+        return caller_file.name
+
+
+class LogFile:
+    """
+    Open log file that is rotated when it grows over max_bytes or gets older than rotate_seconds.
+    Rotated files are renamed to <name>.1, <name>.2, ... (the highest ones above backup_count are dropped).
+    """
+
+    def __init__(
+        self, path: Path, max_bytes: int, rotate_seconds: float, backup_count: int
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        self.file = self.path.open(mode="a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def write(self, lines: list):
+        self.file.write("".join(lines))
+        self.file.flush()
+        if (self.max_bytes and self.file.tell() >= self.max_bytes) or (
+            self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds
+        ):
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            backup = self.path.with_name(f"{self.path.name}.{i}")
+            if backup.exists():
+                backup.replace(self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backup_count:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink(missing_ok=True)
+        self._open()
+
+    def close(self):
+        self.file.close()
+
 
 class Logger:
-    def __init__(self, info_file: str, error_file: str, warning_file: str):
+    """
+    Logger that only puts the records on a queue in the calling thread. A background thread writes them to
+    the files in batches (files are kept open and rotated by size and age).
+    Records are dropped (and counted) if the queue is full, so logging never blocks a request.
+    """
+
+    def __init__(
+        self,
+        info_file: str,
+        error_file: str,
+        warning_file: str,
+        json_lines: bool = False,
+        max_bytes: int = constants.LOG_MAX_BYTES,
+        rotate_seconds: float = constants.LOG_ROTATE_SECONDS,
+        backup_count: int = constants.LOG_BACKUP_COUNT,
+    ):
         self.__info_file__ = info_file
         self.__error_file__ = error_file
         self.__warning_file__ = warning_file
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self._queue = queue.Queue(maxsize=constants.LOG_QUEUE_SIZE)
+        self._dropped = 0
+        self._writer = None
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
 
     def error(self, message):
-        self.__print_to_file__(inspect.stack()[1], self.__error_file__, message)
+        self.__enqueue__("ERROR", self.__error_file__, message)
 
     def info(self, message):
-        self.__print_to_file__(inspect.stack()[1], self.__info_file__, message)
+        self.__enqueue__("INFO", self.__info_file__, message)
 
     def warning(self, message):
-        self.__print_to_file__(inspect.stack()[1], self.__warning_file__, message)
+        self.__enqueue__("WARNING", self.__warning_file__, message)
 
-    def __print_to_file__(self, stack, out_file, message):
-        caller_file = Path(stack.filename)
-        try:
-            caller_file = caller_file.relative_to("/app")
-        except ValueError:
-            caller_file = caller_file.name
+    def flush(self, timeout: float = 5.0):
+        """
+        Waits until the records logged so far are written.
+        """
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self._writer is not None and self._writer_pid == os.getpid():
+            try:
+                self._queue.put(None, timeout=5.0)
+                self._writer.join(timeout=5.0)
+            except queue.Full:
+                pass
+        self._writer = None
 
-        now = datetime.utcnow()
+    def __enqueue__(self, level, out_file, message):
+        # Frame of the caller of error/info/warning
+        frame = sys._getframe(2)
+        record = (
+            time.time(),
+            level,
+            frame.f_code.co_filename,
+            frame.f_lineno,
+            message,
+            out_file,
+        )
+        # The writer thread does not survive a fork (e.g. app workers), it is started again in the new process
+        if self._writer_pid != os.getpid():
+            self.__start_writer__()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._dropped += 1
 
-        out_file_path = Path(out_file)
-        out_file_path.parent.mkdir(parents=True, exist_ok=True)
+    def __start_writer__(self):
+        with self._start_lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=constants.LOG_QUEUE_SIZE)
+            self._writer = threading.Thread(
+                target=self.__write_records__, name="logger-writer", daemon=True
+            )
+            self._writer_pid = os.getpid()
+            self._writer.start()
 
-        with out_file_path.open(mode="a", encoding="utf-8") as log:
-            log.write(
-                f"{now:%Y-%m-%d %H:%M:%S} -- {caller_file} -- line[{stack.lineno}] -- {message}\n"
+    def __format_record__(self, record) -> str:
+        timestamp, level, filename, lineno, message, _ = record
+        now = datetime.utcfromtimestamp(timestamp)
+        caller_file = caller_file_name(filename)
+        if self.json_lines:
+            return (
+                json.dumps(
+                    {
+                        "time": now.isoformat(timespec="milliseconds"),
+                        "level": level,
+                        "file": caller_file,
+                        "line": lineno,
+                        "message": str(message),
+                    },
+                    ensure_ascii=False,
+                )
+                + "\n"
             )
+        return (
+            f"{now:%Y-%m-%d %H:%M:%S} -- {caller_file} -- line[{lineno}] -- {message}\n"
+        )
+
+    def __write_records__(self):
+        files = {}
+        log_queue = self._queue
+        running = True
+        while running:
+            batch = [log_queue.get()]
+            deadline = time.monotonic() + constants.LOG_FLUSH_INTERVAL_SECONDS
+            # Collect a batch until it is full or the flush interval is over
+            while len(batch) < constants.LOG_BATCH_SIZE:
+                try:
+                    batch.append(
+                        log_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    )
+                except queue.Empty:
+                    break
+                if batch[-1] is None or isinstance(batch[-1], threading.Event):
+                    break
+
+            lines_per_file = {}
+            waiters = []
+            for record in batch:
+                if record is None:
+                    running = False
+                elif isinstance(record, threading.Event):
+                    waiters.append(record)
+                else:
+                    lines_per_file.setdefault(record[5], []).append(
+                        self.__format_record__(record)
+                    )
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                lines_per_file.setdefault(self.__warning_file__, []).append(
+                    self.__format_record__(
+                        (
+                            time.time(),
+                            "WARNING",
+                            __file__,
+                            0,
+                            f"{dropped} log records dropped (queue full)",
+                            None,
+                        )
+                    )
+                )
+            for out_file, lines in lines_per_file.items():
+                try:
+                    if out_file not in files:
+                        files[out_file] = LogFile(
+                            Path(out_file),
+                            self.max_bytes,
+                            self.rotate_seconds,
+                            self.backup_count,
+                        )
+                    files[out_file].write(lines)
+                except OSError as exc:
+                    print(
+                        f"Could not write log file {out_file}: {exc}", file=sys.stderr
+                    )
+            for waiter in waiters:
+                waiter.set()
+        for log_file in files.values():
+            log_file.close()
 
 
-current_dir = Path(os.path.dirname(__file__)).as_posix()
-logs_path = current_dir[: current_dir.rindex("/")] + "../../logs/"
+logs_path = Path(__file__).resolve().parents[2] / "logs"
 
 logger = Logger(
-    logs_path + "info.txt", logs_path + "error.txt", logs_path + "warning.txt"
+    (logs_path / "info.txt").as_posix(),
+    (logs_path / "error.txt").as_posix(),
+    (logs_path / "warning.txt").as_posix(),
+    json_lines=constants.LOG_JSON_LINES,
 )
@@ -0,0 +1,175 @@
+import base64
+import json
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import Select, and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.schemas.enums import TotalCountType
+from app.utils import constants
+from app.utils.cache import TTLCache
+
+
+class TotalCounts(NamedTuple):
+    """
+    Total number of matches of a paginated list.
+    """
+
+    # None if include_total is NONE
+    count: Optional[int] = None
+    # The count is an estimate (include_total is ESTIMATE)
+    is_estimate: bool = False
+    # The estimate stopped counting at ESTIMATE_COUNT_CAP, the list has more matches than count
+    is_capped: bool = False
+
+    def fields(self) -> dict:
+        """
+        Keys of the total count in the result of a paginated list.
+        """
+        return {
+            "total_counts": self.count,
+            "total_counts_is_estimate": self.is_estimate,
+            "total_counts_is_capped": self.is_capped,
+        }
+
+
+# Total counts of paginated lists keyed by the list name and the normalized filter set.
+# Values are TotalCounts.
+total_counts_cache = TTLCache(
+    maxsize=constants.COUNT_CACHE_SIZE, ttl=constants.COUNT_CACHE_TTL_SECONDS
+)
+
+
+def encode_cursor(sort_value: Any, row_id: int) -> str:
+    """
+    Creates an opaque cursor (keyset pagination) from the sort key and the id of the last row of a page.
+    :param sort_value: Value of the sort column of the last row (None if the list is sorted by id only)
+    :param row_id: id of the last row
+    :return: URL safe string
+    """
+    if isinstance(sort_value, Enum):
+        sort_value = sort_value.value
+    elif isinstance(sort_value, (date, datetime)):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, python_type: Optional[type] = None) -> Tuple[Any, int]:
+    """
+    Reads the sort key and the id back from a cursor created by encode_cursor.
+    :param cursor: Cursor received from the client
+    :param python_type: Python type of the sort column (used to restore dates and enums)
+    :return: (sort value, row id)
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        if sort_value is not None and python_type is not None:
+            if python_type is datetime:
+                sort_value = datetime.fromisoformat(sort_value)
+            elif python_type is date:
+                sort_value = date.fromisoformat(sort_value)
+            else:
+                sort_value = python_type(sort_value)
+        return sort_value, int(row_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
+def keyset_filter(
+    sort_column, id_column, sort_value: Any, row_id: int, descending: bool
+):
+    """
+    Creates the filter that selects the rows coming after the cursor position. Rows must be ordered by
+    (sort_column, id_column) in the same direction.
+    :param sort_column: Column (or labeled expression) the list is sorted by, None if sorted by id only
+    :param id_column: Unique id column used as the tiebreaker
+    :param sort_value: Sort value of the last row of the previous page
+    :param row_id: id of the last row of the previous page
+    :param descending: Direction of the sort
+    :return: Filter expression
+    """
+    if descending:
+        after_id = id_column < row_id
+        after_value = sort_column < sort_value if sort_column is not None else None
+    else:
+        after_id = id_column > row_id
+        after_value = sort_column > sort_value if sort_column is not None else None
+    if sort_column is None:
+        return after_id
+    return or_(after_value, and_(sort_column == sort_value, after_id))
+
+
+def get_total_counts(
+    db: Session,
+    include_total: TotalCountType,
+    cache_key: tuple,
+    statement: Select,
+    estimate_statement: Optional[Select] = None,
+    estimate_scale: float = 1.0,
+) -> TotalCounts:
+    """
+    Returns the total number of matches of a paginated list. Results are cached for a short time.
+    :param db: App session
+    :param include_total: EXACT, ESTIMATE or NONE (nothing is counted)
+    :param cache_key: Name of the list and its normalized filters (sort and pagination values excluded)
+    :param statement: Select statement of the matching rows (without order, offset and limit)
+    :param estimate_statement: Cheaper statement to count for the estimate (defaults to statement)
+    :param estimate_scale: Multiplier applied to the count of estimate_statement
+    :return: Total count and if it is an estimate (count is None if include_total is NONE)
+    """
+    if include_total == TotalCountType.NONE:
+        return TotalCounts()
+    cached = total_counts_cache.get(cache_key)
+    if cached is not None:
+        if not cached.is_estimate or include_total == TotalCountType.ESTIMATE:
+            return cached
+
+    if include_total == TotalCountType.EXACT:
+        count = db.execute(
+            select(func.count()).select_from(statement.subquery())
+        ).scalar()
+        total_counts = TotalCounts(count)
+        total_counts_cache.set(cache_key, total_counts)
+        return total_counts
+
+    # Estimate: count at most ESTIMATE_COUNT_CAP rows of the (cheaper) statement
+    capped = (
+        estimate_statement if estimate_statement is not None else statement
+    ).limit(constants.ESTIMATE_COUNT_CAP)
+    count = db.execute(select(func.count()).select_from(capped.subquery())).scalar()
+    total_counts = TotalCounts(
+        round(count * estimate_scale),
+        is_estimate=True,
+        is_capped=count >= constants.ESTIMATE_COUNT_CAP,
+    )
+    total_counts_cache.set(cache_key, total_counts)
+    return total_counts
+
+
+async def get_total_counts_async(
+    db: AsyncSession,
+    include_total: TotalCountType,
+    cache_key: tuple,
+    statement: Select,
+    estimate_statement: Optional[Select] = None,
+    estimate_scale: float = 1.0,
+) -> TotalCounts:
+    """
+    Async version of get_total_counts (same parameters), it runs on the connection of the AsyncSession.
+    """
+    return await db.run_sync(
+        get_total_counts,
+        include_total,
+        cache_key,
+        statement,
+        estimate_statement,
+        estimate_scale,
+    )